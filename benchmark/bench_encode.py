@@ -0,0 +1,96 @@
+"""
+    Compares the parallel layer compression of LayerEncoder for different worker counts.
+
+    Builds a deterministic stack of synthetic RGBA layers, compresses it with 1, 2, 4 and 8
+    worker processes and writes the Psd file to memory. Every result is checked to be
+    byte-identical to the Psd file written by pytoshop alone.
+
+    Run from the project directory:
+        python -m benchmark.bench_encode [--layers 100] [--size 1920 1080]
+"""
+import argparse
+import time
+from io import BytesIO
+
+import numpy as np
+import pytoshop
+from pytoshop.enums import ColorChannel, ColorMode
+from pytoshop.user import nested_layers
+
+from modules.psd_encode import LayerEncoder
+
+WORKERS = (1, 2, 4, 8)
+
+
+def create_layers(num_layers: int, size, seed: int=287):
+    """ Render pass like layers: gradients, flat areas, noise and transparent borders """
+    width, height = size
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    layer_ls = list()
+
+    for idx in range(num_layers):
+        layer = nested_layers.Image(name=f'layer_{idx:03d}', color_mode=ColorMode.rgb)
+        gradient = (x * (idx + 1) // 7 + y // 3) % 256
+
+        for c, color_channel in enumerate((ColorChannel.red, ColorChannel.green, ColorChannel.blue)):
+            plane = (gradient + c * 40).astype(np.uint8)
+            noise_rows = slice(height // 3, height // 3 + height // 4)
+            plane[noise_rows] = rng.randint(0, 256, plane[noise_rows].shape, dtype=np.uint8)
+            layer.set_channel(color_channel, plane)
+
+        alpha = np.zeros((height, width), dtype=np.uint8)
+        border = (idx % 5 + 1) * height // 20
+        alpha[border:height - border, border:width - border] = 255
+        layer.set_channel(ColorChannel.transparency, alpha)
+
+        layer_ls.append(layer)
+
+    return layer_ls
+
+
+def create_psd(layer_ls, size):
+    return nested_layers.nested_layers_to_psd(
+        layers=layer_ls, color_mode=ColorMode.rgb, version=pytoshop.enums.Version.psd,
+        compression=pytoshop.enums.Compression.rle, size=size
+        )
+
+
+def write(psd) -> bytes:
+    fd = BytesIO()
+    psd.write(fd)
+    return fd.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--layers', type=int, default=100)
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080))
+    args = parser.parse_args()
+    size = tuple(args.size)
+
+    print(f'Creating {args.layers} layers at {size[0]}x{size[1]}')
+    layer_ls = create_layers(args.layers, size)
+
+    start = time.perf_counter()
+    reference = write(create_psd(layer_ls, size))
+    reference_time = time.perf_counter() - start
+    print(f'pytoshop write: {reference_time:.2f}s {len(reference) / 1048576:.1f}MB')
+
+    print('workers  encode[s]  write[s]  total[s]  speedup  identical')
+    for workers in WORKERS:
+        psd = create_psd(layer_ls, size)
+
+        start = time.perf_counter()
+        LayerEncoder(workers).encode(psd)
+        encode_time = time.perf_counter() - start
+
+        data = write(psd)
+        total_time = time.perf_counter() - start
+
+        print(f'{workers:7d}  {encode_time:9.2f}  {total_time - encode_time:8.2f}  {total_time:8.2f}  '
+              f'{reference_time / total_time:7.2f}  {data == reference}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""
+    Times every stage of the decode -> resize -> split -> compress -> write pipeline.
+
+    Generates a deterministic corpus of PNG, JPEG and TIFF files in 8, 16 and 32 bit
+    and RGB, RGBA, P and L modes in several sizes. Every file is added to a PyShop with
+    PyShop.add_image_as_layer, then the Psd file is created with PyShop.create_psd.
+    The stage times come from the PyShop timer. Results are printed and written as JSON.
+
+    Run from the project directory:
+        python -m benchmark.bench_pipeline [--sizes 640x360 1920x1080 3840x2160] [--output results.json]
+"""
+import argparse
+import json
+import platform
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import PIL
+import pytoshop
+from PIL import Image
+
+from modules import packbits
+from modules.pyshop import PyShop
+from modules.stage_times import StageTimes
+
+# Format, Pillow mode, bits per channel
+CORPUS = [
+    ('PNG', 'RGB', 8),
+    ('PNG', 'RGBA', 8),
+    ('PNG', 'P', 8),
+    ('PNG', 'L', 8),
+    ('PNG', 'I;16', 16),
+    ('JPEG', 'RGB', 8),
+    ('JPEG', 'L', 8),
+    ('TIFF', 'RGB', 8),
+    ('TIFF', 'RGBA', 8),
+    ('TIFF', 'I;16', 16),
+    ('TIFF', 'I', 32),
+    ('TIFF', 'F', 32),
+    ]
+
+SUFFIX = {'PNG': '.png', 'JPEG': '.jpg', 'TIFF': '.tif'}
+
+SIZES = ['640x360', '1920x1080', '3840x2160']
+
+
+def render_pass(size: Tuple[int, int], seed: int) -> np.ndarray:
+    """ Float RGBA image [0.0 - 1.0] resembling a render pass: gradients, flat areas, noise and an alpha mask """
+    width, height = size
+    rng = np.random.RandomState(seed)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+
+    rgb = np.empty((height, width, 3), dtype=np.float32)
+    for c in range(3):
+        rgb[..., c] = (x / width * (c + 1) + y / height * (3 - c)) % 1.0
+
+    # Flat area and a band of noise
+    rgb[height // 8:height // 3, width // 8:width // 3] = rng.rand(3)
+    noise_rows = slice(height // 2, height // 2 + height // 6)
+    rgb[noise_rows] = rng.rand(*rgb[noise_rows].shape)
+
+    alpha = (((x - width / 2) / width) ** 2 + ((y - height / 2) / height) ** 2 < 0.16).astype(np.float32)
+
+    return np.dstack((rgb, alpha))
+
+
+def create_image(rgba: np.ndarray, mode: str, bits: int) -> Image.Image:
+    img_8bit = (rgba * 255).astype(np.uint8)
+    luminance = rgba[..., :3].mean(axis=2)
+
+    # Pillow picks the mode from the array shape and dtype
+    if mode == 'RGBA':
+        return Image.fromarray(img_8bit)
+    if mode == 'RGB':
+        return Image.fromarray(img_8bit[..., :3])
+    if mode == 'P':
+        return Image.fromarray(img_8bit[..., :3]).quantize(colors=64)
+    if mode == 'L':
+        return Image.fromarray((luminance * 255).astype(np.uint8))
+    if mode == 'I;16':
+        return Image.fromarray((luminance * 65535).astype(np.uint16))
+    if mode == 'I':
+        return Image.fromarray((luminance * 2147483647).astype(np.int32))
+    if mode == 'F':
+        return Image.fromarray(luminance.astype(np.float32))
+
+    raise ValueError(f'Unsupported corpus mode {mode} {bits}bit')
+
+
+def create_corpus(directory: Path, sizes: List[Tuple[int, int]], seed: int=287) -> List[dict]:
+    """ Write every corpus entry in every size, files are only written if they do not exist yet """
+    corpus = list()
+
+    for size in sizes:
+        rgba = render_pass(size, seed)
+
+        for idx, (img_format, mode, bits) in enumerate(CORPUS):
+            name = f'{size[0]}x{size[1]}_{img_format.lower()}_{mode.replace(";", "")}_{bits}bit'
+            file = directory / (name + SUFFIX[img_format])
+
+            if not file.exists():
+                create_image(rgba, mode, bits).save(file, format=img_format)
+
+            corpus.append(dict(file=file.name, format=img_format, mode=mode, bits=bits, size=list(size),
+                               file_size=file.stat().st_size))
+
+    return corpus
+
+
+def add_image(pyshop: PyShop, image_file: Path) -> dict:
+    """ Add the image with PyShop.add_image_as_layer, the stage times are recorded by the PyShop timer.
+        Time not covered by any stage eg. opening the file and creating the layer is reported as other.
+    """
+    start = time.perf_counter()
+    pyshop.add_image_as_layer(image_file)
+    wall_time = time.perf_counter() - start
+
+    stages = pyshop.timer.file_seconds(image_file.stem)
+    stages['other'] = max(0.0, wall_time - sum(stages.values()))
+    channels = len(pyshop.layer_ls[0].channels) if pyshop.layer_ls else 0
+
+    return dict(stages=stages, channels=channels)
+
+
+def create_psd(pyshop: PyShop, psd_file: Path) -> dict:
+    """ Create the Psd file with PyShop.create_psd, the job stages of the PyShop timer
+        minus the stages of all files are the time spent in create_psd.
+    """
+    layers = len(pyshop.layer_ls)
+    before = pyshop.timer.records()['job']['stages']
+
+    start = time.perf_counter()
+    pyshop.create_psd(psd_file)
+    wall_time = time.perf_counter() - start
+
+    after = pyshop.timer.records()['job']['stages']
+    stages = {stage: seconds - before.get(stage, 0.0) for stage, seconds in after.items()}
+    stages = {stage: seconds for stage, seconds in stages.items() if seconds > 0.0}
+    stages['other'] = max(0.0, wall_time - sum(stages.values()))
+
+    return dict(stages=stages, layers=layers, psd_size=psd_file.stat().st_size)
+
+
+def run(corpus_dir: Path, corpus: List[dict], psd_size: Tuple[int, int], compression: str, repeat: int) -> dict:
+    files, jobs = list(), list()
+    psd_file = corpus_dir / 'bench_pipeline.psd'
+
+    for run_idx in range(repeat):
+        pyshop = PyShop(psd_size)
+        pyshop.compression = PyShop.compression_methods[compression]
+
+        for entry in corpus:
+            result = dict(entry, run=run_idx)
+            try:
+                result.update(add_image(pyshop, corpus_dir / entry['file']))
+            except Exception as e:
+                result['error'] = f'{type(e).__name__}: {e}'
+            files.append(result)
+
+        try:
+            jobs.append(dict(create_psd(pyshop, psd_file), run=run_idx))
+        finally:
+            pyshop.cleanup()
+            if psd_file.exists():
+                psd_file.unlink()
+
+    return dict(files=files, jobs=jobs)
+
+
+def environment() -> dict:
+    return dict(
+        python=platform.python_version(), platform=platform.platform(), numpy=np.__version__,
+        pillow=PIL.__version__, pytoshop=pytoshop.__version__, packbits=packbits.active_encoder(),
+        )
+
+
+def print_results(results: dict):
+    file_stages = [s for s in StageTimes.stages if s not in ('read', 'write')] + ['other']
+    print(f'{"file":42s}' + ''.join(f'{s:>9s}' for s in file_stages) + '  [ms, best of runs]')
+
+    best = dict()
+    for result in results['files']:
+        if 'error' in result:
+            best[result['file']] = result['error']
+        elif not isinstance(best.get(result['file']), dict) or \
+                sum(result['stages'].values()) < sum(best[result['file']].values()):
+            best[result['file']] = result['stages']
+
+    for file, stages in best.items():
+        if isinstance(stages, str):
+            print(f'{file:42s} {stages}')
+        else:
+            print(f'{file:42s}' + ''.join(f'{stages.get(s, 0) * 1000:9.1f}' for s in file_stages))
+
+    for job in results['jobs']:
+        print(f'create_psd run {job["run"]}: {job["layers"]} layers {job["psd_size"] / 1048576:.1f}MB  ' +
+              '  '.join(f'{s} {v * 1000:.1f}ms' for s, v in job['stages'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=SIZES, help='Corpus image sizes as WIDTHxHEIGHT')
+    parser.add_argument('--psd-size', type=int, nargs=2, default=PyShop.default_img_size)
+    parser.add_argument('--compression', choices=list(PyShop.compression_methods), default=PyShop.default_compression)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus', help='Directory to create and re-use the corpus in, temporary if not set')
+    parser.add_argument('--output', default='bench_pipeline.json', help='JSON result file')
+    args = parser.parse_args()
+
+    sizes = [tuple(int(v) for v in s.lower().split('x')) for s in args.sizes]
+
+    with tempfile.TemporaryDirectory(prefix='tieflader_bench_') as tmp_dir:
+        corpus_dir = Path(args.corpus or tmp_dir)
+        corpus_dir.mkdir(parents=True, exist_ok=True)
+
+        print(f'Creating corpus of {len(CORPUS) * len(sizes)} files in {corpus_dir.as_posix()}')
+        corpus = create_corpus(corpus_dir, sizes)
+        results = run(corpus_dir, corpus, tuple(args.psd_size), args.compression, args.repeat)
+
+    results.update(environment=environment(), psd_size=list(args.psd_size), compression=args.compression,
+                   argv=sys.argv[1:])
+    print_results(results)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Results written to {Path(args.output).absolute().as_posix()}')
+
+
+if __name__ == '__main__':
+    main()
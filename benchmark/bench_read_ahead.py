@@ -0,0 +1,84 @@
+"""
+    Compares decoding image files from a slow network share with and without read-ahead.
+
+    Writes a corpus of PNG and JPEG render passes and reads them through the ThrottledOpener
+    stand-in of a network share. Every configuration reads the files with a ReadAhead of the
+    given depth and concurrent requests and decodes them from the buffers in this thread,
+    like PsdJob does with read_ahead_files set. Depth 1 with 1 request reads one file after
+    another like decoding without read-ahead.
+
+    Run from the project directory:
+        python -m benchmark.bench_read_ahead [--files 24] [--latency 0.02] [--bandwidth 100]
+"""
+import argparse
+import tempfile
+import time
+from io import BytesIO
+from pathlib import Path
+from typing import List, Tuple
+
+from benchmark.bench_pipeline import create_image, render_pass
+from benchmark.throttled_fs import ThrottledOpener
+from modules.pyshop import PyShop
+from modules.read_ahead import ReadAhead
+
+# Files read ahead, concurrent requests
+CONFIGS = [(1, 1), (4, 1), (4, 4), (8, 4), (8, 8)]
+
+
+def create_corpus(directory: Path, num_files: int, size: Tuple[int, int]) -> List[Path]:
+    files = list()
+
+    for idx in range(num_files):
+        img_format, suffix = ('PNG', '.png') if idx % 2 else ('JPEG', '.jpg')
+        file = directory / f'pass_{idx:03d}{suffix}'
+        mode = 'RGBA' if img_format == 'PNG' else 'RGB'
+        create_image(render_pass(size, idx), mode, 8).save(file, format=img_format)
+        files.append(file)
+
+    return files
+
+
+def run(files: List[Path], depth: int, requests: int, psd_size: Tuple[int, int]) -> dict:
+    pyshop = PyShop(psd_size)
+    waited, decoded = 0.0, 0.0
+    start = time.perf_counter()
+
+    for file, data, seconds in ReadAhead(files, depth, requests):
+        waited += seconds
+        decode_start = time.perf_counter()
+        fb = BytesIO(data) if data is not None else ReadAhead.opener(file, 'rb')
+        pyshop._load_image_to_numpy_channels(file, fb)
+        decoded += time.perf_counter() - decode_start
+
+    return dict(depth=depth, requests=requests, wall=time.perf_counter() - start, waited=waited, decoded=decoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, default=24)
+    parser.add_argument('--size', type=int, nargs=2, default=(1920, 1080), help='Corpus image size')
+    parser.add_argument('--psd-size', type=int, nargs=2, default=PyShop.default_img_size)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds per open and read request')
+    parser.add_argument('--bandwidth', type=float, default=100, help='Share bandwidth in MB/s')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix='tieflader_bench_') as tmp_dir:
+        files = create_corpus(Path(tmp_dir), args.files, tuple(args.size))
+        total_size = sum(f.stat().st_size for f in files)
+        print(f'{len(files)} files {total_size / 1048576:.1f}MB, latency {args.latency * 1000:.0f}ms, '
+              f'bandwidth {args.bandwidth:.0f}MB/s')
+
+        ReadAhead.opener = ThrottledOpener(args.latency, args.bandwidth * 1048576)
+        try:
+            results = [run(files, depth, requests, tuple(args.psd_size)) for depth, requests in CONFIGS]
+        finally:
+            ReadAhead.opener = open
+
+    print(f'{"depth":>6s}{"requests":>9s}{"wall":>9s}{"waited":>9s}{"decode":>9s}  [s]')
+    for r in results:
+        print(f'{r["depth"]:6d}{r["requests"]:9d}{r["wall"]:9.2f}{r["waited"]:9.2f}{r["decoded"]:9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""
+    Local stand-in for a slow network share. Files opened with ThrottledOpener behave like
+    files on an SMB/NFS mount: every open and every read request waits for the round trip
+    latency and data arrives at a limited bandwidth shared by all concurrent requests.
+
+    Replace the opener of ReadAhead to read local files as if they were on a share:
+        ReadAhead.opener = ThrottledOpener(latency=0.02, bandwidth=100 * 1048576)
+"""
+import io
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Union
+
+
+class ThrottledOpener:
+    def __init__(self, latency: float=0.02, bandwidth: float=100 * 1048576, request_size: int=1048576):
+        """
+        :param latency: Seconds every open and read request waits for the server
+        :param bandwidth: Bytes per second shared by all open files
+        :param request_size: Largest read request, larger reads are split like a network client does
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.request_size = request_size
+
+        self._lock = Lock()
+        # Time the shared link is busy until
+        self._busy_until = 0.0
+
+    def transfer(self, size: int):
+        """ Wait for the round trip and until size bytes went through the shared link """
+        time.sleep(self.latency)
+
+        with self._lock:
+            start = max(time.perf_counter(), self._busy_until)
+            self._busy_until = start + size / self.bandwidth
+            done = self._busy_until
+
+        time.sleep(max(0.0, done - time.perf_counter()))
+
+    def __call__(self, file: Union[Path, str], mode: str='rb') -> 'ThrottledFile':
+        if mode != 'rb':
+            raise ValueError('Throttled files are read only.')
+
+        self.transfer(0)
+        return ThrottledFile(open(file, 'rb'), self)
+
+
+class ThrottledFile(io.RawIOBase):
+    """ Binary read only file throttled by a ThrottledOpener """
+    def __init__(self, f, opener: ThrottledOpener):
+        super(ThrottledFile, self).__init__()
+        self.f = f
+        self.opener = opener
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int=io.SEEK_SET) -> int:
+        return self.f.seek(offset, whence)
+
+    def tell(self) -> int:
+        return self.f.tell()
+
+    def fileno(self) -> int:
+        return self.f.fileno()
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self.opener.request_size)
+        data = self.f.read(size)
+        self.opener.transfer(len(data))
+        b[:len(data)] = data
+        return len(data)
+
+    def read(self, size: int=-1) -> bytes:
+        chunks = list()
+        while size < 0 or size > 0:
+            chunk = bytearray(self.opener.request_size if size < 0 else min(size, self.opener.request_size))
+            n = self.readinto(chunk)
+            if not n:
+                break
+            chunks.append(bytes(chunk[:n]))
+            if size > 0:
+                size -= n
+
+        return b''.join(chunks)
+
+    def close(self):
+        self.f.close()
+        super(ThrottledFile, self).close()
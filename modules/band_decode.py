@@ -0,0 +1,426 @@
+import math
+import struct
+import zlib
+from io import BytesIO
+from typing import BinaryIO, Iterator, List, Tuple, Union
+
+from PIL import Image, PngImagePlugin, TiffImagePlugin, TiffTags
+
+from modules.image_resize import Resize
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+# Bytes of decoded image data per band
+BAND_SIZE = 16 * 1048576
+
+# Pillow modes decoded band by band
+BAND_MODES = ['L', 'LA', 'RGB', 'RGBA', 'P']
+
+# Support of Pillow's resampling filters in source pixels when upscaling
+RESAMPLE_SUPPORT = {Image.NEAREST: 0.5, Image.BOX: 0.5, Image.BILINEAR: 1.0, Image.HAMMING: 1.0,
+                    Image.BICUBIC: 2.0, Image.LANCZOS: 3.0}
+
+
+class BandDecoder:
+    """ Decodes an image file in bands of full width rows, top to bottom.
+
+        Pillow decodes compressed Png and Tiff files in one piece. Every band is
+        re-wrapped as a small file of the same format holding only the compressed
+        data of it's rows, so Pillow decodes one band at a time.
+    """
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], mode: str):
+        self.fp = fp
+        self.size = size
+        self.mode = mode
+
+        # Checked between the bands, see CancelToken
+        self.cancel_token = None
+
+    def check_cancelled(self):
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def band_rows(self, multiple: int=1) -> int:
+        """ Rows per band, a multiple of multiple """
+        row_size = max(1, self.size[0] * Image.getmodebands(self.mode))
+        return max(1, BAND_SIZE // row_size // multiple) * multiple
+
+    def bands(self, rows: int) -> Iterator[Image.Image]:
+        """ Yield bands of about rows rows until the image height is reached """
+        raise NotImplementedError
+
+
+class PngBandDecoder(BandDecoder):
+    """ Non interlaced 8bit Png files. The filtered rows of every band are inflated from the IDAT
+        stream and stored in a Png file of their own, prefixed by the unfiltered last row of the
+        previous band which the filters of the first row refer to.
+    """
+    signature = b'\x89PNG\r\n\x1a\n'
+    channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+    copied_chunks = [b'PLTE', b'tRNS']
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], mode: str, header: bytes, chunks: List[bytes],
+                 color_type: int):
+        super(PngBandDecoder, self).__init__(fp, size, mode)
+        self.header = header
+        self.chunks = chunks
+        self.row_bytes = 1 + size[0] * self.channels[color_type]
+
+    @staticmethod
+    def _chunk(chunk_type: bytes, data: bytes) -> List[bytes]:
+        return [struct.pack('>I', len(data)), chunk_type, data,
+                struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)))]
+
+    @classmethod
+    def open(cls, fp: BinaryIO) -> Union[None, 'PngBandDecoder']:
+        fp.seek(0)
+        if fp.read(8) != cls.signature:
+            return None
+
+        length, chunk_type = struct.unpack('>I4s', fp.read(8))
+        header = fp.read(length)
+        fp.read(4)
+        if chunk_type != b'IHDR':
+            return None
+
+        width, height, bit_depth, color_type, compression, filter_method, interlace = struct.unpack('>IIBBBBB', header)
+        if bit_depth != 8 or interlace or color_type not in cls.channels:
+            return None
+
+        # Chunks up to the first IDAT chunk
+        chunks = list()
+        while True:
+            length, chunk_type = struct.unpack('>I4s', fp.read(8))
+            if chunk_type == b'IDAT':
+                fp.seek(-8, 1)
+                break
+            data = fp.read(length)
+            fp.read(4)
+            if chunk_type in cls.copied_chunks:
+                chunks.extend(cls._chunk(chunk_type, data))
+
+        mode = {0: 'L', 2: 'RGB', 3: 'P', 4: 'LA', 6: 'RGBA'}[color_type]
+        return cls(fp, (width, height), mode, header, chunks, color_type)
+
+    def _idat(self) -> Iterator[bytes]:
+        while True:
+            length, chunk_type = struct.unpack('>I4s', self.fp.read(8))
+            if chunk_type == b'IEND':
+                return
+            data = self.fp.read(length)
+            self.fp.read(4)
+            if chunk_type == b'IDAT':
+                yield data
+
+    def _band_png(self, rows: int, data: bytes) -> bytes:
+        header = struct.pack('>II', self.size[0], rows) + self.header[8:]
+        # Stored without compression, the band is inflated once more by Pillow
+        return b''.join([self.signature, *self._chunk(b'IHDR', header), *self.chunks,
+                         *self._chunk(b'IDAT', zlib.compress(data, 0)), *self._chunk(b'IEND', b'')])
+
+    def bands(self, rows: int) -> Iterator[Image.Image]:
+        inflate = zlib.decompressobj()
+        idat = self._idat()
+        previous_row, y = b'', 0
+
+        while y < self.size[1]:
+            band_rows = min(rows, self.size[1] - y)
+            size = band_rows * self.row_bytes
+
+            # Unfiltered copy of the previous band's last row the first row may refer to
+            data = bytearray(b'\x00' + previous_row if previous_row else b'')
+            context_rows = 1 if previous_row else 0
+            size += len(data)
+
+            while len(data) < size:
+                tail = inflate.unconsumed_tail or next(idat)
+                data.extend(inflate.decompress(tail, size - len(data)))
+
+            band_file = BytesIO(self._band_png(band_rows + context_rows, data))
+            del data
+            band = PngImagePlugin.PngImageFile(band_file)
+            band.load()
+
+            if context_rows:
+                band = band.crop((0, 1, self.size[0], band.size[1]))
+
+            previous_row = band.crop((0, band_rows - 1, self.size[0], band_rows)).tobytes()
+            y += band_rows
+            yield band
+
+
+class TiffBandDecoder(BandDecoder):
+    """ Striped or tiled Tiff files. The strips or tiles of every band are stored in a Tiff file
+        of their own, with the tags needed to decode them, and decoded by libtiff.
+    """
+    # Tags describing the image data
+    copied_tags = [256, 258, 259, 262, 266, 277, 278, 284, 317, 320, 322, 323, 338, 339, 347, 529, 530, 531, 532]
+
+    tiff_formats = {TiffTags.SHORT: 'H', TiffTags.LONG: 'L'}
+    tiff_types = [TiffTags.BYTE, TiffTags.ASCII, TiffTags.SHORT, TiffTags.LONG, TiffTags.RATIONAL,
+                  TiffTags.UNDEFINED]
+
+    def __init__(self, fp: BinaryIO, size: Tuple[int, int], mode: str, tags: TiffImagePlugin.ImageFileDirectory_v2):
+        super(TiffBandDecoder, self).__init__(fp, size, mode)
+        self.tags = tags
+
+        self.tiled = 322 in tags
+        if self.tiled:
+            self.unit_rows = tags[323]
+            self.offsets, self.byte_counts = tags[324], tags[325]
+            self.units_across = math.ceil(size[0] / tags[322])
+        else:
+            self.unit_rows = tags.get(278, size[1])
+            self.offsets, self.byte_counts = tags[273], tags[279]
+            self.units_across = 1
+
+        self.units_down = math.ceil(size[1] / self.unit_rows)
+        self.planes = tags.get(277, 1) if tags.get(284, 1) == 2 else 1
+
+    @classmethod
+    def open(cls, fp: BinaryIO) -> Union[None, 'TiffBandDecoder']:
+        fp.seek(0)
+        if fp.read(4) not in (b'II*\x00', b'MM\x00*'):
+            return None
+
+        fp.seek(0)
+        # Opened without Image.open's decompression bomb check, memory is bounded by the band size
+        img = TiffImagePlugin.TiffImageFile(fp)
+        tags = img.tag_v2
+
+        if not (322 in tags and 324 in tags) and not (273 in tags and 279 in tags):
+            return None
+
+        return cls(fp, img.size, img.mode, tags)
+
+    def band_rows(self, multiple: int=1) -> int:
+        return max(1, super(TiffBandDecoder, self).band_rows(multiple) // self.unit_rows) * self.unit_rows
+
+    def _ifd(self, tags: List[Tuple[int, int, tuple]], offset: int) -> bytes:
+        """ Image file directory of tags [(tag, type, values)] located at offset. Values
+            not fitting into their entry follow the directory.
+        """
+        endian = '<' if self.tags.prefix == b'II' else '>'
+        data_offset = offset + 2 + len(tags) * 12 + 4
+        entries, data = [struct.pack(endian + 'H', len(tags))], list()
+
+        for tag, tag_type, values in sorted(tags):
+            if tag_type == TiffTags.RATIONAL:
+                value = b''.join(struct.pack(endian + 'LL', v.numerator, v.denominator) for v in values)
+            elif tag_type in (TiffTags.BYTE, TiffTags.UNDEFINED, TiffTags.ASCII):
+                value = b''.join(v if isinstance(v, bytes) else v.encode('ascii') + b'\x00' for v in values)
+            else:
+                value = struct.pack(endian + self.tiff_formats[tag_type] * len(values), *values)
+
+            count = len(value) if tag_type in (TiffTags.BYTE, TiffTags.UNDEFINED, TiffTags.ASCII) \
+                else len(values)
+
+            if len(value) <= 4:
+                entries.append(struct.pack(endian + 'HHL', tag, tag_type, count) + value.ljust(4, b'\x00'))
+            else:
+                entries.append(struct.pack(endian + 'HHLL', tag, tag_type, count, data_offset))
+                value += b'\x00' * (len(value) % 2)
+                data.append(value)
+                data_offset += len(value)
+
+        entries.append(struct.pack(endian + 'L', 0))
+        return b''.join(entries + data)
+
+    def _band_tiff(self, first_unit: int, last_unit: int, rows: int) -> bytes:
+        units_per_plane = self.units_down * self.units_across
+        indices = [plane * units_per_plane + idx for plane in range(self.planes)
+                   for idx in range(first_unit * self.units_across, last_unit * self.units_across)]
+
+        data = list()
+        for idx in indices:
+            self.fp.seek(self.offsets[idx])
+            data.append(self.fp.read(self.byte_counts[idx]))
+
+        tags = [(256, TiffTags.LONG, (self.size[0],)), (257, TiffTags.LONG, (rows,))]
+        for tag in self.copied_tags:
+            if tag in self.tags and tag != 256 and self.tags.tagtype[tag] in self.tiff_types:
+                value = self.tags[tag]
+                tags.append((tag, self.tags.tagtype[tag], value if isinstance(value, tuple) else (value,)))
+
+        offsets_tag, counts_tag = (324, 325) if self.tiled else (273, 279)
+        tags.append((counts_tag, TiffTags.LONG, tuple(len(d) for d in data)))
+
+        # Band data follows the header and the directory
+        offsets = [0] * len(data)
+        tags.append((offsets_tag, TiffTags.LONG, tuple(offsets)))
+        offset = 8 + len(self._ifd(tags, 8))
+        for idx, d in enumerate(data):
+            offsets[idx] = offset
+            offset += len(d)
+        tags[-1] = (offsets_tag, TiffTags.LONG, tuple(offsets))
+
+        endian = '<' if self.tags.prefix == b'II' else '>'
+        header = self.tags.prefix + struct.pack(endian + 'HL', 42, 8)
+
+        return b''.join([header, self._ifd(tags, 8), *data])
+
+    def bands(self, rows: int) -> Iterator[Image.Image]:
+        units = max(1, rows // self.unit_rows)
+
+        for first_unit in range(0, self.units_down, units):
+            last_unit = min(first_unit + units, self.units_down)
+            band_rows = min(last_unit * self.unit_rows, self.size[1]) - first_unit * self.unit_rows
+
+            band = Image.open(BytesIO(self._band_tiff(first_unit, last_unit, band_rows)))
+            band.load()
+            yield band
+
+
+def open_band_decoder(fp: BinaryIO, min_pixels: int) -> Union[None, BandDecoder]:
+    """ A BandDecoder if the image file is a supported Png or Tiff file of at least min_pixels pixels """
+    for decoder_cls in (PngBandDecoder, TiffBandDecoder):
+        try:
+            decoder = decoder_cls.open(fp)
+        except Exception as e:
+            LOGGER.debug('Can not decode file in bands: %s', e)
+            decoder = None
+
+        if decoder is not None:
+            if decoder.mode in BAND_MODES and decoder.size[0] * decoder.size[1] >= min_pixels:
+                return decoder
+            break
+
+    fp.seek(0)
+    return None
+
+
+def _stack(top: Image.Image, bottom: Image.Image) -> Image.Image:
+    img = Image.new(top.mode, (top.size[0], top.size[1] + bottom.size[1]))
+    img.paste(top, (0, 0))
+    img.paste(bottom, (0, top.size[1]))
+    return img
+
+
+def _copy_palette(img: Image.Image, band: Image.Image):
+    """ Palette and transparency of a palette band for the image the bands are pasted into """
+    if band.mode == 'P':
+        img.putpalette(band.getpalette())
+        if 'transparency' in band.info:
+            img.info['transparency'] = band.info['transparency']
+
+
+def reduce_bands(decoder: BandDecoder, factor: Tuple[int, int], mode: str) -> Image.Image:
+    """ Image.reduce of the whole image, one band at a time
+
+    :param decoder: Band source
+    :param factor: Horizontal and vertical reduce factor
+    :param mode: Mode the bands are converted to before they are reduced
+    """
+    factor_x, factor_y = factor
+    width, height = decoder.size
+    reduced = Image.new(mode, (math.ceil(width / factor_x), math.ceil(height / factor_y)))
+
+    y, carry = 0, None
+    for band in decoder.bands(decoder.band_rows(factor_y)):
+        decoder.check_cancelled()
+        if band.mode != mode:
+            band = band.convert(mode)
+        if y == 0 and carry is None:
+            _copy_palette(reduced, band)
+        if carry is not None:
+            band = _stack(carry, band)
+
+        # Rows not filling a block of factor_y rows are reduced with the next band
+        last_band = y + band.size[1] >= height
+        rows = band.size[1] if last_band else band.size[1] // factor_y * factor_y
+        carry = None if rows == band.size[1] else band.crop((0, rows, width, band.size[1]))
+
+        if rows:
+            reduced.paste(band.reduce(factor, box=(0, 0, width, rows)), (0, y // factor_y))
+            y += rows
+
+    return reduced
+
+
+def resample_bands(decoder: BandDecoder, size: Tuple[int, int], resample, mode: str) -> Image.Image:
+    """ Image.resize of the whole image. Pillow resamples horizontally and then vertically,
+        the horizontal pass is applied band by band. The vertical pass resamples the output rows
+        as soon as the source rows they depend on are decoded, only those rows are kept.
+
+    :param decoder: Band source
+    :param size: Size to resample to
+    :param resample: Pillow resampling filter
+    :param mode: Mode the bands are converted to before they are resampled
+    """
+    width, height = decoder.size
+    scale = height / size[1]
+    # Source rows around the center of an output row contributing to it, plus a row of slack
+    support = RESAMPLE_SUPPORT.get(resample, 3.0) * max(scale, 1.0) + 1.0
+
+    # Output rows starting at an integer source row are resampled exactly like the whole image,
+    # rows are resampled in multiples of that period if it spans less source rows than a band
+    band_rows = decoder.band_rows()
+    period = size[1] // math.gcd(height, size[1])
+    if period * scale > band_rows:
+        period = 1
+
+    img, strip, strip_top, y = None, None, 0, 0
+
+    for band in decoder.bands(band_rows):
+        decoder.check_cancelled()
+        if band.mode != mode:
+            band = band.convert(mode)
+        if img is None:
+            img = Image.new(mode, size)
+            _copy_palette(img, band)
+
+        band = band.resize((size[0], band.size[1]), resample)
+        strip = band if strip is None else _stack(strip, band)
+        strip_bottom = strip_top + strip.size[1]
+
+        # Output rows whose source rows are all decoded
+        if strip_bottom >= height:
+            rows = size[1]
+        else:
+            rows = min(size[1], math.floor((strip_bottom - support) / scale + 0.5)) // period * period
+        if rows <= y:
+            continue
+
+        box = (0, y * height / size[1] - strip_top, size[0], rows * height / size[1] - strip_top)
+        img.paste(strip.resize((size[0], rows - y), resample, box=box), (0, y))
+        y = rows
+
+        # Drop the rows the remaining output rows do not depend on
+        top = min(max(strip_top, math.floor((y + 0.5) * scale - support)), strip_bottom)
+        strip = strip.crop((0, top - strip_top, size[0], strip.size[1]))
+        strip_top = top
+
+    return img
+
+
+def resize_thumbnail(decoder: BandDecoder, size: Tuple[int, int], resample) -> Image.Image:
+    """ Image.thumbnail of an image decoded in bands. Pillow's thumbnail reduces images by an
+        integer factor before resampling them, the factor is applied band by band. Alpha images are
+        resampled with premultiplied alpha and palette images with the nearest filter without reducing.
+    """
+    width, height = decoder.size
+    contain_size = Resize.contain_size(decoder.size, size)
+
+    if contain_size is None:
+        img = reduce_bands(decoder, (1, 1), decoder.mode)
+    elif decoder.mode == 'P':
+        img = resample_bands(decoder, contain_size, Image.NEAREST, 'P')
+    elif decoder.mode in ('LA', 'RGBA'):
+        premultiplied = {'LA': 'La', 'RGBA': 'RGBa'}[decoder.mode]
+        img = resample_bands(decoder, contain_size, resample, premultiplied).convert(decoder.mode)
+    else:
+        factor = (int(width / contain_size[0] / Resize.reducing_gap) or 1,
+                  int(height / contain_size[1] / Resize.reducing_gap) or 1)
+        LOGGER.info('Decoding %sx%s image in bands, reduced by %sx%s.', width, height, *factor)
+
+        img = reduce_bands(decoder, factor, decoder.mode)
+        decoder.check_cancelled()
+        img = img.resize(contain_size, resample, box=(0, 0, width / factor[0], height / factor[1]))
+
+    return img
+
+
+def resize_contain(decoder: BandDecoder, size: Tuple[int, int], resample, bg_color=(0, 0, 0, 0)) -> Image.Image:
+    """ Resize.resize_contain of an image decoded in bands """
+    return Resize.paste_contained(resize_thumbnail(decoder, size, resample), size, bg_color)
@@ -0,0 +1,85 @@
+from typing import Tuple, Union
+
+import numpy as np
+
+# Bytes of floating point data converted at once
+BLOCK_SIZE = 4 * 1048576
+
+# 16bit to 8bit values rounded to the nearest 8bit value, 65535 / 255 = 257
+UINT16_TO_UINT8 = np.round(np.arange(65536, dtype=np.float64) / 257).astype(np.uint8)
+
+# 8x8 ordered dither thresholds in [0, 1)
+_bayer = np.array([[0, 2], [3, 1]])
+for _ in range(2):
+    _bayer = np.block([[4 * _bayer, 4 * _bayer + 2], [4 * _bayer + 3, 4 * _bayer + 1]])
+BAYER_THRESHOLDS = ((_bayer + 0.5) / 64).astype(np.float32)
+del _bayer
+
+
+def _block_rows(img: np.ndarray) -> int:
+    row_size = max(1, img[:1].size) * 4
+    return max(1, BLOCK_SIZE // row_size)
+
+
+def _thresholds(start: int, shape: Tuple[int, ...], dither: bool) -> Union[float, np.ndarray]:
+    """ Value added before truncating to 8bit: 0.5 rounds, an ordered dither pattern dithers """
+    if not dither:
+        return 0.5
+
+    height, width = shape[:2]
+    rows = BAYER_THRESHOLDS[np.arange(start, start + height) % 8]
+    thresholds = np.tile(rows, (1, width // 8 + 1))[:, :width]
+
+    # Broadcast over color channels
+    return thresholds.reshape((height, width) + (1,) * (len(shape) - 2))
+
+
+def _convert_float_block(block: np.ndarray, out: np.ndarray, start: int, dither: bool):
+    """ Scale values in [0, 1] to [0, 255], in place if the block is writable 32bit float """
+    if block.dtype != np.float32 or not block.flags.writeable:
+        block = block.astype(np.float32)
+
+    # NaN becomes black, +-inf is clipped like any other value out of range
+    block[np.isnan(block)] = 0.0
+    np.clip(block, 0.0, 1.0, out=block)
+    np.multiply(block, 255, out=block)
+    np.add(block, _thresholds(start, block.shape, dither), out=block)
+    np.clip(block, 0, 255, out=block)
+    out[...] = block
+
+
+def _convert_uint16_block(block: np.ndarray, out: np.ndarray, start: int, dither: bool):
+    if not dither:
+        np.take(UINT16_TO_UINT8, block, out=out)
+        return
+
+    scaled = block.astype(np.float32)
+    np.divide(scaled, 257, out=scaled)
+    np.add(scaled, _thresholds(start, block.shape, dither), out=scaled)
+    np.clip(scaled, 0, 255, out=scaled)
+    out[...] = scaled
+
+
+def to_uint8(img: np.ndarray, dither: bool=False) -> np.ndarray:
+    """ Convert a 16bit integer or floating point image to 8bit, one block of rows at a time
+        so no full size temporary is created. Floating point images are expected in [0, 1],
+        clipped and scaled in place.
+
+    :param img: Image array of shape (height, width) or (height, width, channels)
+    :param dither: Apply an ordered dither pattern instead of rounding
+    :returns: 8bit image or the image itself if it is neither 16bit integer nor floating point
+    """
+    if img.dtype == np.uint16:
+        convert = _convert_uint16_block
+    elif img.dtype.kind == 'f':
+        convert = _convert_float_block
+    else:
+        return img
+
+    out = np.empty(img.shape, dtype=np.uint8)
+    rows = _block_rows(img)
+
+    for start in range(0, img.shape[0], rows):
+        convert(img[start:start + rows], out[start:start + rows], start, dither)
+
+    return out
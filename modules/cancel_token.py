@@ -0,0 +1,68 @@
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from threading import Event
+from typing import Union
+
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+
+class Cancelled(Exception):
+    """ Raised at a cancellation point of a cancelled job """
+
+
+class CancelToken:
+    """ Cancellation request of a job, checked at cancellation points inside long running stages
+        eg. between the bands of a band decoded image or the layers of the final compression.
+    """
+    def __init__(self):
+        self.event = Event()
+        # perf_counter time of the first cancel request
+        self.requested: Union[None, float] = None
+
+    def cancel(self):
+        if self.requested is None:
+            self.requested = time.perf_counter()
+        self.event.set()
+
+    @property
+    def is_cancelled(self) -> bool:
+        return self.event.is_set()
+
+    def check(self):
+        """ Cancellation point, raises Cancelled once the job was cancelled """
+        if self.event.is_set():
+            raise Cancelled()
+
+    def latency(self) -> float:
+        """ Seconds since the cancel request """
+        if self.requested is None:
+            return 0.0
+        return time.perf_counter() - self.requested
+
+
+def has_cancelled_work(executor: Union[None, Executor]) -> bool:
+    """ A process pool holding cancelled futures not yet removed from it's queue can not be killed safely """
+    pending_work_items = getattr(executor, '_pending_work_items', None) or dict()
+    return any(work_item.future.cancelled() for work_item in list(pending_work_items.values()))
+
+
+def kill_process_pool(executor: Union[None, Executor]):
+    """ Terminate the worker processes of a process pool instead of waiting for their current tasks.
+        Do not cancel futures of the pool before, Python before 3.12 fails to mark the remaining
+        futures broken if it holds cancelled ones and leaves the pool hanging.
+    """
+    if not isinstance(executor, ProcessPoolExecutor):
+        return
+
+    # ProcessPoolExecutor does not provide a public way to stop running tasks
+    processes = list((getattr(executor, '_processes', None) or dict()).values())
+    for process in processes:
+        try:
+            process.terminate()
+        except Exception as e:
+            LOGGER.debug('Could not terminate pool process: %s', e)
+
+    executor.shutdown(wait=True)
+    LOGGER.info('Terminated %s pool processes.', len(processes))
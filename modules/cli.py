@@ -0,0 +1,205 @@
+"""
+    Headless batch mode creating a layered Psd file without importing Qt.
+
+    Options not provided on the command line are taken from the application settings.
+    With --watch the inputs are folders watched for render passes, a Psd file is created
+    for every group of files matching the same --pattern job key eg. frame number.
+
+    Run from the project directory:
+        python -m modules.cli renders/frame_0001 beauty.png --size 1920 1080 --compression ZIP -o stack.psd
+"""
+import argparse
+import sys
+import time
+from multiprocessing import freeze_support
+from pathlib import Path
+from queue import Queue
+from typing import List
+
+from modules import AppSettings
+from modules.app_globals import APP_NAME
+from modules.log import init_logging, setup_log_queue_listener, setup_logging
+from modules.pyshop import PyShop
+from modules.pyshop_job import PsdJob
+from modules.watch_folder import WatchFolder
+
+LOGGER = init_logging(__name__)
+
+
+def collect_files(inputs: List[str]) -> List[Path]:
+    """ Image files provided directly and all supported image files inside provided folders """
+    files = list()
+
+    for path in (Path(i) for i in inputs):
+        if path.is_dir():
+            files += [f for f in sorted(path.iterdir())
+                      if f.is_file() and f.suffix.casefold() in PyShop.supported_img]
+        elif path.is_file():
+            files.append(path)
+        else:
+            LOGGER.warning('Skipping non-existent input: %s', path.as_posix())
+
+    return files
+
+
+def parse_args(argv: List[str]=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(prog='python -m modules.cli', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('inputs', nargs='+', help='Image files or folders containing image files')
+    parser.add_argument('-o', '--output',
+                        help='Psd file to create or folder to create it in, '
+                             'defaults to a unique name next to the first image')
+    parser.add_argument('--size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        default=AppSettings.app['psd_size'])
+    parser.add_argument('--filter', choices=list(PyShop.resample_filters),
+                        default=AppSettings.app['resampling_filter'])
+    parser.add_argument('--compression', choices=list(PyShop.compression_methods),
+                        default=AppSettings.app['compression'])
+    parser.add_argument('--pool-size', type=int, default=AppSettings.app['process_pool_size'],
+                        help='Number of processes decoding image files')
+    parser.add_argument('--encode-pool-size', type=int, default=AppSettings.app['encode_pool_size'],
+                        help='Number of processes compressing layers')
+    parser.add_argument('--stream', action='store_true', default=AppSettings.app['stream_psd'],
+                        help='Write layers to the Psd file as soon as they are decoded')
+    parser.add_argument('--memory-budget', type=int, default=AppSettings.app['memory_budget_mb'],
+                        metavar='MB', help='Keep decoded layers above this budget in scratch files')
+    parser.add_argument('--scratch-dir', default=AppSettings.app['scratch_dir'])
+    parser.add_argument('--cache-size', type=int, default=AppSettings.app['layer_cache_mb'],
+                        metavar='MB', help='Size of the on disk cache of compressed layers, 0 disables the cache')
+    parser.add_argument('--incremental', action='store_true', default=AppSettings.app['incremental_export'],
+                        help='Copy layers of unchanged files from a previously created Psd file and '
+                             'write a manifest next to the Psd file')
+    parser.add_argument('--place', dest='place_layers', action='store_true',
+                        default=AppSettings.app['layer_placement'],
+                        help='Store images at their resized size centered by the layer bounds instead of '
+                             'padding them to the Psd size')
+    parser.add_argument('--trim', dest='trim_layers', action='store_true',
+                        default=AppSettings.app['trim_layers'],
+                        help='Crop fully transparent borders off layers')
+    parser.add_argument('--no-dedup', dest='dedup_layers', action='store_false',
+                        default=AppSettings.app['dedup_layers'],
+                        help='Decode and compress identical image files for every layer')
+    parser.add_argument('--decode-threads', type=int, default=AppSettings.app['pipeline_decode_threads'],
+                        help='Threads decoding files while others read and compress, 0 disables the pipeline')
+    parser.add_argument('--encode-threads', type=int, default=AppSettings.app['pipeline_encode_threads'],
+                        help='Threads compressing layers inside the pipeline')
+    parser.add_argument('--queue-depths', type=int, nargs=3, metavar=('READ', 'DECODED', 'ENCODED'),
+                        default=AppSettings.app['pipeline_queue_depths'],
+                        help='Files read ahead, decoded and compressed layers waiting inside the pipeline')
+    parser.add_argument('--read-ahead', type=int, default=AppSettings.app['read_ahead_files'], metavar='FILES',
+                        help='Files read into memory ahead of decoding eg. from a network share, 0 disables it')
+    parser.add_argument('--read-requests', type=int, default=AppSettings.app['read_ahead_requests'],
+                        help='Files read ahead concurrently')
+
+    watch = parser.add_argument_group('watch folders')
+    watch.add_argument('--watch', action='store_true', help='Watch the input folders until interrupted')
+    watch.add_argument('--pattern', default=WatchFolder.default_pattern,
+                       help='Regular expression searched in file names, the named group "job" '
+                            'or the whole match groups files into jobs')
+    watch.add_argument('--passes', type=int, default=0,
+                       help='Number of files a job waits for, 0 starts once no file changed')
+    watch.add_argument('--settle', type=float, default=2.0,
+                       help='Seconds file size and modification time have to stay unchanged')
+    watch.add_argument('--jobs', type=int, default=2, help='Number of jobs running concurrently')
+    watch.add_argument('--existing', action='store_true', help='Create jobs for files already present')
+    watch.add_argument('--poll', action='store_true', help='Poll folders instead of file system notifications')
+
+    return parser.parse_args(argv)
+
+
+def create_job(args: argparse.Namespace, files: List[Path]) -> PsdJob:
+    job = PsdJob(
+        files,
+        size=tuple(args.size),
+        resample_filter=PyShop.resample_filters[args.filter],
+        compression=PyShop.compression_methods[args.compression],
+        pool_size=args.pool_size,
+        encode_pool_size=args.encode_pool_size,
+        stream_psd=args.stream,
+        memory_budget=args.memory_budget * 1048576,
+        scratch_dir=args.scratch_dir,
+        layer_cache_size=args.cache_size * 1048576,
+        incremental=args.incremental,
+        place_layers=args.place_layers,
+        trim_layers=args.trim_layers,
+        dedup_layers=args.dedup_layers,
+        decode_threads=args.decode_threads,
+        encode_threads=args.encode_threads,
+        queue_depths=args.queue_depths,
+        read_ahead_files=args.read_ahead,
+        read_requests=args.read_requests,
+        )
+
+    if args.output:
+        output = Path(args.output)
+        if output.suffix.casefold() == '.psd':
+            job.psd_file = output
+        else:
+            job.current_dir = output
+
+    return job
+
+
+def watch(args: argparse.Namespace) -> int:
+    folders = [Path(i) for i in args.inputs if Path(i).is_dir()]
+    if not folders:
+        LOGGER.error('No folders to watch in: %s', ', '.join(args.inputs))
+        return 1
+
+    if args.output and Path(args.output).suffix.casefold() == '.psd':
+        LOGGER.error('Watch folder jobs need an output folder instead of a Psd file.')
+        return 1
+
+    watcher = WatchFolder(
+        folders, lambda files: create_job(args, files), pattern=args.pattern, passes=args.passes,
+        settle_time=args.settle, max_jobs=args.jobs, process_existing=args.existing,
+        use_notifications=not args.poll
+        )
+
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def main(argv: List[str]=None) -> int:
+    args = parse_args(argv)
+
+    logging_queue = Queue(-1)
+    setup_logging(logging_queue)
+    logger = init_logging(APP_NAME)
+    log_listener = setup_log_queue_listener(logger, logging_queue)
+    log_listener.start()
+
+    if args.watch:
+        try:
+            return watch(args)
+        finally:
+            log_listener.stop()
+
+    start = time.perf_counter()
+    job = create_job(args, collect_files(args.inputs))
+
+    try:
+        if not job.files:
+            logger.error('No image files found in: %s', ', '.join(args.inputs))
+            return 1
+
+        psd_file = job.run()
+    finally:
+        log_listener.stop()
+
+    if psd_file is None or not psd_file.exists():
+        print('Could not create Psd file.', file=sys.stderr)
+        return 1
+
+    print(f'Created {psd_file.as_posix()} from {len(job.files)} files in {time.perf_counter() - start:.2f}s')
+    return 0
+
+
+if __name__ == '__main__':
+    # Required for process pools inside frozen PyInstaller executables
+    freeze_support()
+    sys.exit(main())
@@ -9,7 +9,8 @@ from modules import AppSettings
 from modules.detect_language import get_translation
 from modules.log import init_logging
 from modules.pyshop import PyShop
-from modules.run_pyshop import CreateLayeredPsdThread
+from modules.job_scheduler import ScheduledJob
+from modules.run_pyshop import PsdJobQueue
 
 LOGGER = init_logging(__name__)
 
@@ -23,6 +24,17 @@ class FileDrop(QObject):
     cancel_thread = Signal()
     current_psd_file = Path('.')
 
+    stage_names = {
+        'read': _('Lesen'),
+        'decode': _('Dekodieren'),
+        'resize': _('Skalieren'),
+        'split': _('Kanäle'),
+        'trim': _('Zuschneiden'),
+        'dedup': _('Duplikate'),
+        'compress': _('Komprimieren'),
+        'write': _('Schreiben'),
+        }
+
     def __init__(self, ui):
         """ Initializes file drag&drop events on to the Main Window and handles the py shop layering threads.
 
@@ -31,6 +43,14 @@ class FileDrop(QObject):
         super(FileDrop, self).__init__(parent=ui)
         self.ui = ui
 
+        # --- Jobs of all drops, queued while other jobs run ---
+        self.job_queue = PsdJobQueue(self)
+        self.job_queue.signals.job_updated.connect(self.job_updated)
+        self.job_queue.signals.file_created.connect(self.thread_file_created)
+        self.job_queue.signals.timings.connect(self.thread_timings)
+        self.cancel_thread.connect(self.job_queue.cancel_all)
+        self.ui.job_queue_widget.cancel_job.connect(self.job_queue.cancel_job)
+
         self.ui.cancelBtn.released.connect(self.cancel_thread)
 
         # --- Install file drop on main window ---
@@ -46,24 +66,46 @@ class FileDrop(QObject):
         # Hide cancel btn
         self.ui.cancelBtn.hide()
         self.ui.lastFileWidget.hide()
+        self.ui.timing_label.hide()
 
-        self.py_shop_thread = CreateLayeredPsdThread(self, list())
+    def job_updated(self, scheduled: ScheduledJob):
+        """ Update the job list and show the progress of all queued jobs """
+        self.ui.job_queue_widget.update_job(scheduled)
+        active = self.job_queue.scheduler.active_jobs()
+
+        if not active:
+            self.ui.progress_widget.progress.hide()
+            self.ui.cancelBtn.setEnabled(False)
+            self.ui.cancelBtn.hide()
+            return
 
-    def thread_started(self):
-        self.ui.progress_widget.progress.setValue(0)
+        self.ui.progress_widget.progress.setMaximum(sum(j.total for j in active))
+        self.ui.progress_widget.progress.setValue(sum(min(j.progress, j.total) for j in active))
         self.ui.progress_widget.progress.show()
         self.ui.cancelBtn.setEnabled(True)
         self.ui.cancelBtn.show()
 
-    def thread_progress(self):
-        progress = self.ui.progress_widget.progress.value()
-        progress += 1
-        self.ui.progress_widget.progress.setValue(progress)
+    def thread_timings(self, timings: dict):
+        """ Show the time spent per pipeline stage of the last job below the last file button """
+        job = timings.get('job')
+        if not job:
+            return
 
-    def thread_finished(self):
-        self.ui.progress_widget.progress.hide()
-        self.ui.cancelBtn.setEnabled(False)
-        self.ui.cancelBtn.hide()
+        text = _('{:.2f}s gesamt').format(job['wall_time']) + ' - ' + self._format_stages(job['stages'])
+        if 'trimmed_percent' in job:
+            text += ' - ' + _('{:.0f}% Pixel zugeschnitten').format(job['trimmed_percent'])
+        self.ui.timing_label.setText(text)
+
+        # Slowest files as tooltip
+        files = sorted(timings['files'], key=lambda r: r['total'], reverse=True)[:10]
+        self.ui.timing_label.setToolTip('\n'.join(
+            f'{r["name"]}: {self._format_stages(r["stages"])}' for r in files
+            ))
+        self.ui.timing_label.show()
+
+    def _format_stages(self, stages: dict) -> str:
+        return ', '.join(f'{name} {stages[stage]:.2f}s'
+                         for stage, name in self.stage_names.items() if stage in stages)
 
     def thread_file_created(self, psd_file: Path):
         self.current_psd_file = psd_file
@@ -152,17 +194,5 @@ class FileDrop(QObject):
         return True
 
     def run_py_shop(self, files: List[Path]):
-        if self.py_shop_thread.is_alive():
-            return
-
-        self.ui.progress_widget.progress.setMaximum(len(files))
-
-        self.py_shop_thread = CreateLayeredPsdThread(self, files)
-
-        self.py_shop_thread.signals.started.connect(self.thread_started)
-        self.py_shop_thread.signals.progress_step.connect(self.thread_progress)
-        self.py_shop_thread.signals.finished.connect(self.thread_finished)
-        self.py_shop_thread.signals.file_created.connect(self.thread_file_created)
-        self.cancel_thread.connect(self.py_shop_thread.abort_creation)
-
-        self.py_shop_thread.start()
+        """ Queue a job for the files, it starts once fewer than the concurrent jobs setting are running """
+        self.job_queue.add_files(files)
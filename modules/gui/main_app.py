@@ -140,5 +140,7 @@ class MainApp(QtWidgets.QApplication):
         GenericMsgBox.warning(self.ui, _("Schwerwiegender Fehler"), msg)
 
     def about_to_quit(self):
+        self.ui.drop.job_queue.shutdown()
+
         g = self.ui.geometry()
         AppSettings.app['window'] = (g.x(), g.y(), g.width(), g.height())
@@ -11,6 +11,7 @@ from modules.gui.gui_utils import SetupWidget, replace_widget
 from modules.gui.icon_resource import IconRsc
 from modules.gui.main_menu import MainWindowMenu
 from modules.log import init_logging
+from modules.widgets.job_queue import JobQueueWidget
 from modules.widgets.progress_overlay import ProgressOverlay
 from modules.widgets.settings_dialog import ResolutionLineEdit
 
@@ -41,6 +42,17 @@ class MainWindow(QMainWindow):
         # ---- Setup overlay progress widget ----
         self.progress_widget = ProgressOverlay(self.topWidget)
 
+        # ---- Setup pipeline stage timing of the last job ----
+        self.timing_label = QLabel(self.centralwidget)
+        self.timing_label.setWordWrap(True)
+        self.timing_label.setAlignment(Qt.AlignHCenter)
+        layout = self.centralwidget.layout()
+        layout.insertWidget(layout.indexOf(self.lastFileWidget) + 1, self.timing_label)
+
+        # ---- Setup list of pending and running jobs ----
+        self.job_queue_widget = JobQueueWidget(self.centralwidget)
+        layout.insertWidget(layout.indexOf(self.timing_label) + 1, self.job_queue_widget)
+
         # --- Setup main window resolution box ---
         # Setup expand area
         self.res_btn: QPushButton
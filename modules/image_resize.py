@@ -24,6 +24,8 @@ LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
+import math
+
 import numpy as np
 from PIL import Image
 
@@ -91,14 +93,59 @@ class Resize:
         size:       a list of two integers [width, height]
         """
         image.thumbnail((size[0], size[1]), resample)
+        return Resize.paste_contained(image, size, bg_color)
+
+    @staticmethod
+    def paste_contained(image, size, bg_color=(255, 255, 255, 0)):
+        """
+        Paste an image centered onto a RGBA background of size.
+        image:      a Pillow image instance no larger than size
+        size:       a list of two integers [width, height]
+        """
         background = Image.new('RGBA', (size[0], size[1]), bg_color)
-        img_position = (
-            int(np.math.ceil((size[0] - image.size[0]) / 2)),
-            int(np.math.ceil((size[1] - image.size[1]) / 2))
-        )
-        background.paste(image, img_position)
+        background.paste(image, Resize.contain_position(image.size, size))
         return background
 
+    @staticmethod
+    def contain_position(image_size, size):
+        """
+        Position of an image of image_size centered inside size.
+        image_size: a list of two integers [width, height]
+        size:       a list of two integers [width, height]
+        """
+        return (
+            math.ceil((size[0] - image_size[0]) / 2),
+            math.ceil((size[1] - image_size[1]) / 2)
+        )
+
+    # Pillow's thumbnail reduces by an integer factor until the image is less than
+    # reducing_gap times the thumbnail size and resamples the rest
+    reducing_gap = 2.0
+
+    @staticmethod
+    def contain_size(image_size, size):
+        """
+        Size Pillow's thumbnail resizes an image of image_size to.
+        image_size: a list of two integers [width, height]
+        size:       a list of two integers [width, height]
+        Returns None if the image is not larger than size.
+        """
+        width, height = image_size
+        x, y = size
+        if x >= width and y >= height:
+            return None
+
+        def round_aspect(number, key):
+            return max(min(math.floor(number), math.ceil(number), key=key), 1)
+
+        aspect = width / height
+        if x / y >= aspect:
+            x = round_aspect(y * aspect, key=lambda n: abs(aspect - n / y))
+        else:
+            y = round_aspect(x / aspect, key=lambda n: 0 if n == 0 else abs(aspect - x / n))
+
+        return x, y
+
     @staticmethod
     def resize_width(image, size, resample=Image.LANCZOS):
         """
@@ -0,0 +1,216 @@
+import itertools
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, List, Union
+
+from modules.cancel_token import has_cancelled_work, kill_process_pool
+from modules.layer_pool import LayerDecodePool
+from modules.log import init_logging
+from modules.pyshop_job import PsdJob
+
+LOGGER = init_logging(__name__)
+
+
+class ScheduledJob:
+    """ State and progress of a PsdJob inside the JobScheduler """
+    pending = 'pending'
+    running = 'running'
+    finished = 'finished'
+    failed = 'failed'
+    cancelled = 'cancelled'
+
+    def __init__(self, job_id: int, job: PsdJob):
+        self.id = job_id
+        self.job = job
+        self.state = self.pending
+
+        # Files added as layer and number of files
+        self.progress = 0
+        self.total = len(job.files)
+
+        self.psd_file: Union[None, Path] = None
+        self.error = ''
+        self.future: Union[None, Future] = None
+
+    @property
+    def name(self) -> str:
+        if self.psd_file is not None:
+            return self.psd_file.name
+        if self.job.psd_file:
+            return Path(self.job.psd_file).name
+        return self.job.current_dir.name or self.job.current_dir.as_posix()
+
+    @property
+    def is_active(self) -> bool:
+        return self.state in (self.pending, self.running)
+
+
+class JobScheduler:
+    """ Runs PsdJobs in the order they were submitted, a number of them concurrently.
+        Jobs submitted while others run wait in the queue instead of being dropped.
+
+        Jobs decoding or compressing in processes share one process pool, so concurrent jobs
+        do not each start their own processes. Cancelling the only job using the shared pool
+        terminates it's processes, the next job starts a new pool. The listener is called from
+        the job threads whenever the state or progress of a job changed.
+    """
+    def __init__(self, max_jobs: int=1, pool_size: int=0,
+                 listener: Union[None, Callable[[ScheduledJob], None]]=None):
+        """
+        :param max_jobs: Number of jobs running concurrently
+        :param pool_size: Number of processes shared by all jobs, 0 or 1 lets every job use it's own pools
+        :param listener: Called with the ScheduledJob whenever it's state or progress changed
+        """
+        self.max_jobs = max(1, max_jobs)
+        self.pool_size = pool_size
+        self.listener = listener
+
+        self.executor = ThreadPoolExecutor(max_workers=self.max_jobs, thread_name_prefix='PsdJob')
+        self.process_pool: Union[None, ProcessPoolExecutor] = None
+        # Shared pools of cancelled jobs finishing their current files
+        self.retired_pools: List[ProcessPoolExecutor] = list()
+
+        self.jobs: Dict[int, ScheduledJob] = dict()
+        self.lock = Lock()
+        self._ids = itertools.count(1)
+
+    def _shared_process_pool(self) -> Union[None, ProcessPoolExecutor]:
+        """ Process pool shared by all jobs, call with the lock held """
+        if self.pool_size < 2 or not LayerDecodePool.available():
+            return None
+
+        if self.process_pool is None:
+            LOGGER.info('Starting a process pool of %s processes shared by all jobs.', self.pool_size)
+            # Forking while other job threads hold locks eg. of the shared memory resource tracker
+            # would leave them locked inside the processes, spawn them like on Windows instead.
+            self.process_pool = ProcessPoolExecutor(max_workers=self.pool_size,
+                                                    mp_context=multiprocessing.get_context('spawn'))
+
+        return self.process_pool
+
+    def _kill_shared_process_pool(self, scheduled: ScheduledJob):
+        """ Terminate the shared process pool still running files of a cancelled job unless other jobs use it """
+        with self.lock:
+            pool = self.process_pool
+            if pool is None or scheduled.job.process_pool is not pool:
+                return
+
+            for other in self.jobs.values():
+                if other is not scheduled and other.state == ScheduledJob.running and other.job.process_pool is pool:
+                    return
+
+            self.process_pool = None
+
+        if has_cancelled_work(pool):
+            # The files queued by the job got cancelled, let the processes finish their current file
+            LOGGER.info('Replacing the shared process pool of cancelled job %s.', scheduled.id)
+            pool.shutdown(wait=False)
+            with self.lock:
+                self.retired_pools.append(pool)
+            return
+
+        LOGGER.info('Terminating the shared process pool of cancelled job %s.', scheduled.id)
+        kill_process_pool(pool)
+
+    def submit(self, job: PsdJob) -> ScheduledJob:
+        """ Queue a job, it starts once less than max_jobs jobs are running """
+        scheduled = ScheduledJob(next(self._ids), job)
+
+        with self.lock:
+            self.jobs[scheduled.id] = scheduled
+
+        LOGGER.info('Queued job %s with %s files, %s jobs active.', scheduled.id, scheduled.total,
+                    len(self.active_jobs()))
+        self._notify(scheduled)
+        scheduled.future = self.executor.submit(self._run, scheduled)
+
+        return scheduled
+
+    def active_jobs(self) -> List[ScheduledJob]:
+        """ Pending and running jobs in the order they were submitted """
+        with self.lock:
+            return [j for j in self.jobs.values() if j.is_active]
+
+    def _notify(self, scheduled: ScheduledJob):
+        if self.listener is None:
+            return
+
+        try:
+            self.listener(scheduled)
+        except Exception as e:
+            LOGGER.error('Job listener failed: %s', e)
+
+    def _progress_step(self, scheduled: ScheduledJob):
+        scheduled.progress += 1
+        self._notify(scheduled)
+
+    def _run(self, scheduled: ScheduledJob) -> Union[None, Path]:
+        if scheduled.state == ScheduledJob.cancelled:
+            return None
+
+        job = scheduled.job
+        with self.lock:
+            if max(job.pool_size, job.encode_pool_size) > 1:
+                job.process_pool = self._shared_process_pool()
+            scheduled.state = ScheduledJob.running
+        self._notify(scheduled)
+
+        try:
+            scheduled.psd_file = job.run(lambda: self._progress_step(scheduled))
+        except Exception as e:
+            if job.abort:
+                scheduled.state, scheduled.psd_file = ScheduledJob.cancelled, None
+            else:
+                LOGGER.error('Job %s failed: %s', scheduled.id, e)
+                scheduled.state, scheduled.error = ScheduledJob.failed, str(e)
+        else:
+            scheduled.state = ScheduledJob.finished if scheduled.psd_file else ScheduledJob.cancelled
+
+        if scheduled.state == ScheduledJob.cancelled and job.abort:
+            self._kill_shared_process_pool(scheduled)
+
+        self._finish(scheduled)
+        return scheduled.psd_file
+
+    def _finish(self, scheduled: ScheduledJob):
+        with self.lock:
+            self.jobs.pop(scheduled.id, None)
+        self._notify(scheduled)
+
+    def cancel(self, job_id: int):
+        """ Remove a pending job from the queue or abort a running job """
+        with self.lock:
+            scheduled = self.jobs.get(job_id)
+        if scheduled is None:
+            return
+
+        scheduled.job.abort = True
+
+        if scheduled.state == ScheduledJob.pending and scheduled.future is not None and scheduled.future.cancel():
+            scheduled.state = ScheduledJob.cancelled
+            LOGGER.info('Removed job %s from the queue.', scheduled.id)
+            self._finish(scheduled)
+
+    def cancel_all(self):
+        for scheduled in self.active_jobs():
+            self.cancel(scheduled.id)
+
+    def shutdown(self, cancel: bool=True):
+        """ Wait for all jobs and stop the shared process pool
+
+        :param cancel: Cancel pending and running jobs first
+        """
+        if cancel:
+            self.cancel_all()
+
+        self.executor.shutdown(wait=True)
+
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=True)
+            self.process_pool = None
+
+        for pool in self.retired_pools:
+            pool.shutdown(wait=True)
+        self.retired_pools = list()
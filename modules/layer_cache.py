@@ -0,0 +1,313 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from pathlib import Path
+from threading import Lock
+from typing import Dict, Tuple, Union
+
+from pytoshop import enums, layers
+
+from modules.app_globals import get_settings_dir
+from modules.log import init_logging
+from modules.psd_encode import encoded_channel
+
+LOGGER = init_logging(__name__)
+
+
+class CachedLayer:
+    """ Compressed channel data and bounds of a layer as written to the Psd file """
+    magic = b'TLCL'
+
+    def __init__(self, compression: int, bounds: Tuple[int, int, int, int], channels: Dict[int, bytes],
+                 depth: int=enums.ColorDepth.depth8, version: int=enums.Version.psd):
+        """
+        :param compression: Compression of all channels
+        :param bounds: top, left, bottom, right of the layer
+        :param channels: Compressed data by channel id, without the compression value
+        """
+        self.compression = compression
+        self.bounds = tuple(bounds)
+        self.channels = channels
+        self.depth = depth
+        self.version = version
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        top, left, bottom, right = self.bounds
+        return bottom - top, right - left
+
+    @property
+    def size(self) -> int:
+        return sum(len(data) for data in self.channels.values())
+
+    def channel_data(self) -> Dict[int, layers.ChannelImageData]:
+        """ Channel image data pytoshop and the PsdStreamWriter write without compressing again """
+        return {channel_id: encoded_channel(data, self.shape, self.compression, self.depth, self.version)
+                for channel_id, data in self.channels.items()}
+
+    def to_bytes(self) -> bytes:
+        header = json.dumps(dict(
+            compression=int(self.compression), bounds=self.bounds, depth=int(self.depth),
+            version=int(self.version), channels=[(int(c), len(d)) for c, d in self.channels.items()]
+            )).encode('utf-8')
+
+        return b''.join([self.magic, struct.pack('>I', len(header)), header, *self.channels.values()])
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'CachedLayer':
+        if data[:4] != cls.magic:
+            raise ValueError('Not a cached layer.')
+
+        header_size = struct.unpack('>I', data[4:8])[0]
+        header = json.loads(data[8:8 + header_size].decode('utf-8'))
+
+        channels, offset = dict(), 8 + header_size
+        for channel_id, size in header['channels']:
+            channels[channel_id] = data[offset:offset + size]
+            offset += size
+
+        if offset != len(data):
+            raise ValueError('Cached layer is truncated.')
+
+        return cls(header['compression'], header['bounds'], channels, header['depth'], header['version'])
+
+
+class LayerCache:
+    """ On disk cache of compressed layers inside the settings directory.
+
+        Layers are keyed by image file path, size, modification time and content hash plus the
+        Psd settings changing the layer content. Least recently used layers are removed once
+        the cache exceeds it's size. One instance per cache directory is shared by all jobs
+        of this process, see LayerCache.open.
+    """
+    dir_name = 'layer_cache'
+    index_name = 'index.json'
+    suffix = '.layer'
+
+    # Change whenever the layer content for the same key changes
+    format_version = 1
+
+    # Remembered content hashes of unchanged image files
+    max_hashes = 8192
+
+    _instances: Dict[str, 'LayerCache'] = dict()
+    _instances_lock = Lock()
+
+    def __init__(self, max_size: int, cache_dir: Union[Path, str]):
+        """
+        :param max_size: Bytes of compressed layer data kept in the cache
+        :param cache_dir: Directory of the cache files
+        """
+        self.max_size = max_size
+        self.cache_dir = Path(cache_dir)
+        self.lock = Lock()
+
+        # key: [bytes, last used time]
+        self.entries: Dict[str, list] = dict()
+        # path|size|mtime: content hash
+        self.hashes: Dict[str, str] = dict()
+
+        self.hits, self.misses = 0, 0
+
+        self._load_index()
+
+    @classmethod
+    def open(cls, max_size: int, cache_dir: Union[None, Path, str]=None) -> Union[None, 'LayerCache']:
+        """ The shared cache of a directory, the layer_cache directory inside the settings directory by default
+
+        :param max_size: Bytes of compressed layer data kept in the cache
+        :param cache_dir: Directory of the cache files
+        :returns: LayerCache or None if the directory can not be created
+        """
+        if cache_dir is None:
+            settings_dir = get_settings_dir()
+            if not settings_dir:
+                return None
+            cache_dir = Path(settings_dir) / cls.dir_name
+
+        cache_dir = Path(cache_dir)
+        try:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            LOGGER.error('Could not create layer cache directory %s: %s', cache_dir.as_posix(), e)
+            return None
+
+        with cls._instances_lock:
+            cache = cls._instances.get(cache_dir.as_posix())
+            if cache is None:
+                cache = cls(max_size, cache_dir)
+                cls._instances[cache_dir.as_posix()] = cache
+
+        cache.max_size = max_size
+        return cache
+
+    def _entry_file(self, key: str) -> Path:
+        return self.cache_dir / f'{key}{self.suffix}'
+
+    def _load_index(self):
+        index_file = self.cache_dir / self.index_name
+
+        try:
+            with open(index_file, 'r') as f:
+                index = json.load(f)
+            if index.get('format_version') != self.format_version:
+                raise ValueError('Layer cache format changed.')
+            self.entries = index['entries']
+            self.hashes = index['hashes']
+            return
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            LOGGER.warning('Could not read layer cache index, rebuilding it: %s', e)
+
+        # Pick up entries without an index, eg. after a crash
+        self.entries, self.hashes = dict(), dict()
+        for entry_file in self.cache_dir.glob(f'*{self.suffix}'):
+            stat = entry_file.stat()
+            self.entries[entry_file.stem] = [stat.st_size, stat.st_mtime]
+
+    @property
+    def total_size(self) -> int:
+        return sum(size for size, last_used in self.entries.values())
+
+    def content_hash(self, image_file: Path, stat: os.stat_result) -> str:
+        """ Hash of the file content, re-used as long as the size and modification time do not change """
+        memo_key = f'{image_file.as_posix()}|{stat.st_size}|{stat.st_mtime_ns}'
+
+        with self.lock:
+            content_hash = self.hashes.get(memo_key)
+        if content_hash:
+            return content_hash
+
+        h = hashlib.blake2b(digest_size=20)
+        with open(image_file, 'rb') as f:
+            for chunk in iter(lambda: f.read(1048576), b''):
+                h.update(chunk)
+        content_hash = h.hexdigest()
+
+        with self.lock:
+            self.hashes[memo_key] = content_hash
+            while len(self.hashes) > self.max_hashes:
+                del self.hashes[next(iter(self.hashes))]
+
+        return content_hash
+
+    def key(self, image_file: Union[Path, str], *settings) -> Union[None, str]:
+        """ Cache key of an image file
+
+        :param image_file: Image file the layer gets created from
+        :param settings: Everything else changing the layer eg. Psd size, resample filter and compression
+        :returns: Key or None if the file can not be read
+        """
+        image_file = Path(image_file).resolve()
+
+        try:
+            stat = image_file.stat()
+            content_hash = self.content_hash(image_file, stat)
+        except OSError as e:
+            LOGGER.warning('Could not create layer cache key for %s: %s', image_file.name, e)
+            return None
+
+        key_data = [self.format_version, image_file.as_posix(), stat.st_size, stat.st_mtime_ns, content_hash,
+                    [s if isinstance(s, (int, float, str, bool, type(None))) else list(s) for s in settings]]
+
+        return hashlib.sha1(json.dumps(key_data).encode('utf-8')).hexdigest()
+
+    def get(self, key: Union[None, str]) -> Union[None, CachedLayer]:
+        if key is None:
+            return None
+
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+
+        try:
+            layer = CachedLayer.from_bytes(self._entry_file(key).read_bytes())
+        except FileNotFoundError:
+            # Removed by another job of this cache
+            with self.lock:
+                self.misses += 1
+                self.entries.pop(key, None)
+            return None
+        except Exception as e:
+            LOGGER.warning('Removing unreadable layer cache entry %s: %s', key, e)
+            with self.lock:
+                self.misses += 1
+                self._remove(key)
+            return None
+
+        with self.lock:
+            self.hits += 1
+            if key in self.entries:
+                self.entries[key][1] = time.time()
+
+        return layer
+
+    def put(self, key: Union[None, str], layer: CachedLayer):
+        """ Store a layer and remove least recently used layers exceeding the cache size """
+        if key is None:
+            return
+
+        data = layer.to_bytes()
+        if len(data) > self.max_size:
+            return
+
+        entry_file = self._entry_file(key)
+        tmp_file = entry_file.with_suffix(f'.{os.getpid()}.tmp')
+
+        try:
+            tmp_file.write_bytes(data)
+            os.replace(tmp_file, entry_file)
+        except OSError as e:
+            LOGGER.error('Could not write layer cache entry: %s', e)
+            return
+
+        with self.lock:
+            self.entries[key] = [len(data), time.time()]
+            self._evict()
+
+    def _evict(self):
+        total = self.total_size
+        if total <= self.max_size:
+            return
+
+        for key in sorted(self.entries, key=lambda k: self.entries[k][1]):
+            total -= self.entries[key][0]
+            self._remove(key)
+            if total <= self.max_size:
+                break
+
+    def _remove(self, key: str):
+        self.entries.pop(key, None)
+        try:
+            self._entry_file(key).unlink()
+        except OSError:
+            pass
+
+    def save(self):
+        """ Write the index, call once a job finished """
+        index_file = self.cache_dir / self.index_name
+        tmp_file = index_file.with_suffix(f'.{os.getpid()}.tmp')
+
+        with self.lock:
+            self._evict()
+            index = dict(format_version=self.format_version, entries=self.entries, hashes=self.hashes)
+
+            try:
+                with open(tmp_file, 'w') as f:
+                    json.dump(index, f)
+                os.replace(tmp_file, index_file)
+            except OSError as e:
+                LOGGER.error('Could not write layer cache index: %s', e)
+
+            LOGGER.info('Layer cache %s hits, %s misses, %.1fMB of %.1fMB used.',
+                        self.hits, self.misses, self.total_size / 1048576, self.max_size / 1048576)
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries):
+                self._remove(key)
+            self.hashes = dict()
@@ -0,0 +1,333 @@
+import queue
+import time
+from io import BytesIO
+from pathlib import Path
+from threading import Event, Lock, Semaphore, Thread
+from typing import Dict, Iterator, List, Sequence, Union
+
+import numpy as np
+from pytoshop.enums import ColorDepth, Version
+
+from modules.cancel_token import CancelToken
+from modules.layer_cache import CachedLayer
+from modules.log import init_logging
+from modules.psd_encode import encode_layer_channels
+from modules.pyshop import PyShop
+from modules.read_ahead import ReadAhead
+from modules.stage_times import PipelineTimer
+
+LOGGER = init_logging(__name__)
+
+
+class PipelineItem:
+    """ A file travelling through the pipeline stages """
+    def __init__(self, index: int, file: Path):
+        self.index = index
+        self.file = file
+
+        # Read ahead file content, None lets the decode thread open the file
+        self.data: Union[None, bytes] = None
+        # Decoded channel planes, kept for layers added without compressing them upfront
+        self.img_channels: Union[None, List[np.ndarray]] = None
+        # Compressed layer, None for kept channels and duplicates of digest
+        self.encoded: Union[None, CachedLayer] = None
+        self.digest: Union[None, bytes] = None
+
+        self.stage_seconds: Dict[str, float] = dict()
+        self.error: Union[None, Exception] = None
+
+    def add_seconds(self, seconds: Dict[str, float]):
+        for stage, value in seconds.items():
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + value
+
+
+class StageQueue(queue.Queue):
+    """ Bounded queue between two pipeline stages. Records how full it was and how long
+        producers were blocked by a full queue and consumers waited on an empty queue.
+    """
+    poll_seconds = 0.1
+
+    def __init__(self, name: str, depth: int):
+        super(StageQueue, self).__init__(max(1, depth))
+        self.name = name
+
+        self.stats_lock = Lock()
+        self.put_wait, self.get_wait = 0.0, 0.0
+        self.max_fill, self.fill_sum, self.puts = 0, 0, 0
+
+    def put_item(self, item, stop: Event) -> bool:
+        """ Put an item, waiting for a free slot until stop is set
+
+        :returns: False if stopped
+        """
+        start = time.perf_counter()
+
+        while not stop.is_set():
+            try:
+                self.put(item, timeout=self.poll_seconds)
+            except queue.Full:
+                continue
+
+            fill = self.qsize()
+            with self.stats_lock:
+                self.put_wait += time.perf_counter() - start
+                self.max_fill = max(self.max_fill, fill)
+                self.fill_sum += fill
+                self.puts += 1
+            return True
+
+        return False
+
+    def get_item(self, stop: Event, cancel_token: Union[None, CancelToken]=None):
+        """ Get the next item, waiting until stop is set
+
+        :param stop: Stops waiting
+        :param cancel_token: Checked while waiting, raises Cancelled once cancelled
+        :returns: The item or None if stopped
+        """
+        start = time.perf_counter()
+
+        while not stop.is_set():
+            if cancel_token is not None:
+                cancel_token.check()
+            try:
+                item = self.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                continue
+
+            with self.stats_lock:
+                self.get_wait += time.perf_counter() - start
+            return item
+
+        return None
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return dict(depth=self.maxsize, max_fill=self.max_fill, mean_fill=self.fill_sum / max(1, self.puts),
+                        put_wait=self.put_wait, get_wait=self.get_wait)
+
+
+class LayerPipeline:
+    """ Reads, decodes and compresses image files in stages connected by bounded queues.
+
+        A reader thread reads the next files into memory with a ReadAhead, decode threads decode,
+        resize and split them and encode threads position, trim and compress the layers. Pillow, zlib and
+        most NumPy operations release the GIL, so disk access, decoding and compressing overlap.
+        The queue depths bound how many files are held in memory between the stages, results
+        are returned in the order the files were provided.
+    """
+    queue_names = ('read', 'decoded', 'encoded')
+    default_queue_depths = (4, 2, 2)
+
+    def __init__(self, pyshop: PyShop, decode_threads: int, encode_threads: int,
+                 queue_depths: Sequence[int]=default_queue_depths, read_ahead_files: int=1, read_requests: int=1):
+        """
+        :param pyshop: PyShop the layers get added to, provides the layer settings
+        :param decode_threads: Number of threads decoding image files
+        :param encode_threads: Number of threads compressing layers
+        :param queue_depths: Items waiting to be decoded, to be compressed and to be added
+        :param read_ahead_files: Files read by the reader thread before they are put into the read queue
+        :param read_requests: Files read concurrently by the reader thread
+        """
+        self.pyshop = pyshop
+        self.read_ahead_files = max(1, read_ahead_files)
+        self.read_requests = max(1, read_requests)
+        self.decode_threads = max(1, decode_threads)
+        self.encode_threads = max(1, encode_threads)
+
+        depths = list(queue_depths or self.default_queue_depths)
+        depths += self.default_queue_depths[len(depths):]
+        self.queues = [StageQueue(name, depth) for name, depth in zip(self.queue_names, depths)]
+        self.read_queue, self.decoded_queue, self.encoded_queue = self.queues
+
+        # Files on their way through the pipeline, including results waiting to be returned in order
+        self.in_flight = sum(q.maxsize for q in self.queues) + self.decode_threads + self.encode_threads
+        self._slots = Semaphore(self.in_flight)
+
+        self.stop = Event()
+        self.threads: List[Thread] = list()
+        self.workers: List[PyShop] = list()
+
+        self._lock = Lock()
+        self._running = dict(decode=0, encode=0)
+        # Lowest index of the files resulting in a channel digest
+        self._claims: Dict[bytes, int] = dict()
+
+    def process(self, files: Sequence[Path]) -> Iterator[PipelineItem]:
+        """ Yield an item with the compressed layer or the decoded channels in the order of the provided files.
+            Errors of any stage are raised once the failed file is reached, Cancelled as soon as
+            the cancel token of the PyShop is cancelled.
+        """
+        files = list(files)
+        self._start(files)
+
+        pending: Dict[int, PipelineItem] = dict()
+
+        for index in range(len(files)):
+            while index not in pending:
+                item = self.encoded_queue.get_item(self.stop, self.pyshop.cancel_token)
+                if item is None:
+                    raise RuntimeError('Layer pipeline stopped.')
+                pending[item.index] = item
+
+            item = pending.pop(index)
+            self._slots.release()
+
+            if item.error is not None:
+                raise item.error
+
+            yield item
+
+    def _start(self, files: List[Path]):
+        self._running.update(decode=self.decode_threads, encode=self.encode_threads)
+
+        threads = [Thread(target=self._read, args=(files,), name='LayerPipelineRead')]
+        threads += [Thread(target=self._decode, args=(self._create_worker(),), name=f'LayerPipelineDecode{n}')
+                    for n in range(self.decode_threads)]
+        threads += [Thread(target=self._encode, args=(self._create_worker(),), name=f'LayerPipelineEncode{n}')
+                    for n in range(self.encode_threads)]
+
+        LOGGER.info('Processing %s files in a pipeline of %s decode and %s encode threads, queue depths %s.',
+                    len(files), self.decode_threads, self.encode_threads, [q.maxsize for q in self.queues])
+
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        self.threads = threads
+
+    def _create_worker(self) -> PyShop:
+        worker = self.pyshop.worker_copy()
+        self.workers.append(worker)
+        return worker
+
+    def _acquire_slot(self) -> bool:
+        while not self.stop.is_set():
+            if self._slots.acquire(timeout=StageQueue.poll_seconds):
+                return True
+        return False
+
+    def _read(self, files: List[Path]):
+        buffers = iter(ReadAhead(files, self.read_ahead_files, self.read_requests))
+
+        try:
+            for index, (file, data, waited) in enumerate(buffers):
+                if not self._acquire_slot():
+                    return
+
+                item = PipelineItem(index, file)
+                item.data = data
+                item.stage_seconds['read'] = waited
+
+                if not self.read_queue.put_item(item, self.stop):
+                    return
+        finally:
+            buffers.close()
+
+        for _ in range(self.decode_threads):
+            self.read_queue.put_item(None, self.stop)
+
+    def _decode(self, worker: PyShop):
+        while True:
+            item = self.read_queue.get_item(self.stop)
+            if item is None:
+                break
+
+            worker.timer = PipelineTimer()
+            try:
+                fb = BytesIO(item.data) if item.data is not None else None
+                item.data = None
+                item.img_channels = worker._load_image_to_numpy_channels(item.file, fb)
+            except Exception as e:
+                item.error = e
+            item.add_seconds(worker.timer.file_seconds(item.file.stem))
+
+            if not self.decoded_queue.put_item(item, self.stop):
+                return
+
+        self._stage_finished('decode', self.decoded_queue, self.encode_threads)
+
+    def _encode(self, worker: PyShop):
+        while True:
+            item = self.decoded_queue.get_item(self.stop)
+            if item is None:
+                break
+
+            if item.error is None:
+                worker.timer = PipelineTimer()
+                try:
+                    self._encode_item(worker, item)
+                except Exception as e:
+                    item.error = e
+                item.add_seconds(worker.timer.file_seconds(item.file.stem))
+
+            if not self.encoded_queue.put_item(item, self.stop):
+                return
+
+        self._stage_finished('encode', self.encoded_queue, 1)
+
+    def _stage_finished(self, stage: str, next_queue: StageQueue, consumers: int):
+        """ The last thread of a stage tells every thread of the next stage to finish """
+        with self._lock:
+            self._running[stage] -= 1
+            if self._running[stage]:
+                return
+
+        for _ in range(consumers):
+            next_queue.put_item(None, self.stop)
+
+    def _claim(self, digest: bytes, index: int) -> int:
+        """ Lowest index of all files resulting in the same digest """
+        with self._lock:
+            first = min(self._claims.get(digest, index), index)
+            self._claims[digest] = first
+        return first
+
+    def _encode_item(self, worker: PyShop, item: PipelineItem):
+        name, img_channels = item.file.stem, item.img_channels
+        worker.cancel_token.check()
+
+        if not img_channels or (len(img_channels) > 3 and not img_channels[3].any()):
+            # Layers without content are added from their channels
+            return
+
+        img_channels, top, left = worker._position_channels(name, img_channels)
+
+        if worker.dedup_layers:
+            with worker.timer.stage('dedup', name):
+                item.digest = worker._channels_digest(img_channels, top, left)
+
+            if self._claim(item.digest, item.index) < item.index:
+                # An earlier file of the same content gets compressed and added first
+                item.img_channels = None
+                return
+
+        # Channel ids of the color channels
+        layer = worker._layer_from_channels(name, img_channels, top, left)
+        compression, encoded, seconds = encode_layer_channels(
+            list(layer.channels.values()), worker.compression, ColorDepth.depth8, Version.psd
+            )
+        worker.timer.add('compress', seconds, name)
+
+        height, width = img_channels[0].shape
+        item.encoded = CachedLayer(compression, (top, left, top + height, left + width),
+                                   dict(zip(layer.channels, encoded)))
+        item.img_channels = None
+
+    def queue_stats(self) -> Dict[str, dict]:
+        """ Depth, maximum and mean fill and seconds producers were blocked and consumers waited per queue """
+        return {q.name: q.stats() for q in self.queues}
+
+    def close(self):
+        """ Stop all threads and add the trimming statistics of the threads to the PyShop """
+        self.stop.set()
+
+        for thread in self.threads:
+            thread.join()
+        self.threads = list()
+
+        for worker in self.workers:
+            self.pyshop.untrimmed_pixels += worker.untrimmed_pixels
+            self.pyshop.trimmed_pixels += worker.trimmed_pixels
+        self.workers = list()
+
+        LOGGER.debug('Layer pipeline shut down.')
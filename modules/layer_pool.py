@@ -0,0 +1,191 @@
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+import numpy as np
+
+try:
+    # Python 3.8+
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from modules.cancel_token import CancelToken, kill_process_pool
+from modules.log import init_logging
+from modules.pyshop import PyShop
+from modules.stage_times import PipelineTimer
+
+LOGGER = init_logging(__name__)
+
+# --- PyShop instance of the worker process and the layer settings it was created with ---
+_worker_pyshop, _worker_settings = None, None
+
+
+def _init_worker(size: Tuple[int, int], resample_filter, place_layers: bool):
+    global _worker_pyshop, _worker_settings
+    _worker_pyshop = PyShop(size, resample_filter)
+    _worker_pyshop.place_layers = place_layers
+    _worker_settings = (tuple(size), resample_filter, place_layers)
+
+
+def _decode_to_shared_memory(image_file: Path, shm_name: str, settings: tuple):
+    """ Decode an image file in a worker process and copy it's channel planes
+        one after another into the shared memory block of the parent process.
+        Workers of a shared pool decode files of jobs with different settings.
+
+        :returns: (in shared memory, list of (shape, dtype, offset) per channel or a list of channel
+                  arrays if they do not fit into the memory block, seconds spent per stage)
+    """
+    if settings != _worker_settings:
+        _init_worker(*settings)
+
+    _worker_pyshop.timer = PipelineTimer()
+    img_channels = _worker_pyshop._load_image_to_numpy_channels(image_file)
+    stage_seconds = _worker_pyshop.timer.file_seconds(image_file.stem)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        if sum(c.nbytes for c in img_channels) > shm.size:
+            return False, img_channels, stage_seconds
+
+        planes, offset = list(), 0
+        for channel in img_channels:
+            plane = np.ndarray(channel.shape, dtype=channel.dtype, buffer=shm.buf, offset=offset)
+            plane[:] = channel
+            planes.append((channel.shape, channel.dtype.str, offset))
+            offset += channel.nbytes
+
+            # Release the buffer export before the block is closed
+            del plane
+    finally:
+        shm.close()
+
+    return True, planes, stage_seconds
+
+
+class LayerDecodePool:
+    """ Decodes, resizes and splits image files into channels in a process pool.
+
+        Every in-flight file gets a shared memory slot allocated by this parent process. Workers
+        write the channel planes into the slot and only return their layout, the parent copies
+        the planes out and re-uses the slot for the next file. Results are returned in the order
+        the files were provided. Several pools eg. of concurrent jobs can share one process pool.
+    """
+    slots_per_process = 2
+    # Seconds between cancellation checks while waiting for a file
+    poll_seconds = 0.1
+
+    def __init__(self, size: Tuple[int, int], resample_filter, processes: int, place_layers: bool=False,
+                 executor: Union[None, Executor]=None, cancel_token: Union[None, CancelToken]=None):
+        """
+        :param size: Size of the Psd file
+        :param resample_filter: Pillow resampling filter
+        :param processes: Number of processes, or files decoded at once inside a shared executor
+        :param place_layers: Store resized images at their size, see PyShop.place_layers
+        :param executor: Shared process pool, a pool of processes is created if not set
+        :param cancel_token: Checked while waiting for files, cancelling terminates processes created here
+        """
+        self.size = size
+        self.processes = max(1, processes)
+        self.settings = (tuple(size), resample_filter, place_layers)
+        self.cancel_token = cancel_token or CancelToken()
+
+        # Resized images are RGBA at psd size, images already at psd size
+        # have at most 4 channels of 8bit data.
+        self.slot_size = max(1, size[0] * size[1] * 4)
+        self.slots: List[shared_memory.SharedMemory] = list()
+        # Running decodes of a stopped consumer, still writing into their slots
+        self.abandoned: List[Future] = list()
+
+        self.shared_executor = executor is not None
+        self.executor = executor or ProcessPoolExecutor(max_workers=self.processes,
+                                                        initializer=_init_worker,
+                                                        initargs=self.settings)
+
+    @staticmethod
+    def available() -> bool:
+        return shared_memory is not None
+
+    def _create_slots(self, num_slots: int):
+        for _ in range(0, num_slots):
+            self.slots.append(shared_memory.SharedMemory(create=True, size=self.slot_size))
+
+    @staticmethod
+    def _collect(slot, in_shared_memory: bool, planes) -> List[np.ndarray]:
+        if not in_shared_memory:
+            return planes
+
+        img_channels = list()
+        for shape, dtype, offset in planes:
+            plane = np.ndarray(shape, dtype=np.dtype(dtype), buffer=slot.buf, offset=offset)
+            img_channels.append(plane.copy())
+            del plane
+
+        return img_channels
+
+    def decode(self, files: Iterable[Path]) -> Iterator[Tuple[Path, List[np.ndarray], Dict[str, float]]]:
+        """ Yield (file, list of channel arrays, seconds per stage) in the order of the provided files """
+        files = iter(files)
+        pending = deque()
+
+        self._create_slots(self.processes * self.slots_per_process)
+        free_slots = list(self.slots)
+
+        def submit_next() -> bool:
+            try:
+                file = next(files)
+            except StopIteration:
+                return False
+
+            slot = free_slots.pop()
+            pending.append((file, slot, self.executor.submit(_decode_to_shared_memory, file, slot.name,
+                                                                    self.settings)))
+            return True
+
+        while free_slots and submit_next():
+            pass
+
+        try:
+            while pending:
+                file, slot, future = pending[0]
+                while not wait([future], timeout=self.poll_seconds, return_when=FIRST_COMPLETED).done:
+                    self.cancel_token.check()
+                pending.popleft()
+
+                in_shared_memory, planes, stage_seconds = future.result()
+                img_channels = self._collect(slot, in_shared_memory, planes)
+
+                free_slots.append(slot)
+                submit_next()
+
+                yield file, img_channels, stage_seconds
+        finally:
+            # Consumer stopped early eg. aborted, do not start queued files.
+            # Processes of a cancelled pool get killed instead.
+            killed = self.cancel_token.is_cancelled and not self.shared_executor
+            for file, slot, future in pending:
+                if killed or not future.cancel():
+                    self.abandoned.append(future)
+
+    def shutdown(self):
+        """ Stop the worker processes unless they are shared and release all shared memory blocks.
+            Processes created by a cancelled pool are terminated instead of finishing their files.
+        """
+        if not self.shared_executor:
+            if self.cancel_token.is_cancelled:
+                kill_process_pool(self.executor)
+            else:
+                self.executor.shutdown(wait=True)
+        elif self.abandoned and not self.cancel_token.is_cancelled:
+            # Other jobs keep the processes running, wait before the slots get released.
+            # Files of a cancelled job fail to open their released slot instead.
+            wait(self.abandoned)
+        self.abandoned = list()
+
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+        self.slots = list()
+        LOGGER.debug('Layer decode pool shut down.')
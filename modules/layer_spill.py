@@ -0,0 +1,70 @@
+import shutil
+import tempfile
+from pathlib import Path
+from typing import Union
+
+import numpy as np
+
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+
+class LayerSpill:
+    """ Keeps decoded channel planes in memory mapped scratch files once a memory budget is used up.
+
+        Spilled planes are re-opened read-only so the OS can drop their pages at any time
+        and read them back from disk when the Psd file gets written.
+    """
+    prefix = 'tieflader_spill_'
+
+    def __init__(self, budget: int, scratch_dir: Union[Path, str, None]=None):
+        """
+        :param budget: Bytes of channel data kept in memory before planes are spilled to disk
+        :param scratch_dir: Directory for the scratch files, system temp directory if not set
+        """
+        self.budget = budget
+        self.scratch_dir = Path(scratch_dir) if scratch_dir else None
+
+        self.in_memory = 0
+        self.spilled = 0
+        self.spill_dir: Union[None, Path] = None
+        self.file_count = 0
+
+    def store(self, plane: np.ndarray) -> np.ndarray:
+        """ Return the plane itself while within budget, otherwise a memory mapped copy of it """
+        if self.in_memory + plane.nbytes <= self.budget:
+            self.in_memory += plane.nbytes
+            return plane
+
+        if self.spill_dir is None:
+            self.spill_dir = Path(tempfile.mkdtemp(prefix=self.prefix, dir=self.scratch_dir))
+            LOGGER.info('Memory budget of %.1fMB exceeded, spilling channel data to: %s',
+                        self.budget / 1048576, self.spill_dir.as_posix())
+
+        spill_file = self.spill_dir / f'{self.file_count:06d}.raw'
+        self.file_count += 1
+
+        mm = np.memmap(spill_file, dtype=plane.dtype, mode='w+', shape=plane.shape)
+        mm[:] = plane
+        mm.flush()
+        del mm
+
+        self.spilled += plane.nbytes
+        return np.memmap(spill_file, dtype=plane.dtype, mode='r', shape=plane.shape)
+
+    def cleanup(self):
+        """ Remove all scratch files. Spilled planes must not be referenced anymore. """
+        if self.spill_dir is None:
+            return
+
+        shutil.rmtree(self.spill_dir, ignore_errors=True)
+
+        if self.spill_dir.exists():
+            LOGGER.warning('Could not remove all scratch files in: %s', self.spill_dir.as_posix())
+        else:
+            LOGGER.info('Removed %s scratch files with %.1fMB of channel data.',
+                        self.file_count, self.spilled / 1048576)
+
+        self.spill_dir = None
+        self.file_count, self.in_memory, self.spilled = 0, 0, 0
@@ -0,0 +1,190 @@
+"""
+    NumPy implementation of pytoshop's packbits extension.
+
+    pytoshop's Cython extension often fails to build and pytoshop can not write run length
+    encoded data without it. This module provides the same functions, run boundaries are
+    detected for a whole channel at once and the encoded output is byte-identical to the
+    compiled encoder.
+"""
+import sys
+
+import numpy as np
+from pytoshop import codecs, enums
+
+COMPILED = 'compiled'
+NUMPY = 'numpy'
+
+_active_encoder = None
+
+
+def _packets(num: np.ndarray, max_last: np.ndarray):
+    """ Split segments of num bytes into packets of 127 bytes, the last packet may be up to max_last bytes """
+    over = np.maximum(num - max_last, 0)
+    return 1 + (over + 126) // 127
+
+
+def encode_rows(rows: np.ndarray):
+    """ PackBits encode every row of a 2D uint8 array.
+
+    :returns: (bytes of every row concatenated, encoded length of every row)
+    """
+    height, width = rows.shape
+
+    if width == 0 or height == 0:
+        return b'', np.zeros(height, dtype=np.int64)
+
+    flat = np.ascontiguousarray(rows).ravel()
+
+    # Bytes equal to their right or left neighbour are part of a run
+    eq = np.zeros((height, width + 1), dtype=bool)
+    eq[:, 1:width] = rows[:, 1:] == rows[:, :-1]
+    in_run = eq[:, :-1] | eq[:, 1:]
+
+    # Segments start at every row start, every change between literal and run
+    # and where two runs of different bytes touch
+    starts = np.zeros((height, width), dtype=bool)
+    starts[:, 0] = True
+    starts[:, 1:] = (in_run[:, 1:] != in_run[:, :-1]) | (in_run[:, 1:] & ~eq[:, 1:width])
+    seg_start = np.flatnonzero(starts)
+    seg_len = np.diff(np.append(seg_start, flat.size))
+    seg_run = in_run.ravel()[seg_start]
+    seg_row = seg_start // width
+
+    # Runs and literals at the end of a row may end with a packet of 128 bytes,
+    # literals followed by a run are flushed every 127 bytes
+    seg_trailing = (seg_start + seg_len) % width == 0
+    max_last = np.where(seg_run | seg_trailing, 128, 127)
+    seg_packets = _packets(seg_len, max_last)
+
+    # --- Expand segments to packets ---
+    pk_seg = np.repeat(np.arange(seg_start.size), seg_packets)
+    first_packet = np.cumsum(seg_packets) - seg_packets
+    pk_idx = np.arange(pk_seg.size) - first_packet[pk_seg]
+    pk_last = pk_idx == seg_packets[pk_seg] - 1
+    pk_size = np.where(pk_last, seg_len[pk_seg] - 127 * pk_idx, 127)
+    pk_start = seg_start[pk_seg] + 127 * pk_idx
+    pk_run = seg_run[pk_seg]
+
+    pk_out_len = np.where(pk_run, 2, pk_size + 1)
+    pk_out = np.cumsum(pk_out_len) - pk_out_len
+    out = np.empty(int(pk_out_len.sum()), dtype=np.uint8)
+
+    # Packet headers: 257 - count for runs, count - 1 for literals
+    out[pk_out] = np.where(pk_run, 257 - pk_size, pk_size - 1)
+
+    # Repeated byte of run packets
+    out[pk_out[pk_run] + 1] = flat[pk_start[pk_run]]
+
+    # Literal bytes
+    lit = ~pk_run
+    lit_size = pk_size[lit]
+    lit_before = np.cumsum(lit_size) - lit_size
+    lit_pos = np.arange(int(lit_size.sum()))
+    src = np.repeat(pk_start[lit] - lit_before, lit_size) + lit_pos
+    dst = np.repeat(pk_out[lit] + 1 - lit_before, lit_size) + lit_pos
+    out[dst] = flat[src]
+
+    row_lengths = np.bincount(seg_row[pk_seg], weights=pk_out_len, minlength=height).astype(np.int64)
+
+    return out.tobytes(), row_lengths
+
+
+def _as_byte_rows(image: np.ndarray) -> np.ndarray:
+    """ View an image as rows of big endian bytes """
+    image = np.ascontiguousarray(image, dtype=image.dtype.newbyteorder('>'))
+    return image.view(np.uint8).reshape(image.shape[0], -1)
+
+
+def encode(data) -> bytes:
+    """ Encodes PackBit encoded data. """
+    row = np.frombuffer(data, dtype=np.uint8)
+    return encode_rows(row.reshape(1, row.size))[0]
+
+
+def decode(data, height: int, width: int, depth: int, version: int) -> bytes:
+    """ Decodes PackBit encoded data. """
+    if version == 1:
+        lengths = np.frombuffer(data, dtype='>u2', count=height)
+        pos = 2 * height
+    else:
+        lengths = np.frombuffer(data, dtype='>u4', count=height)
+        pos = 4 * height
+
+    row_size = width * depth
+    output = list()
+
+    for length in lengths.tolist():
+        end = pos + length
+        row = list()
+
+        while pos < end:
+            header = data[pos]
+            pos += 1
+
+            if header < 128:
+                row.append(data[pos:pos + header + 1])
+                pos += header + 1
+            elif header != 128:
+                row.append(data[pos:pos + 1] * (257 - header))
+                pos += 1
+
+        row = b''.join(row)
+        output.append(row[:row_size].ljust(row_size, b'\x00'))
+        pos = end
+
+    return b''.join(output)
+
+
+def encode_prediction_8bit(data):
+    data[1:] -= data[:-1]
+
+
+def encode_prediction_16bit(data):
+    data[1:] -= data[:-1]
+
+
+def decode_prediction_8bit(data):
+    np.cumsum(data, dtype=data.dtype, out=data)
+
+
+def decode_prediction_16bit(data):
+    np.cumsum(data, dtype=data.dtype, out=data)
+
+
+def compress_rle(fd, image: np.ndarray, depth: int, version: int):
+    """ Write a Numpy array to a run length encoded stream, replaces pytoshop.codecs.compress_rle """
+    if depth == 1:
+        raise ValueError("rle compression is not supported for 1-bit images")
+
+    encoded, row_lengths = encode_rows(_as_byte_rows(image))
+
+    if version == 1:
+        fd.write(row_lengths.astype('>u2').tobytes())
+    else:
+        fd.write(row_lengths.astype('>u4').tobytes())
+
+    fd.write(encoded)
+
+
+def install() -> str:
+    """ Let pytoshop use this module if it's compiled packbits extension is missing.
+
+    :returns: name of the active encoder
+    """
+    global _active_encoder
+
+    if _active_encoder is not None:
+        return _active_encoder
+
+    if hasattr(codecs, 'packbits'):
+        _active_encoder = COMPILED
+    else:
+        codecs.packbits = sys.modules[__name__]
+        codecs.compressors[enums.Compression.rle] = compress_rle
+        _active_encoder = NUMPY
+
+    return _active_encoder
+
+
+def active_encoder() -> str:
+    return install()
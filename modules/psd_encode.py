@@ -0,0 +1,328 @@
+import time
+import zlib
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, wait
+from io import BytesIO
+from typing import Iterator, List, Tuple, Union
+
+import numpy as np
+from pytoshop import codecs, core, enums, layers, util
+
+from modules import packbits
+from modules.cancel_token import CancelToken, kill_process_pool
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+# Use the NumPy PackBits encoder if pytoshop's compiled extension is missing,
+# imported by every worker process as well
+packbits.install()
+
+# Compression value letting the encoder pick a compression per layer
+AUTO = -1
+
+# Rows sampled from every channel: number of bands spread across the image and rows per band
+AUTO_SAMPLE_BANDS = 4
+AUTO_SAMPLE_ROWS = 8
+
+# ZIP needs to be this much smaller than RLE to be worth it's slower compression
+AUTO_ZIP_GAIN = 0.8
+
+
+def _predict_rows(image: np.ndarray) -> np.ndarray:
+    """ Replace every value but the first of a row by it's difference to the previous value """
+    if image.dtype.itemsize > 2:
+        raise ValueError("zip with prediction is not implemented for 32-bit images")
+
+    image = util.ensure_native_endian(image)
+    predicted = image.copy()
+    predicted[:, 1:] -= image[:, :-1]
+
+    return util.ensure_bigendian(predicted)
+
+
+def compress_zip_prediction(fd, image: np.ndarray, depth: int, version: int):
+    """ Write a Numpy array to a zip with prediction compressed stream, replaces
+        pytoshop.codecs.compress_zip_prediction which predicts flattened copies of the rows
+        and writes the unaltered rows.
+    """
+    fd.write(zlib.compress(_predict_rows(image)))
+
+
+def compress_constant_zip_prediction(fd, value: int, width: int, rows: int, depth: int, version: int):
+    """ Write a constant image to a zip with prediction compressed stream """
+    row = codecs._make_constant_row(value, width, depth).reshape((1, width))
+    fd.write(zlib.compress(_predict_rows(row).tobytes() * rows))
+
+
+def decompress_zip_prediction(data: bytes, shape: Tuple[int, int], depth: int, version: int) -> np.ndarray:
+    """ Decompress zip with prediction encoded data """
+    image = util.ensure_native_endian(codecs.decompress_raw(zlib.decompress(data), shape, depth, version))
+    if image.dtype.itemsize > 2:
+        raise ValueError("zip with prediction is not implemented for 32-bit images")
+
+    return np.cumsum(image, axis=1, dtype=image.dtype)
+
+
+codecs.compressors[enums.Compression.zip_prediction] = compress_zip_prediction
+codecs.constant_compressors[enums.Compression.zip_prediction] = compress_constant_zip_prediction
+codecs.decompressors[enums.Compression.zip_prediction] = decompress_zip_prediction
+
+
+def encode_channel(image: np.ndarray, compression: int, depth: int, version: int) -> bytes:
+    """ Compress a single channel plane exactly like pytoshop does while writing a layer record """
+    fd = BytesIO()
+    codecs.compress_image(fd, image, compression, image.shape, 1, depth, version)
+    return fd.getvalue()
+
+
+def _sample_rows(image: np.ndarray) -> np.ndarray:
+    """ A few bands of consecutive rows spread across the image """
+    height = image.shape[0]
+    if height <= AUTO_SAMPLE_BANDS * AUTO_SAMPLE_ROWS:
+        return image
+
+    starts = np.linspace(0, height - AUTO_SAMPLE_ROWS, AUTO_SAMPLE_BANDS).astype(int)
+    return np.concatenate([image[s:s + AUTO_SAMPLE_ROWS] for s in starts])
+
+
+def choose_compression(images: List[np.ndarray], depth: int, version: int) -> int:
+    """ Compress sample rows of all channels of a layer and pick the compression for the layer.
+
+        RLE is preferred for it's speed, ZIP only if it is considerably smaller
+        and raw if RLE would not reduce the size at all.
+    """
+    sizes = {c: 0 for c in (enums.Compression.raw, enums.Compression.rle,
+                            enums.Compression.zip, enums.Compression.zip_prediction)}
+
+    for image in images:
+        sample = _sample_rows(image)
+        for compression in sizes:
+            sizes[compression] += len(encode_channel(sample, compression, depth, version))
+
+    fast = enums.Compression.rle
+    if sizes[enums.Compression.rle] >= sizes[enums.Compression.raw]:
+        fast = enums.Compression.raw
+
+    small = enums.Compression.zip
+    if sizes[enums.Compression.zip_prediction] < sizes[enums.Compression.zip]:
+        small = enums.Compression.zip_prediction
+
+    if sizes[small] < sizes[fast] * AUTO_ZIP_GAIN:
+        return small
+
+    return fast
+
+
+def constant_compression(compression: int) -> int:
+    """ Compression of the constant channels of a layer compressed with compression.
+        PSD stores the compression per channel, a raw constant channel would take it's full size.
+    """
+    if compression in (enums.Compression.zip, enums.Compression.zip_prediction):
+        return compression
+    return enums.Compression.rle
+
+
+def encode_layer_channels(images: List[np.ndarray], compression: int, depth: int, version: int
+                          ) -> Tuple[int, List[bytes], float]:
+    """ Compress all channels of one layer, the task of LayerEncoder workers and LayerPipeline threads
+
+    :returns: (compression used, compressed channels, seconds spent)
+    """
+    start = time.perf_counter()
+
+    if compression == AUTO:
+        compression = choose_compression(images, depth, version)
+
+    encoded = [encode_channel(image, compression, depth, version) for image in images]
+
+    return compression, encoded, time.perf_counter() - start
+
+
+def log_layer_compression(name: str, compression: int, raw_size: int, size: int, seconds: float):
+    LOGGER.info('Compressed layer %s with %s in %.1fms: %.2fMB -> %.2fMB ratio %.2f',
+                name, enums.Compression(compression).name, seconds * 1000,
+                raw_size / 1048576, size / 1048576, size / max(1, raw_size))
+
+
+def encoded_channel(data: bytes, shape: Tuple[int, int], compression: int, depth: int, version: int
+                    ) -> layers.ChannelImageData:
+    """ Channel image data pytoshop writes as is, because it already holds the compressed bytes """
+    return layers.ChannelImageData(fd=BytesIO(data), offset=0, size=len(data), shape=shape,
+                                   depth=depth, version=version, compression=compression)
+
+
+def encoded_bytes(channel: layers.ChannelImageData) -> Union[None, bytes]:
+    """ The compressed bytes of a channel created by encoded_channel, None for any other channel """
+    if isinstance(channel._fd, BytesIO) and channel._image is None:
+        return channel._fd.getvalue()
+
+    return None
+
+
+def _channel_array(channel: layers.ChannelImageData):
+    """ The uncompressed plane of a channel or None for constant and already compressed channels """
+    # pytoshop only exposes image data through the decoding image property
+    image = channel._image
+
+    if image is None or np.isscalar(image) or image.shape == ():
+        return None
+
+    return image
+
+
+class LayerEncoder:
+    """ Compresses the channel data of all layer records in parallel before the PsdFile is written.
+
+        pytoshop's PackBits encoder holds the GIL so channels are compressed in worker processes.
+        The compressed bytes replace the channel arrays and get copied to the file unaltered,
+        the written file is byte-identical to a serially compressed one. Layers sharing the
+        same channel arrays, eg. duplicate layers, are compressed once.
+    """
+    # Seconds between cancellation checks while waiting for worker processes
+    poll_seconds = 0.1
+
+    def __init__(self, workers: int, compression: int=None, executor: Union[None, Executor]=None,
+                 cancel_token: Union[None, CancelToken]=None):
+        """
+        :param workers: Number of worker processes, 0 or 1 compresses in this process
+        :param compression: Compression for all channels, AUTO to pick one per layer,
+                            None keeps the compression of the channels
+        :param executor: Process pool shared eg. by concurrent jobs, used instead of creating worker processes
+        :param cancel_token: Checked before every layer, cancelling terminates worker processes created here
+        """
+        self.workers = max(1, workers)
+        self.compression = compression
+        self.executor = executor
+        self.cancel_token = cancel_token or CancelToken()
+
+        # (layer name, seconds) of every compressed layer
+        self.layer_seconds: List[Tuple[str, float]] = list()
+
+    def encode(self, psd: core.PsdFile):
+        jobs = list()
+
+        for record in psd.layer_and_mask_info.layer_info.layer_records:
+            channel_ids, images = list(), list()
+            compression = self.compression
+
+            for channel_id, data in record.channels.items():
+                image = _channel_array(data)
+                if image is not None:
+                    channel_ids.append(channel_id)
+                    images.append(image)
+                    if compression is None:
+                        compression = data.compression
+
+            if images:
+                jobs.append((record, channel_ids, images, compression))
+            else:
+                self._match_constant_channels(record)
+
+        if not jobs:
+            return
+
+        # Index of the unique job compressing the same arrays as every job
+        unique, unique_jobs, job_index = dict(), list(), list()
+        for job in jobs:
+            record, ids, images, compression = job
+            key = (compression, tuple(id(image) for image in images))
+            if key not in unique:
+                unique[key] = len(unique_jobs)
+                unique_jobs.append(job)
+            job_index.append(unique[key])
+
+        LOGGER.info('Compressing %s layers with %s worker processes.', len(unique_jobs), self.workers)
+
+        results = self._compress(unique_jobs, psd.depth, psd.version)
+        try:
+            self._replace_channels(jobs, self._job_results(job_index, results), psd.depth, psd.version)
+        finally:
+            results.close()
+
+    def _compress(self, unique_jobs: list, depth: int, version: int) -> Iterator[Tuple[int, List[bytes], float]]:
+        """ Yield the result of every job in order, jobs are released once they got compressed """
+        if self.workers == 1:
+            for idx, (record, ids, images, compression) in enumerate(unique_jobs):
+                self.cancel_token.check()
+                unique_jobs[idx] = None
+                yield encode_layer_channels(images, compression, depth, version)
+            return
+
+        executor = self.executor or ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            futures = [executor.submit(encode_layer_channels, images, compression, depth, version)
+                       for record, ids, images, compression in unique_jobs]
+            unique_jobs.clear()
+
+            for idx in range(len(futures)):
+                # Queued futures of a shared pool get cancelled, a pool killed afterwards must keep them
+                yield self._result(futures, idx, cancel_queued=self.executor is not None)
+                futures[idx] = None
+        finally:
+            if self.executor is None:
+                if self.cancel_token.is_cancelled:
+                    kill_process_pool(executor)
+                else:
+                    executor.shutdown(wait=True)
+
+    def _result(self, futures: List[Union[None, Future]], idx: int, cancel_queued: bool):
+        """ Result of the future at idx, raises Cancelled once the job was cancelled """
+        while True:
+            if self.cancel_token.is_cancelled:
+                for future in futures[idx:] if cancel_queued else ():
+                    future.cancel()
+                self.cancel_token.check()
+
+            if wait([futures[idx]], timeout=self.poll_seconds).done:
+                return futures[idx].result()
+
+    @staticmethod
+    def _job_results(job_index: List[int], results: Iterator[Tuple[int, List[bytes], float]]):
+        """ Results of every job, duplicate jobs re-use the result of their first job without taking time """
+        done = list()
+        for idx in job_index:
+            if idx == len(done):
+                done.append(next(results))
+                yield done[idx]
+            else:
+                compression, encoded, seconds = done[idx]
+                yield compression, encoded, 0.0
+
+    @classmethod
+    def match_constant_channels(cls, psd: core.PsdFile):
+        """ Constant channels of all layers follow their layer's compression, for layers compressed while writing """
+        for record in psd.layer_and_mask_info.layer_info.layer_records:
+            cls._match_constant_channels(record)
+
+    @staticmethod
+    def _match_constant_channels(record: layers.LayerRecord):
+        """ Constant channels of layers compressed upfront eg. from the layer cache follow the layer's compression """
+        compressions = [data.compression for data in record.channels.values()
+                        if data._image is None or _channel_array(data) is not None]
+        if not compressions:
+            return
+
+        for data in record.channels.values():
+            if data._image is not None and _channel_array(data) is None:
+                data.compression = constant_compression(compressions[0])
+
+    def _replace_channels(self, jobs: list, results: Iterator[Tuple[int, List[bytes], float]], depth: int,
+                          version: int):
+        """ Replace the channel arrays of every job's record by their compressed bytes.
+            Jobs are released one by one so the arrays of a layer get dropped once it is compressed.
+        """
+        for idx, (compression, encoded, seconds) in enumerate(results):
+            record, channel_ids, images, c = jobs[idx]
+            jobs[idx] = None
+
+            for channel_id, image, data in zip(channel_ids, images, encoded):
+                record.channels[channel_id] = encoded_channel(data, image.shape, compression, depth, version)
+
+            # Constant channels are compressed while writing
+            for data in record.channels.values():
+                if data._image is not None:
+                    data.compression = constant_compression(compression)
+
+            self.layer_seconds.append((record.name, seconds))
+            log_layer_compression(record.name, compression, sum(i.nbytes for i in images),
+                                  sum(len(d) for d in encoded), seconds)
@@ -0,0 +1,196 @@
+import json
+from pathlib import Path
+from typing import BinaryIO, Dict, List, Tuple, Union
+
+import pytoshop
+from pytoshop import layers
+
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+
+class PreviousLayer:
+    """ Channel data of a layer inside a previously created or the currently streamed Psd file,
+        read when the layer is written again
+    """
+    def __init__(self, fd: BinaryIO, bounds: Tuple[int, int, int, int], channels: List[list],
+                 depth: int, version: int):
+        """
+        :param fd: Opened Psd file
+        :param bounds: top, left, bottom, right of the layer
+        :param channels: [channel id, compression, data offset, data size] of every channel
+        """
+        self.fd = fd
+        self.bounds = tuple(bounds)
+        self.channels = channels
+        self.depth = depth
+        self.version = version
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        top, left, bottom, right = self.bounds
+        return bottom - top, right - left
+
+    def channel_data(self) -> Dict[int, layers.ChannelImageData]:
+        """ Channel image data pytoshop and the PsdStreamWriter copy from the file as is """
+        return {channel_id: layers.ChannelImageData(fd=self.fd, offset=offset, size=size, shape=self.shape,
+                                                    depth=self.depth, version=self.version,
+                                                    compression=compression)
+                for channel_id, compression, offset, size in self.channels}
+
+
+class PsdManifest:
+    """ Sidecar file of a created Psd file recording the image file of every layer and where
+        it's compressed channel data is located inside the Psd file.
+
+        Another job with the same layer settings can copy the layers of unchanged image files
+        from the Psd file instead of decoding and compressing them again.
+    """
+    suffix = '.manifest.json'
+    format_version = 1
+
+    def __init__(self, psd_file: Union[Path, str], settings: list, psd_stat: Tuple[int, int],
+                 header: Tuple[int, int], layer_entries: List[dict]):
+        """
+        :param psd_file: The Psd file described
+        :param settings: Settings changing the layer content, see PyShop.layer_settings
+        :param psd_stat: Size and modification time in ns of the Psd file, offsets are invalid once it changed
+        :param header: Depth and version of the Psd file
+        :param layer_entries: Image file fingerprint, layer bounds and channel locations of every layer
+        """
+        self.psd_file = Path(psd_file)
+        self.settings = settings
+        self.psd_stat = tuple(psd_stat)
+        self.header = tuple(header)
+        self.layer_entries = layer_entries
+
+        self.fd: Union[None, BinaryIO] = None
+
+    @classmethod
+    def path_for(cls, psd_file: Union[Path, str]) -> Path:
+        psd_file = Path(psd_file)
+        return psd_file.with_name(psd_file.name + cls.suffix)
+
+    @staticmethod
+    def fingerprint(file: Path) -> Tuple[int, int]:
+        stat = file.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def create(cls, psd_file: Union[Path, str], settings: list, layer_files: Dict[str, Path]) -> 'PsdManifest':
+        """ Describe a written Psd file. Layer records are read without their channel data.
+
+        :param psd_file: The written Psd file
+        :param settings: Settings changing the layer content, see PyShop.layer_settings
+        :param layer_files: Image file of every layer by layer name, layers of other names are not recorded
+        """
+        psd_file = Path(psd_file)
+        layer_entries = list()
+
+        with open(psd_file, 'rb') as f:
+            psd = pytoshop.read(f)
+
+        for record in psd.layer_and_mask_info.layer_info.layer_records:
+            file = layer_files.get(record.name)
+            if file is None or record.bottom <= record.top or record.right <= record.left:
+                continue
+
+            try:
+                size, mtime_ns = cls.fingerprint(file)
+            except OSError:
+                continue
+
+            layer_entries.append(dict(
+                file=file.resolve().as_posix(), size=size, mtime_ns=mtime_ns,
+                bounds=(record.top, record.left, record.bottom, record.right),
+                channels=[(c, d.compression, d._offset, d._size) for c, d in record.channels.items()],
+                ))
+
+        return cls(psd_file, settings, cls.fingerprint(psd_file), (psd.depth, psd.version), layer_entries)
+
+    def write(self):
+        manifest_file = self.path_for(self.psd_file)
+        data = dict(format_version=self.format_version, psd_file=self.psd_file.name, settings=self.settings,
+                    psd_stat=self.psd_stat, header=self.header, layers=self.layer_entries)
+
+        try:
+            with open(manifest_file, 'w') as f:
+                json.dump(data, f)
+        except OSError as e:
+            LOGGER.error('Could not write Psd manifest %s: %s', manifest_file.name, e)
+
+    @classmethod
+    def read(cls, manifest_file: Path) -> Union[None, 'PsdManifest']:
+        try:
+            with open(manifest_file, 'r') as f:
+                data = json.load(f)
+            if data['format_version'] != cls.format_version:
+                return None
+            return cls(manifest_file.with_name(data['psd_file']), data['settings'], data['psd_stat'],
+                       data['header'], data['layers'])
+        except Exception as e:
+            LOGGER.warning('Could not read Psd manifest %s: %s', manifest_file.name, e)
+
+        return None
+
+    def is_valid(self, settings: list) -> bool:
+        """ Test if the layers were created with the same settings and the Psd file was not changed since """
+        if self.settings != settings:
+            return False
+
+        try:
+            return self.fingerprint(self.psd_file) == self.psd_stat
+        except OSError:
+            return False
+
+    def unchanged_entries(self, files: List[Path]) -> Dict[Path, dict]:
+        """ Layer entries of the files that did not change since the Psd file was created """
+        entries = {e['file']: e for e in self.layer_entries}
+        unchanged = dict()
+
+        for file in files:
+            entry = entries.get(file.resolve().as_posix())
+            if entry is None:
+                continue
+
+            try:
+                if self.fingerprint(file) == (entry['size'], entry['mtime_ns']):
+                    unchanged[file] = entry
+            except OSError:
+                pass
+
+        return unchanged
+
+    @classmethod
+    def find_previous(cls, directory: Path, files: List[Path], settings: list) -> Union[None, 'PsdManifest']:
+        """ The manifest inside directory sharing the most unchanged image files """
+        best, best_count = None, 0
+
+        for manifest_file in directory.glob(f'*{cls.suffix}'):
+            manifest = cls.read(manifest_file)
+            if manifest is None or not manifest.is_valid(settings):
+                continue
+
+            count = len(manifest.unchanged_entries(files))
+            if count > best_count:
+                best, best_count = manifest, count
+
+        return best
+
+    def open_layers(self, files: List[Path]) -> Dict[Path, PreviousLayer]:
+        """ Open the Psd file and return the layers of all unchanged image files, call close when done """
+        unchanged = self.unchanged_entries(files)
+        if not unchanged:
+            return dict()
+
+        self.fd = open(self.psd_file, 'rb')
+        depth, version = self.header
+
+        return {file: PreviousLayer(self.fd, entry['bounds'], entry['channels'], depth, version)
+                for file, entry in unchanged.items()}
+
+    def close(self):
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
@@ -0,0 +1,227 @@
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+import numpy as np
+from pytoshop import color_mode, core, enums, image_data, image_resources, layers, tagged_block, util
+from pytoshop.user import nested_layers
+
+from modules.log import init_logging
+from modules.psd_encode import (AUTO, choose_compression, constant_compression, encode_channel, encoded_channel,
+                                log_layer_compression)
+from modules.psd_manifest import PreviousLayer
+
+LOGGER = init_logging(__name__)
+
+
+class PsdStreamWriter:
+    """ Writes a layered Psd file layer by layer instead of building the whole PsdFile in memory.
+
+        Header, image resources and all layer records are written upfront. Every layer's
+        compressed channel data is written as soon as the layer is provided, the layer
+        bounds, channel lengths and section lengths are back-patched into the file.
+        Layers have to be written bottom to top, in the order of the provided layer names.
+    """
+    # Channels every layer record is reserved for: A R G B
+    # in the sorted order pytoshop writes them
+    channel_ids = [
+        enums.ChannelId.transparency,
+        enums.ChannelId.red,
+        enums.ChannelId.green,
+        enums.ChannelId.blue
+        ]
+
+    def __init__(self, psd_file: Union[Path, str], size: Tuple[int, int], layer_names: List[str],
+                 compression=enums.Compression.rle, version=enums.Version.psd):
+        self.psd_file = Path(psd_file)
+        self.size = size
+        self.layer_names = layer_names
+        self.compression = compression
+
+        self.header = core.Header(
+            version=version, num_channels=3, width=size[0], height=size[1],
+            depth=enums.ColorDepth.depth8, color_mode=enums.ColorMode.rgb
+            )
+
+        self.file = None
+        self.records: List[Tuple[int, layers.LayerRecord]] = list()
+        self.layer_count = 0
+
+        # Channel data of the last written layer inside the file, eg. to copy it for an identical layer
+        self.written_layer: Union[None, PreviousLayer] = None
+
+        self.layer_and_mask_info_start = 0
+        self.layer_info_start = 0
+
+    def open(self):
+        """ Create the Psd file and write everything up to the first layer's channel data """
+        # Readable to copy already written channel data
+        self.file = open(self.psd_file, 'w+b')
+        fd = self.file
+
+        num_layers = len(self.layer_names)
+
+        self.header.write(fd)
+        color_mode.ColorModeData().write(fd, self.header)
+        image_resources.ImageResources(
+            blocks=[image_resources.LayersGroupInfo(group_ids=[0] * num_layers)]
+            ).write(fd, self.header)
+
+        # Section lengths will be written on close
+        self.layer_and_mask_info_start = fd.tell()
+        fd.seek(self._length_size(), os.SEEK_CUR)
+        self.layer_info_start = fd.tell()
+        fd.seek(self._length_size(), os.SEEK_CUR)
+
+        util.write_value(fd, 'h', num_layers)
+
+        for idx, name in enumerate(self.layer_names):
+            # Layer id's are counted from the top most layer like pytoshop does
+            record = layers.LayerRecord(
+                name=name,
+                channels={c: layers.ChannelImageData(image=0) for c in self.channel_ids},
+                blocks=[
+                    tagged_block.UnicodeLayerName(name=name),
+                    tagged_block.LayerId(id=num_layers - 1 - idx),
+                    ]
+                )
+            self.records.append((fd.tell(), record))
+            record.write(fd, self.header)
+
+        LOGGER.debug('Opened Psd stream with %s layer records: %s', num_layers, self.psd_file.name)
+
+    def _length_size(self) -> int:
+        if self.header.version == enums.Version.psd:
+            return 4
+        return 8
+
+    def _write_length(self, offset: int, end: int):
+        fd = self.file
+        fd.seek(offset)
+
+        if self.header.version == enums.Version.psd:
+            util.write_value(fd, 'I', end - offset - 4)
+        else:
+            util.write_value(fd, 'Q', end - offset - 8)
+
+    def write_layer(self, layer: nested_layers.Image) -> Tuple[int, Dict[int, bytes]]:
+        """ Compress and write the channel data of the next layer
+
+        :param layer: Layer with channel arrays or already compressed channel image data eg. from the layer cache
+        :returns: (compression used, compressed data of the layer's own channels by channel id)
+        """
+        if self.layer_count >= len(self.records):
+            raise ValueError('More layers written than layer records reserved.')
+
+        record_start, record = self.records[self.layer_count]
+        self.layer_count += 1
+
+        channels = dict(layer.channels)
+        alpha = channels.get(enums.ChannelId.transparency)
+        shape = self.layer_shape(channels)
+
+        if isinstance(alpha, np.ndarray) and not np.any(alpha):
+            # pytoshop skips fully transparent layers, the record already exists so keep it empty
+            LOGGER.debug('Writing fully transparent layer %s without content.', record.name)
+            channels, shape = dict(), (0, 0)
+
+        top, left = layer.top, layer.left
+        bottom, right = top + shape[0], left + shape[1]
+        images = [c for c in channels.values() if isinstance(c, np.ndarray) and c.shape != ()]
+        encoded = [c for c in channels.values() if isinstance(c, layers.ChannelImageData)]
+
+        start = time.perf_counter()
+        compression = self._image_compression()
+        if encoded:
+            compression = encoded[0].compression
+        elif self.compression == AUTO and images:
+            compression = choose_compression(images, self.header.depth, self.header.version)
+
+        fd = self.file
+        lengths, channel_bytes, locations = list(), dict(), list()
+        for channel_id in self.channel_ids:
+            # Missing color channels are black, missing transparency is opaque
+            image = channels.get(channel_id, -1 if channel_id == enums.ChannelId.transparency else 0)
+
+            if isinstance(image, np.ndarray) and image.shape != ():
+                channel_bytes[channel_id] = encode_channel(image, compression, self.header.depth,
+                                                           self.header.version)
+                image = encoded_channel(channel_bytes[channel_id], shape, compression, self.header.depth,
+                                        self.header.version)
+
+            if isinstance(image, layers.ChannelImageData):
+                data = image
+            else:
+                data = layers.ChannelImageData(image=image, compression=constant_compression(compression))
+
+            offset = fd.tell()
+            lengths.append(data.write(fd, self.header, shape))
+            # Data follows the compression value
+            locations.append([channel_id, data.compression, offset + 2, lengths[-1] - 2])
+
+        end = fd.tell()
+
+        if images:
+            log_layer_compression(record.name, compression, sum(i.nbytes for i in images), sum(lengths),
+                                  time.perf_counter() - start)
+
+        # Back-patch layer bounds and channel lengths
+        fd.seek(record_start)
+        util.write_value(fd, 'iiii', top, left, bottom, right)
+        fd.seek(record.channel_lengths_offset)
+        for channel_id, length in zip(self.channel_ids, lengths):
+            if self.header.version == enums.Version.psd:
+                util.write_value(fd, 'hI', channel_id, length)
+            else:
+                util.write_value(fd, 'hQ', channel_id, length)
+
+        fd.seek(end)
+        self.written_layer = PreviousLayer(fd, (top, left, bottom, right), locations, self.header.depth,
+                                           self.header.version)
+
+        return compression, channel_bytes
+
+    def _image_compression(self) -> int:
+        """ Compression of content without a per layer choice """
+        if self.compression == AUTO:
+            return enums.Compression.rle
+        return self.compression
+
+    @staticmethod
+    def layer_shape(channels: dict) -> Tuple[int, int]:
+        for channel in channels.values():
+            if not np.isscalar(channel) and channel.shape != ():
+                return tuple(channel.shape)
+
+        return 0, 0
+
+    def close(self) -> Path:
+        """ Write empty layers for missing records, back-patch section lengths and write image data """
+        while self.layer_count < len(self.records):
+            self.write_layer(nested_layers.Image())
+
+        fd = self.file
+        end = fd.tell()
+        self._write_length(self.layer_info_start, end)
+        self._write_length(self.layer_and_mask_info_start, end)
+        fd.seek(end)
+
+        # Empty merged image data like pytoshop
+        image_data.ImageData(compression=self._image_compression()).write(fd, self.header)
+
+        fd.close()
+        self.file, self.written_layer = None, None
+        LOGGER.debug('Closed Psd stream: %s', self.psd_file.name)
+
+        return self.psd_file
+
+    def discard(self):
+        """ Close and remove an incomplete Psd file """
+        if self.file is not None:
+            self.file.close()
+            self.file, self.written_layer = None, None
+
+        if self.psd_file.exists():
+            self.psd_file.unlink()
+            LOGGER.info('Removed incomplete Psd file: %s', self.psd_file.name)
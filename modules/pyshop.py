@@ -1,15 +1,31 @@
+import hashlib
+import math
+import mmap
+import os
+import time
+from collections import Counter
+from concurrent.futures import Executor
 from pathlib import Path
-from typing import Union, Tuple, List
+from typing import Dict, Union, Tuple, List
 
 import pytoshop
 import numpy as np
 from PIL import Image
 from imageio import imread
-from pytoshop.enums import ColorChannel, ColorMode
+from pytoshop import core, image_resources, layers, tagged_block
+from pytoshop.enums import ColorChannel, ColorDepth, ColorMode, Compression, ImageResourceID, Version
 from pytoshop.user import nested_layers
 
+from modules import band_decode, bit_depth
+from modules.cancel_token import Cancelled, CancelToken
 from modules.image_resize import Resize
+from modules.layer_cache import CachedLayer, LayerCache
+from modules.layer_spill import LayerSpill
 from modules.log import init_logging
+from modules.psd_encode import AUTO, LayerEncoder, encoded_bytes
+from modules.psd_manifest import PreviousLayer
+from modules.psd_writer import PsdStreamWriter
+from modules.stage_times import PipelineTimer
 
 LOGGER = init_logging(__name__)
 
@@ -36,6 +52,36 @@ class PyShop:
     # --- Resampling method ---
     default_resample_filter = Image.BICUBIC
 
+    # --- Resampling filters by setting name ---
+    resample_filters = {
+        'Bilinear': Image.BILINEAR,
+        'Hamming': Image.HAMMING,
+        'Bicubic': Image.BICUBIC,
+        'Lanczos': Image.LANCZOS,
+        }
+
+    # --- Image modes Pillow can pack band by band ---
+    band_pack_modes = ['RGB', 'RGBA', 'RGBX', 'CMYK']
+
+    # --- Channel compression by setting name, Auto picks a compression per layer ---
+    compression_methods = {
+        'Raw': Compression.raw,
+        'RLE': Compression.rle,
+        'ZIP': Compression.zip,
+        'ZIP Prediction': Compression.zip_prediction,
+        'Auto': AUTO,
+        }
+    default_compression = 'RLE'
+
+    # --- Let the JPEG decoder down scale images much larger than the psd size ---
+    jpeg_draft_decode = True
+
+    # --- Dither instead of round 16bit and floating point images loaded with imageio ---
+    dither_high_bit_depth = False
+
+    # --- Decode and down scale Png and Tiff images of at least this many pixels band by band ---
+    band_decode_pixels = 64 * 1048576
+
     def __init__(self,
                  target_size: Tuple[int, int]=(1920, 1080), resampling_filter=None, resize_mode=None
                  ):
@@ -44,6 +90,48 @@ class PyShop:
 
         self.group_id = 0
 
+        # --- Writer of a Psd file streamed layer by layer ---
+        self.psd_stream: Union[None, PsdStreamWriter] = None
+
+        # --- Number of processes compressing layer channels before the Psd file is written ---
+        self.encode_workers = 0
+        # Process pool shared with other jobs, used by the encode workers instead of their own processes
+        self.process_pool: Union[None, Executor] = None
+
+        # --- Compression of the layer channels ---
+        self.compression = self.compression_methods[self.default_compression]
+
+        # --- Store resized images at their size centered by the layer bounds instead of padding them ---
+        self.place_layers = False
+
+        # --- Crop fully transparent borders off layers with an alpha channel ---
+        self.trim_layers = False
+        # Pixels of all layers before and after trimming
+        self.untrimmed_pixels, self.trimmed_pixels = 0, 0
+
+        # --- Re-use the content of layers from the same image file or with identical channels ---
+        self.dedup_layers = False
+        # Added layer or it's channel data inside the Psd stream by file identity or channel digest
+        self._duplicates: Dict[Union[tuple, bytes], Union[nested_layers.Image, PreviousLayer]] = dict()
+        self.duplicate_count = 0
+
+        # --- Seconds spent per pipeline stage and file ---
+        self.timer = PipelineTimer()
+
+        # --- Cancellation request checked between and inside the stages of every file ---
+        self.cancel_token = CancelToken()
+
+        # --- Memory mapped scratch files for channel data exceeding the memory budget ---
+        self.spill: Union[None, LayerSpill] = None
+
+        # --- On disk cache of compressed layers ---
+        self.layer_cache: Union[None, LayerCache] = None
+        # Cache keys of layers missing in the cache by layer name, None if the name is not unique
+        self._cache_keys: Dict[str, Union[None, str]] = dict()
+
+        # --- Existing Psd file who's layer records and channel data are copied below all added layers ---
+        self.existing_psd: Union[None, core.PsdFile] = None
+
         # --- PSD Image Size ---
         self.size: Tuple[int, int] = self.default_img_size
         if target_size:
@@ -54,16 +142,37 @@ class PyShop:
         if resampling_filter:
             self.resample_filter = resampling_filter
 
+    def worker_copy(self) -> 'PyShop':
+        """ PyShop with the same layer settings creating layers eg. inside a LayerPipeline thread """
+        worker = PyShop(self.size, self.resample_filter)
+        worker.compression = self.compression
+        worker.place_layers = self.place_layers
+        worker.trim_layers = self.trim_layers
+        worker.dedup_layers = self.dedup_layers
+        worker.cancel_token = self.cancel_token
+
+        return worker
+
     @staticmethod
-    def _add_layers_from_existing_psd(psd_file_obj) -> List[nested_layers.Layer]:
-        """ Create List of Layers from opened PsdFile file object """
-        existing_psd = pytoshop.read(psd_file_obj)
+    def _add_layers_from_existing_psd(existing_psd: core.PsdFile) -> List[nested_layers.Layer]:
+        """ Create List of Layers from a read PsdFile, decodes the channel data of all layers """
         existing_layers = nested_layers.psd_to_nested_layers(existing_psd)
 
         return existing_layers
 
+    @classmethod
+    def _can_copy_existing_layers(cls, existing_psd: core.PsdFile) -> bool:
+        """ Channel data can only be copied as is into a Psd file of the same version, depth and color mode """
+        return (existing_psd.version == Version.psd and existing_psd.depth == ColorDepth.depth8
+                and existing_psd.color_mode == cls.color_mode)
+
     def _resize_image(self, pil_img: Image):
         """ Resize Layer content image to psd instance size if necessary """
+        if self.place_layers:
+            # Layer bounds center the image inside the psd
+            pil_img.thumbnail(self.size, self.resample_filter)
+            return pil_img
+
         if pil_img.size != self.size:
             return Resize.resize_contain(pil_img, self.size, resample=self.resample_filter,
                                          bg_color=(0, 0, 0, 0)
@@ -71,8 +180,37 @@ class PyShop:
 
         return pil_img
 
-    @staticmethod
-    def _open_with_imageio(file: Path) -> Union[None, Image.Image]:
+    def _draft_jpeg(self, img: Image.Image):
+        """ Decode JPEG images at the smallest power of two DCT scale
+            that still covers the size the image will be contained in.
+        """
+        if not self.jpeg_draft_decode or img.format != 'JPEG':
+            return
+
+        width, height = img.size
+        ratio = min(self.size[0] / width, self.size[1] / height)
+
+        if ratio > 0.5:
+            # Decoder can not reduce by at least half
+            return
+
+        contain_size = (max(1, math.ceil(width * ratio)), max(1, math.ceil(height * ratio)))
+        img.draft(None, contain_size)
+        scale = width // img.size[0]
+
+        if scale <= 1:
+            return
+
+        start = time.perf_counter()
+        img.load()
+        decode_time = time.perf_counter() - start
+
+        # Decoding work shrinks roughly with the number of decoded pixels
+        LOGGER.info('Decoded JPEG at 1/%s scale %sx%s -> %sx%s in %.1fms, estimated %.1fms decode time saved.',
+                    scale, width, height, *img.size, decode_time * 1000, decode_time * (scale ** 2 - 1) * 1000)
+
+    @classmethod
+    def _open_with_imageio(cls, file: Path) -> Union[None, Image.Image]:
         """ Open image files failed in Pillow with imageio """
         try:
             LOGGER.info('Loading image file with imageio.')
@@ -81,13 +219,8 @@ class PyShop:
             LOGGER.error(e)
             return None
 
-        # Convert none 8bit depth images
-        if img.dtype == np.float32:
-            # Convert 32bit float images to 8bit integer
-            img = np.uint8(img * 255)
-        elif img.dtype == np.uint16:
-            # Convert 16bit integer[0 - 65535] to 8bit integer [0-255]
-            img = np.uint8(img / 256)
+        # Convert 16bit integer [0-65535] and floating point [0-1] images to 8bit integer [0-255]
+        img = bit_depth.to_uint8(img, cls.dither_high_bit_depth)
 
         return Image.fromarray(img)
 
@@ -107,44 +240,149 @@ class PyShop:
 
         return img
 
-    def _load_image_to_numpy_channels(self, image_file: Path):
-        """ Open Image file with Pillow and create list containing each channel as NumPy array """
-        with open(image_file.as_posix(), 'rb') as f:
-            img = self._open_image(f, image_file)
+    def _decode_image(self, fb, image_file: Path) -> Image.Image:
+        """ Decode and resize an image file to the psd instance size """
+        name = image_file.stem
+        self.cancel_token.check()
+
+        with self.timer.stage('decode', name):
+            img = self._open_image(fb, image_file)
 
+            # Decode large JPEGs at reduced resolution
+            self._draft_jpeg(img)
+            img.load()
+
+        self.cancel_token.check()
+        with self.timer.stage('resize', name):
             # Resize image with Pillow if necessary
             img = self._resize_image(img)
 
+        return img
+
+    def _band_decode_image(self, fb, image_file: Path) -> Union[None, Image.Image]:
+        """ Decode and down scale very large Png and Tiff images band by band so the
+            full resolution image is never held in memory.
+        """
+        if not self.band_decode_pixels:
+            return None
+
+        decoder = band_decode.open_band_decoder(fb, self.band_decode_pixels)
+        if decoder is None:
+            return None
+        decoder.cancel_token = self.cancel_token
+
+        try:
+            with self.timer.stage('decode', image_file.stem):
+                if self.place_layers:
+                    return band_decode.resize_thumbnail(decoder, self.size, self.resample_filter)
+                return band_decode.resize_contain(decoder, self.size, self.resample_filter)
+        except Cancelled:
+            raise
+        except Exception as e:
+            LOGGER.error('Could not decode %s in bands: %s', image_file.name, e)
+
+        fb.seek(0)
+        return None
+
+    def _load_image_to_numpy_channels(self, image_file: Path, fb=None):
+        """ Open Image file with Pillow and create list containing each channel as NumPy array
+
+        :param image_file: Image file to decode
+        :param fb: File object holding the content of the image file eg. read ahead into a BytesIO,
+                   the image file gets opened if not set
+        """
+        if fb is None:
+            with open(image_file.as_posix(), 'rb') as f:
+                return self._file_to_numpy_channels(f, image_file)
+
+        return self._file_to_numpy_channels(fb, image_file)
+
+    def _file_to_numpy_channels(self, f, image_file: Path) -> List[np.ndarray]:
+        name = image_file.stem
+        img = self._band_decode_image(f, image_file) or self._decode_image(f, image_file)
+
+        self.cancel_token.check()
+        with self.timer.stage('split', name):
             # Convert to RGBA
             if img.mode == 'P':
                 img = img.convert('RGBA')
-
-            # Convert Image to NumPy array
-            img_np = np.array(img)
-
-            # Get number of channels
-            img_channel_num = 0
-            if len(img_np.shape) > 2:
-                img_channel_num = img_np.shape[2]
+            elif self.place_layers and img.mode not in ('RGB', 'RGBA'):
+                # Not pasted onto a RGBA background by resize_contain
+                has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+                img = img.convert('RGBA' if has_alpha else 'RGB')
 
             # Create list of image channels
             # len(3) - R G B
             # len(4) - R G B A
-            img_channels = list()
-            for c in range(0, img_channel_num):
-                img_channels.append(img_np[..., c])
+            img_channels = self._split_channels(img)
 
-        del img, f
+        del img
 
         return img_channels
 
-    def _layer_from_image(self, image_file: Path) -> nested_layers.Layer:
-        """ Open an Image as NumPy Array and create a new pytoshop Layer object """
-        img_channels = self._load_image_to_numpy_channels(image_file)
+    def _split_channels(self, img: Image.Image) -> List[np.ndarray]:
+        """ Create a C-contiguous 8bit NumPy plane for every band of a multi band image.
+
+            Pillow's raw encoder packs a single band straight into it's own bytes buffer
+            which NumPy wraps without copying. So every plane is copied exactly once instead
+            of copying the interleaved image and handing strided views to pytoshop.
+
+            A fully opaque alpha band is left out, the layer gets a constant transparency channel.
+        """
+        bands = img.getbands()
+
+        # Single band images do not provide color channels
+        if len(bands) < 2:
+            return list()
+
+        width, height = img.size
+        img_channels = list()
+
+        for idx, band in enumerate(bands):
+            if img.mode in self.band_pack_modes:
+                data = img.tobytes('raw', band)
+            else:
+                data = img.getchannel(idx).tobytes()
+
+            plane = np.frombuffer(data, dtype=np.uint8).reshape(height, width)
+
+            if band == 'A' and plane.min() == 255:
+                LOGGER.debug('Skipping fully opaque alpha channel.')
+                continue
+
+            img_channels.append(plane)
+
+        return img_channels
+
+    def _position_channels(self, name: str, img_channels: List[np.ndarray]
+                           ) -> Tuple[List[np.ndarray], int, int]:
+        """ Position of the channels inside the psd, trimmed if trim_layers is set
+
+        :returns: (channels, top, left)
+        """
+        # Images smaller than the psd are centered
+        left, top = 0, 0
+        if img_channels:
+            height, width = img_channels[0].shape
+            left, top = Resize.contain_position((width, height), self.size)
+
+        if self.trim_layers:
+            with self.timer.stage('trim', name):
+                img_channels, top, left = self._trim_channels(img_channels, top, left)
+
+        return img_channels, top, left
+
+    def _layer_from_channels(self, name: str, img_channels: List[np.ndarray], top: int, left: int
+                             ) -> nested_layers.Layer:
+        """ Create a new pytoshop Layer object from a list of NumPy image channels """
+        if self.spill is not None:
+            img_channels = [self.spill.store(c) for c in img_channels]
 
         # Create an empty layer
         layer = nested_layers.Image(
-            name=image_file.stem,
+            name=name,
+            top=top,
+            left=left,
             color_mode=self.color_mode,
             )
 
@@ -156,20 +394,329 @@ class PyShop:
 
         return layer
 
+    def _trim_channels(self, img_channels: List[np.ndarray], top: int, left: int
+                       ) -> Tuple[List[np.ndarray], int, int]:
+        """ Crop the channels to the bounding box of all pixels with non-zero alpha
+
+        :returns: (cropped channels, top, left of the cropped channels)
+        """
+        if not img_channels:
+            return img_channels, top, left
+
+        height, width = img_channels[0].shape
+        self.untrimmed_pixels += height * width
+
+        if len(img_channels) < 4:
+            # Opaque layer
+            self.trimmed_pixels += height * width
+            return img_channels, top, left
+
+        alpha = img_channels[3]
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if not rows.size:
+            # Fully transparent layers are written without content
+            return img_channels, top, left
+
+        y0, y1 = int(rows[0]), int(rows[-1]) + 1
+        columns = np.flatnonzero(alpha[y0:y1].any(axis=0))
+        x0, x1 = int(columns[0]), int(columns[-1]) + 1
+        self.trimmed_pixels += (y1 - y0) * (x1 - x0)
+
+        if (y1 - y0, x1 - x0) == (height, width):
+            return img_channels, top, left
+
+        img_channels = [np.ascontiguousarray(c[y0:y1, x0:x1]) for c in img_channels]
+        return img_channels, top + y0, left + x0
+
+    @property
+    def trimmed_percent(self) -> float:
+        """ Percentage of layer pixels removed by trimming """
+        if not self.untrimmed_pixels:
+            return 0.0
+        return 100.0 * (1.0 - self.trimmed_pixels / self.untrimmed_pixels)
+
+    @classmethod
+    def is_supported_file(cls, image_file: Union[Path, str]) -> bool:
+        """ Test if image exists and is supported """
+        image_file = Path(image_file)
+
+        if not image_file.exists() or image_file.suffix.casefold() not in cls.supported_img:
+            LOGGER.info('Skipping non-existent or unsupported file: %s', image_file.name)
+            return False
+
+        return True
+
     def add_image_as_layer(self, image_file: Union[Path, str]):
         """ Append an image to the PSD file """
         image_file = Path(image_file)
 
-        # Test if image exists and is supported
-        if not image_file.exists() or image_file.suffix.casefold() not in self.supported_img:
-            LOGGER.info('Skipping non-existent or unsupported file: %s', image_file.name)
+        if not self.is_supported_file(image_file):
             return False
 
-        new_layer = self._layer_from_image(image_file)
-        self.layer_ls.insert(0, new_layer)
+        file_key = self.file_key(image_file)
+        if self.add_duplicate_layer(image_file.stem, file_key):
+            return True
+
+        cached = self.cached_layer(image_file)
+        if cached is not None:
+            self.add_cached_layer(image_file.stem, cached, file_key)
+            return True
+
+        img_channels = self._load_image_to_numpy_channels(image_file)
+
+        return self.add_channels_as_layer(image_file.stem, img_channels, file_key=file_key)
+
+    def add_channels_as_layer(self, name: str, img_channels: List[np.ndarray], stage_seconds: dict=None,
+                              file_key: Union[None, tuple]=None):
+        """ Append already decoded image channels eg. from a LayerDecodePool to the PSD file
+
+        :param name: Layer name
+        :param img_channels: Channel planes in R G B (A) order
+        :param stage_seconds: Seconds spent decoding the channels per stage, eg. inside a worker process
+        :param file_key: Identity of the decoded image file, see file_key
+        """
+        if stage_seconds:
+            self.timer.update(stage_seconds, name)
+
+        img_channels, top, left = self._position_channels(name, img_channels)
+
+        digest = None
+        if self.dedup_layers and img_channels:
+            with self.timer.stage('dedup', name):
+                digest = self._channels_digest(img_channels, top, left)
+
+            if self.add_duplicate_layer(name, digest):
+                if file_key is not None:
+                    self._duplicates[file_key] = self._duplicates[digest]
+                return True
+
+        new_layer = self._layer_from_channels(name, img_channels, top, left)
+        self._add_layer(new_layer, (file_key, digest))
+
+        return True
+
+    def file_key(self, image_file: Union[Path, str]) -> Union[None, tuple]:
+        """ Identity of an image file, the same for every path of an unchanged file. None if
+            dedup_layers is not set or the file system does not provide file identities.
+        """
+        if not self.dedup_layers:
+            return None
+
+        try:
+            stat = Path(image_file).stat()
+        except OSError:
+            return None
+
+        if not stat.st_ino:
+            return None
+
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    @staticmethod
+    def _channels_digest(img_channels: List[np.ndarray], top: int, left: int) -> bytes:
+        """ Digest of the channel data and position of a layer """
+        h = hashlib.blake2b(digest_size=20)
+        h.update(f'{top},{left},{len(img_channels)},{img_channels[0].shape}'.encode('utf-8'))
+
+        for channel in img_channels:
+            h.update(np.ascontiguousarray(channel).data)
+
+        return h.digest()
+
+    def add_duplicate_layer(self, name: str, key: Union[None, tuple, bytes]) -> bool:
+        """ Append a layer re-using the content of an added layer of the same file identity or channel digest
+
+        :returns: False if no layer of this key was added
+        """
+        source = self._duplicates.get(key) if key is not None else None
+        if source is None:
+            return False
+
+        LOGGER.debug('Re-using layer content for duplicate layer %s', name)
+        self.duplicate_count += 1
+
+        if isinstance(source, PreviousLayer):
+            # Copy the channel data already written to the Psd stream
+            return self.add_cached_layer(name, source)
+
+        # Share the channels, the LayerEncoder compresses them once
+        new_layer = nested_layers.Image(
+            name=name, top=source.top, left=source.left, bottom=source.bottom, right=source.right,
+            channels=dict(source.channels), color_mode=self.color_mode
+            )
+        self._add_layer(new_layer)
+
+        return True
+
+    def layer_settings(self) -> list:
+        """ Settings changing the content of a layer created from an image file """
+        return [list(self.size), int(self.resample_filter), int(self.compression), self.jpeg_draft_decode,
+                self.dither_high_bit_depth, self.place_layers, self.trim_layers]
+
+    def cached_layer(self, image_file: Union[Path, str]) -> Union[None, CachedLayer]:
+        """ Look up the compressed layer of an image file in the layer cache,
+            a missing layer gets stored once it has been compressed.
+        """
+        if self.layer_cache is None:
+            return None
+
+        image_file = Path(image_file)
+        name = image_file.stem
+
+        with self.timer.stage('decode', name):
+            key = self.layer_cache.key(image_file, *self.layer_settings())
+            cached = self.layer_cache.get(key)
+
+        if cached is None and key is not None:
+            # Compressed layers are matched by name, do not cache layers of the same name
+            self._cache_keys[name] = None if name in self._cache_keys else key
+
+        return cached
+
+    def add_cached_layer(self, name: str, cached: Union[CachedLayer, PreviousLayer], file_key: tuple=None):
+        """ Append a layer from the layer cache or a previous Psd file,
+            it's channels are written without decoding or compressing.
+        """
+        top, left, bottom, right = cached.bounds
+        new_layer = nested_layers.Image(
+            name=name, top=top, left=left, bottom=bottom, right=right,
+            channels=cached.channel_data(), color_mode=self.color_mode
+            )
+        self._add_layer(new_layer, (file_key,))
+
+        return True
+
+    def add_encoded_layer(self, name: str, encoded: Union[None, CachedLayer], stage_seconds: dict=None,
+                          digest: Union[None, bytes]=None, file_key: Union[None, tuple]=None):
+        """ Append a layer positioned and compressed outside of this instance eg. by a LayerPipeline
+
+        :param name: Layer name
+        :param encoded: Compressed channels and bounds of the layer, None if it duplicates the layer of digest
+        :param stage_seconds: Seconds spent creating the layer per stage
+        :param digest: Channel digest of the layer, see _channels_digest
+        :param file_key: Identity of the decoded image file, see file_key
+        """
+        if stage_seconds:
+            self.timer.update(stage_seconds, name)
+
+        if self.add_duplicate_layer(name, digest):
+            if file_key is not None:
+                self._duplicates[file_key] = self._duplicates[digest]
+            return True
+
+        if encoded is None:
+            raise ValueError(f'Layer {name} duplicates a layer that was not added.')
+
+        # Compressed channels are not returned by the Psd stream, store them upfront
+        self._store_cached_layer(name, encoded.compression, encoded.bounds, encoded.channels)
+
+        top, left, bottom, right = encoded.bounds
+        new_layer = nested_layers.Image(
+            name=name, top=top, left=left, bottom=bottom, right=right,
+            channels=encoded.channel_data(), color_mode=self.color_mode
+            )
+        self._add_layer(new_layer, (file_key, digest))
 
         return True
 
+    def _store_cached_layer(self, name: str, compression: int, bounds: Tuple[int, int, int, int],
+                            channels: Dict[int, bytes]):
+        if self.layer_cache is None or not channels:
+            return
+
+        key = self._cache_keys.pop(name, None)
+        if key is None:
+            return
+
+        with self.timer.stage('write', name):
+            self.layer_cache.put(key, CachedLayer(compression, bounds, channels))
+
+    def _store_cached_layers(self, psd: pytoshop.core.PsdFile):
+        """ Store the compressed layers of a PsdFile missing in the layer cache """
+        if self.layer_cache is None:
+            return
+
+        records = psd.layer_and_mask_info.layer_info.layer_records
+        names = Counter(record.name for record in records)
+
+        for record in records:
+            if names[record.name] > 1:
+                continue
+
+            channels, compression = dict(), None
+            for channel_id, data in record.channels.items():
+                channel_bytes = encoded_bytes(data)
+                if channel_bytes is not None:
+                    channels[channel_id], compression = channel_bytes, data.compression
+
+            bounds = (record.top, record.left, record.bottom, record.right)
+            self._store_cached_layer(record.name, compression, bounds, channels)
+
+    def _add_layer(self, layer: nested_layers.Layer, duplicate_keys: tuple=()):
+        """ Add a layer, duplicates of any of the duplicate keys re-use it's content """
+        if self.psd_stream is not None:
+            # Write the layer right away and drop it's pixel data
+            self.cancel_token.check()
+            with self.timer.stage('compress', layer.name):
+                compression, channels = self.psd_stream.write_layer(layer)
+
+            height, width = self.psd_stream.layer_shape(layer.channels)
+            bounds = (layer.top, layer.left, layer.top + height, layer.left + width)
+            self._store_cached_layer(layer.name, compression, bounds, channels)
+            source = self.psd_stream.written_layer
+        else:
+            self.layer_ls.insert(0, layer)
+            source = layer
+
+        if self.dedup_layers:
+            for key in duplicate_keys:
+                if key is not None:
+                    self._duplicates[key] = source
+
+    def stream_psd(self, psd_file: Union[Path, str], layer_names: List[str]):
+        """ Write every added layer directly to the Psd file instead of keeping it in memory.
+
+        :param psd_file: Path to the Psd file to create
+        :param layer_names: Names of all layers that will be added, in the order they will be added
+        """
+        self.psd_stream = PsdStreamWriter(psd_file, self.size, layer_names, self.compression)
+        self.psd_stream.open()
+
+    def spill_to_disk(self, budget: int, scratch_dir: Union[Path, str, None]=None):
+        """ Keep channel data of added layers in memory mapped scratch files once the budget is used up.
+
+        :param budget: Bytes of channel data to keep in memory
+        :param scratch_dir: Directory for the scratch files, system temp directory if not set
+        """
+        self.spill = LayerSpill(budget, scratch_dir)
+
+    def cleanup(self):
+        """ Release all layers and remove scratch files, call when the job finished or was aborted """
+        self.layer_ls = list()
+        self._cache_keys = dict()
+        self._duplicates = dict()
+
+        if self.spill is not None:
+            self.spill.cleanup()
+
+        if self.layer_cache is not None:
+            self.layer_cache.save()
+
+    def discard_psd_stream(self):
+        """ Remove the incomplete file of an aborted Psd stream """
+        if self.psd_stream is not None:
+            self.psd_stream.discard()
+            self.psd_stream = None
+
+    @staticmethod
+    def _remove_partial_file(file: Path):
+        try:
+            if file.exists():
+                file.unlink()
+                LOGGER.info('Removed partially written file %s', file.name)
+        except OSError as e:
+            LOGGER.error('Could not remove partially written file %s: %s', file.name, e)
+
     def create_psd_from_existing(self, existing_psd_file: Union[Path, str], psd_file: Union[Path, str]) -> str:
         """ Create PSD keeping all layers of an existing PSD file.
 
@@ -183,40 +730,136 @@ class PyShop:
         if not existing_psd_file.exists() or existing_psd_file.suffix.casefold() != '.psd':
             return 'Existing PSD file does not exists.'
 
-        existing_psd = open(existing_psd_file, 'rb')
-        self.layer_ls += self._add_layers_from_existing_psd(existing_psd)
+        # The existing file stays mapped while writing, replace it once the new file is complete
+        out_file = psd_file
+        if psd_file.exists() and psd_file.resolve() == existing_psd_file.resolve():
+            out_file = psd_file.with_suffix('.tmp.psd')
+
+        # Only layer records get parsed, channel data is read from the mapped file while writing
+        with open(existing_psd_file, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as existing:
+            existing_psd = pytoshop.read(existing)
 
-        out_psd_file = self.create_psd(psd_file)
-        existing_psd.close()
+            if self._can_copy_existing_layers(existing_psd):
+                self.existing_psd = existing_psd
+            else:
+                LOGGER.info('Decoding all layers of %s, it\'s channel data can not be copied.', existing_psd_file.name)
+                self.layer_ls += self._add_layers_from_existing_psd(existing_psd)
+
+            out_psd_file = self.create_psd(out_file)
+            self.existing_psd = None
+            del existing_psd
+
+        if out_file != psd_file and out_file.exists():
+            os.replace(out_file, psd_file)
+            out_psd_file = psd_file.as_posix()
 
         return out_psd_file
 
+    def _empty_psd(self, compression: int) -> core.PsdFile:
+        """ PsdFile without layers, like nested_layers_to_psd creates them """
+        return core.PsdFile(
+            version=Version.psd, num_channels=3, width=self.size[0], height=self.size[1], depth=ColorDepth.depth8,
+            color_mode=self.color_mode,
+            layer_and_mask_info=layers.LayerAndMaskInfo(layer_info=layers.LayerInfo(layer_records=[])),
+            image_resources=image_resources.ImageResources(blocks=[image_resources.LayersGroupInfo(group_ids=[])]),
+            compression=compression
+            )
+
+    def _add_existing_layers(self, psd: core.PsdFile):
+        """ Put the layer records of the existing Psd file below the layers of psd. Their channel
+            data stays compressed and gets copied byte for byte when psd is written.
+        """
+        existing_records = self.existing_psd.layer_and_mask_info.layer_info.layer_records
+        existing_group_info = self.existing_psd.image_resources.get_block(ImageResourceID.layers_group_info)
+        existing_group_ids = [0] * len(existing_records)
+        if existing_group_info is not None and len(existing_group_info.group_ids) == len(existing_records):
+            existing_group_ids = list(existing_group_info.group_ids)
+
+        # Layer ids of the added layers continue after the existing layer ids
+        existing_ids = [b.id for r in existing_records for b in r.blocks if isinstance(b, tagged_block.LayerId)]
+        next_id = max(existing_ids, default=-1) + 1
+
+        records = psd.layer_and_mask_info.layer_info.layer_records
+        for block in (b for r in records for b in r.blocks if isinstance(b, tagged_block.LayerId)):
+            block.id += next_id
+
+        # Records are stored bottom to top
+        psd.layer_and_mask_info.layer_info.layer_records = existing_records + records
+
+        group_info = psd.image_resources.get_block(ImageResourceID.layers_group_info)
+        group_info.group_ids = existing_group_ids + list(group_info.group_ids)
+
+        LOGGER.info('Copying %s layers of existing Psd file without decoding them.', len(existing_records))
+
+    def _encode_upfront(self) -> bool:
+        """ Compress layers before writing in worker processes, to pick the Auto compression per layer
+            or to store them in the layer cache. Compressed copies of all layers are kept until written.
+        """
+        return self.encode_workers > 1 or self.compression == AUTO or self.layer_cache is not None
+
     def create_psd(self, psd_file: Union[Path, str]) -> str:
         """ Create PSD file at provided path containing all layers previously added to this instance.
 
         :param psd_file: Path to the Psd file to create
         :return: Path of the created file or error message.
         """
-        if not self.layer_ls:
+        if self.psd_stream is not None:
+            # Layers have already been written, finish the file opened by stream_psd
+            with self.timer.stage('write'):
+                psd_file = self.psd_stream.close()
+            self.psd_stream = None
+            return psd_file.as_posix()
+
+        if not self.layer_ls and self.existing_psd is None:
             return 'Can not create PSD file without layer content.'
 
         psd_file = Path(psd_file)
 
         nested_layers.pprint_layers(self.layer_ls)
 
-        psd_stacked = nested_layers.nested_layers_to_psd(
-            layers=self.layer_ls,
-            color_mode=ColorMode.rgb,
-            version=pytoshop.enums.Version.psd,
-            compression=pytoshop.enums.Compression.rle,
-            size=self.size
-            )
-
-        try:
-            # TODO: Alternative location when write only location
-            with open(psd_file, 'wb') as file:
-                psd_stacked.write(file)
-        except Exception as e:
-            LOGGER.error('Error writing Photoshop file: %s', e)
+        # Layers get their compression from the LayerEncoder in Auto mode
+        compression = self.compression
+        if compression == AUTO:
+            compression = Compression.rle
+
+        with self.timer.stage('write'):
+            if self.layer_ls:
+                psd_stacked = nested_layers.nested_layers_to_psd(
+                    layers=self.layer_ls,
+                    color_mode=ColorMode.rgb,
+                    version=pytoshop.enums.Version.psd,
+                    compression=compression,
+                    size=self.size
+                    )
+            else:
+                psd_stacked = self._empty_psd(compression)
+
+            if self.existing_psd is not None:
+                self._add_existing_layers(psd_stacked)
+
+        if self._encode_upfront():
+            # The records hold the only references to the channel arrays,
+            # every layer's arrays get released once it is compressed.
+            self.layer_ls, self._duplicates = list(), dict()
+
+            encoder = LayerEncoder(self.encode_workers, self.compression, self.process_pool, self.cancel_token)
+            encoder.encode(psd_stacked)
+            for name, seconds in encoder.layer_seconds:
+                self.timer.add('compress', seconds, name)
+
+            self._store_cached_layers(psd_stacked)
+        else:
+            # pytoshop compresses every channel while writing it
+            LayerEncoder.match_constant_channels(psd_stacked)
+
+        self.cancel_token.check()
+        with self.timer.stage('write'):
+            try:
+                # TODO: Alternative location when write only location
+                with open(psd_file, 'wb') as file:
+                    psd_stacked.write(file)
+            except Exception as e:
+                LOGGER.error('Error writing Photoshop file: %s', e)
+                self._remove_partial_file(psd_file)
 
         return psd_file.as_posix()
@@ -0,0 +1,466 @@
+import os
+import time
+from collections import Counter
+from concurrent.futures import Executor
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+from typing import Callable, Dict, List, Sequence, Set, Union
+
+from modules import AppSettings
+from modules.cancel_token import Cancelled, CancelToken
+from modules.detect_language import get_translation
+from modules.layer_cache import LayerCache
+from modules.layer_pipeline import LayerPipeline
+from modules.layer_pool import LayerDecodePool
+from modules.log import init_logging
+from modules.psd_manifest import PreviousLayer, PsdManifest
+from modules.pyshop import PyShop
+from modules.read_ahead import ReadAhead
+from modules.stage_times import StageTimes
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class PsdJob:
+    """ Creates one layered Psd file from a list of image files.
+
+        Holds everything CreateLayeredPsdThread does without depending on Qt,
+        so jobs can run headless eg. from the command line.
+    """
+    counter = 0
+    psd_base_name = _('Dateien')
+    psd_name_suffix = _('Stapel')
+
+    # Psd files picked by running jobs but not written yet, concurrent jobs must not pick the same name
+    reserved_psd_files: Set[Path] = set()
+    reserved_lock = Lock()
+
+    def __init__(self, files: List[Path], size=PyShop.default_img_size, resample_filter=None,
+                 compression=None, pool_size: int=0, encode_pool_size: int=0, stream_psd: bool=False,
+                 memory_budget: int=0, scratch_dir: Union[Path, str]='', layer_cache_size: int=0,
+                 incremental: bool=False, place_layers: bool=False, trim_layers: bool=False,
+                 dedup_layers: bool=False, decode_threads: int=0, encode_threads: int=1,
+                 queue_depths: Sequence[int]=LayerPipeline.default_queue_depths, read_ahead_files: int=0,
+                 read_requests: int=4, psd_file: Union[None, Path]=None):
+        """
+        :param files: Image files, every file becomes a layer
+        :param size: Size of the Psd file
+        :param resample_filter: Pillow resampling filter
+        :param compression: Compression of the layer channels, see PyShop.compression_methods
+        :param pool_size: Number of processes decoding image files
+        :param encode_pool_size: Number of processes compressing layers
+        :param stream_psd: Write layers to the Psd file as soon as they are decoded
+        :param memory_budget: Bytes of channel data kept in memory, 0 keeps everything in memory
+        :param scratch_dir: Directory for scratch files of the memory budget
+        :param layer_cache_size: Bytes of compressed layers kept in the layer cache, 0 disables the cache
+        :param incremental: Copy layers of unchanged files from a previously created Psd file and
+                            write a manifest next to the created Psd file
+        :param place_layers: Store resized images at their size centered by the layer bounds
+        :param trim_layers: Crop fully transparent borders off layers
+        :param dedup_layers: Re-use the layer content of identical image files and decoded images
+        :param decode_threads: Number of threads decoding image files in a LayerPipeline, 0 disables the pipeline
+        :param encode_threads: Number of threads compressing layers in the LayerPipeline
+        :param queue_depths: Files read ahead, decoded and compressed layers waiting inside the LayerPipeline
+        :param read_ahead_files: Files read into memory ahead of decoding eg. from a network share, 0 disables it
+        :param read_requests: Files read ahead concurrently
+        :param psd_file: Psd file to create, a unique name next to the image files if not set
+        """
+        self.files = files
+        # Cancellation request checked between files and inside the stages of a file
+        self.cancel_token = CancelToken()
+
+        self.size = size
+        self.resample_filter = resample_filter or PyShop.default_resample_filter
+        self.compression = compression
+        if self.compression is None:
+            self.compression = PyShop.compression_methods[PyShop.default_compression]
+
+        self.pool_size = pool_size
+        self.encode_pool_size = encode_pool_size
+        self.stream_psd = stream_psd
+        self.memory_budget = memory_budget
+        self.scratch_dir = scratch_dir
+        self.layer_cache_size = layer_cache_size
+        self.incremental = incremental
+        self.place_layers = place_layers
+        self.trim_layers = trim_layers
+        self.dedup_layers = dedup_layers
+        self.decode_threads = decode_threads
+        self.encode_threads = encode_threads
+        self.queue_depths = queue_depths
+        self.read_ahead_files = read_ahead_files
+        self.read_requests = read_requests
+        self.psd_file = psd_file
+
+        # Process pool shared by the jobs of a JobScheduler, used instead of creating pool processes per job
+        self.process_pool: Union[None, Executor] = None
+        # Psd file name reserved by this job
+        self._reserved: Union[None, Path] = None
+
+        # Per file and per job timing records of the finished job
+        self.timings: dict = dict()
+        # Depth, fill and wait times of the LayerPipeline queues
+        self.queue_stats: Dict[str, dict] = dict()
+
+        if files:
+            self.current_dir = files[0].parent
+        else:
+            self.current_dir = Path('.')
+
+    @classmethod
+    def from_settings(cls, files: List[Path]):
+        """ Create a job with a frozen copy of the current application settings,
+            settings changed while the job is queued or running do not affect it.
+        """
+        return cls(
+            list(files),
+            size=tuple(AppSettings.app['psd_size']),
+            resample_filter=PyShop.resample_filters.get(AppSettings.app['resampling_filter']),
+            compression=PyShop.compression_methods.get(AppSettings.app['compression']),
+            pool_size=AppSettings.app['process_pool_size'],
+            encode_pool_size=AppSettings.app['encode_pool_size'],
+            stream_psd=AppSettings.app['stream_psd'],
+            memory_budget=AppSettings.app['memory_budget_mb'] * 1048576,
+            scratch_dir=AppSettings.app['scratch_dir'],
+            layer_cache_size=AppSettings.app['layer_cache_mb'] * 1048576,
+            incremental=AppSettings.app['incremental_export'],
+            place_layers=AppSettings.app['layer_placement'],
+            trim_layers=AppSettings.app['trim_layers'],
+            dedup_layers=AppSettings.app['dedup_layers'],
+            decode_threads=AppSettings.app['pipeline_decode_threads'],
+            encode_threads=AppSettings.app['pipeline_encode_threads'],
+            queue_depths=tuple(AppSettings.app['pipeline_queue_depths']),
+            read_ahead_files=AppSettings.app['read_ahead_files'],
+            read_requests=AppSettings.app['read_ahead_requests'],
+            )
+
+    @property
+    def abort(self) -> bool:
+        return self.cancel_token.is_cancelled
+
+    @abort.setter
+    def abort(self, value: bool):
+        """ Aborting cancels the job inside the running stages, it can not be resumed """
+        if value:
+            self.cancel_token.cancel()
+
+    def run(self, progress_step: Callable=None) -> Union[None, Path]:
+        """ Create the Psd file
+
+        :param progress_step: Called before every file is added as layer
+        :returns: Path of the created Psd file or None if the job was aborted
+        """
+        if not self.files:
+            return None
+
+        try:
+            return self._run(progress_step)
+        finally:
+            self._release_psd_path()
+
+    def _run(self, progress_step: Callable=None) -> Union[None, Path]:
+
+        start = time.perf_counter()
+        pyshop = PyShop(self.size, self.resample_filter)
+        pyshop.encode_workers = self.encode_pool_size
+        pyshop.process_pool = self.process_pool
+        pyshop.compression = self.compression
+        pyshop.place_layers = self.place_layers
+        pyshop.trim_layers = self.trim_layers
+        pyshop.dedup_layers = self.dedup_layers
+        pyshop.cancel_token = self.cancel_token
+        if self.layer_cache_size:
+            pyshop.layer_cache = LayerCache.open(self.layer_cache_size)
+        files = [f for f in reversed(sorted(self.files)) if pyshop.is_supported_file(f)]
+
+        previous, psd_file, temp_file = None, self.psd_file, None
+        try:
+            previous = self._find_previous_psd(pyshop, files)
+            previous_layers = previous.open_layers(files) if previous else dict()
+            if previous_layers:
+                LOGGER.info('Copying %s of %s layers from previous Psd file %s', len(previous_layers), len(files),
+                            previous.psd_file.name)
+
+            if previous_layers and psd_file and Path(psd_file).resolve() == previous.psd_file.resolve():
+                # Layers are copied from the file that gets replaced, write to a temporary file first
+                psd_file = temp_file = Path(psd_file).with_suffix('.tmp.psd')
+
+            if self.stream_psd:
+                # Layers are written to the Psd file as soon as they are decoded
+                psd_file = psd_file or self._create_psd_path()
+                pyshop.stream_psd(psd_file, [f.stem for f in files])
+            elif self.memory_budget:
+                # Spill decoded layers to scratch files once the budget is used up
+                pyshop.spill_to_disk(self.memory_budget, self.scratch_dir)
+
+            if self.pool_size > 1 and LayerDecodePool.available():
+                self._add_layers_with_pool(pyshop, files, previous_layers, progress_step)
+            elif self.decode_threads > 0:
+                self._add_layers_with_pipeline(pyshop, files, previous_layers, progress_step)
+            elif self.read_ahead_files > 0:
+                self._add_layers_with_read_ahead(pyshop, files, previous_layers, progress_step)
+            else:
+                self._add_layers(pyshop, files, previous_layers, progress_step)
+            self.cancel_token.check()
+
+            if not self.stream_psd:
+                psd_file = psd_file or self._create_psd_path()
+
+            pyshop.create_psd(psd_file=psd_file)
+        except Exception as e:
+            self._remove_partial_files(pyshop, temp_file)
+            if not self.abort:
+                raise
+            if not isinstance(e, Cancelled):
+                # eg. a terminated process pool shared with other jobs
+                LOGGER.debug('Job cancelled with %s', e)
+
+            self.files = list()
+            LOGGER.info('Job cancelled, idle %.0fms after the cancel request.', self.cancel_token.latency() * 1000)
+            return None
+        finally:
+            # Release layers, scratch files and the previous Psd file on success, failure and cancel
+            pyshop.cleanup()
+            if previous:
+                previous.close()
+
+        if temp_file:
+            target_file = Path(self.psd_file)
+            try:
+                os.replace(temp_file, target_file)
+            except OSError:
+                self._remove_partial_files(pyshop, temp_file)
+                raise
+            psd_file = target_file
+
+        if self.incremental:
+            self._write_manifest(pyshop, psd_file, files)
+
+        self.timings = pyshop.timer.records(Path(psd_file).name, time.perf_counter() - start)
+        if self.trim_layers:
+            self.timings['job']['trimmed_percent'] = pyshop.trimmed_percent
+        if self.queue_stats:
+            self.timings['job']['queues'] = self.queue_stats
+        if pyshop.duplicate_count:
+            LOGGER.info('Re-used the content of %s duplicate layers.', pyshop.duplicate_count)
+        self._log_timings()
+
+        return psd_file
+
+    @staticmethod
+    def _remove_partial_files(pyshop: PyShop, temp_file: Union[None, Path]):
+        """ Remove the incomplete Psd stream and temporary Psd file of a failed or cancelled job """
+        pyshop.discard_psd_stream()
+        if temp_file is not None:
+            pyshop._remove_partial_file(temp_file)
+
+    def _log_timings(self):
+        for record in self.timings['files']:
+            LOGGER.debug('Timing %s: %s', record['name'], StageTimes.format(record['stages']))
+
+        job = self.timings['job']
+        LOGGER.info('Created %s from %s files in %.2fs: %s', job['name'], len(self.timings['files']),
+                    job['wall_time'], StageTimes.format(job['stages']))
+        if 'trimmed_percent' in job:
+            LOGGER.info('Trimmed %.1f%% of the decoded layer pixels.', job['trimmed_percent'])
+        for name, stats in job.get('queues', dict()).items():
+            LOGGER.info('Pipeline queue %s depth %s: mean fill %.1f, max fill %s, producers blocked %.2fs, '
+                        'consumers waited %.2fs', name, stats['depth'], stats['mean_fill'], stats['max_fill'],
+                        stats['put_wait'], stats['get_wait'])
+
+    def _find_previous_psd(self, pyshop: PyShop, files: List[Path]) -> Union[None, PsdManifest]:
+        """ Manifest of the Psd file in the output directory sharing the most unchanged files """
+        if not self.incremental:
+            return None
+
+        directory = Path(self.psd_file).parent if self.psd_file else self.current_dir
+        return PsdManifest.find_previous(directory, files, pyshop.layer_settings())
+
+    @staticmethod
+    def _write_manifest(pyshop: PyShop, psd_file: Path, files: List[Path]):
+        # Layers are matched by name, only record layers of unique names
+        names = Counter(f.stem for f in files)
+        layer_files = {f.stem: f for f in files if names[f.stem] == 1}
+
+        try:
+            PsdManifest.create(psd_file, pyshop.layer_settings(), layer_files).write()
+        except Exception as e:
+            LOGGER.error('Could not create Psd manifest of %s: %s', Path(psd_file).name, e)
+
+    def _add_layers(self, pyshop: PyShop, files: List[Path], previous_layers: Dict[Path, PreviousLayer],
+                    progress_step: Callable=None):
+        for file in files:
+            if progress_step:
+                progress_step()
+
+            if self.abort:
+                return
+
+            if file in previous_layers:
+                pyshop.add_cached_layer(file.stem, previous_layers[file])
+                continue
+
+            pyshop.add_image_as_layer(file)
+
+    @staticmethod
+    def _missing_files(files: List[Path], cached_layers: Dict[Path, object], file_keys: Dict[Path, tuple]
+                       ) -> List[Path]:
+        """ Files missing in the previous Psd file and the layer cache,
+            every image file reached through several paths once.
+        """
+        missing, missing_keys = list(), set()
+        for file in (f for f in files if cached_layers[f] is None):
+            if file_keys[file] is None or file_keys[file] not in missing_keys:
+                missing.append(file)
+                missing_keys.add(file_keys[file])
+
+        return missing
+
+    def _add_layers_with_read_ahead(self, pyshop: PyShop, files: List[Path],
+                                    previous_layers: Dict[Path, PreviousLayer], progress_step: Callable=None):
+        """ Decode files inside the job thread from buffers read ahead with concurrent requests """
+        cached_layers = {file: previous_layers.get(file) or pyshop.cached_layer(file) for file in files}
+        file_keys = {file: pyshop.file_key(file) for file in files}
+        missing = self._missing_files(files, cached_layers, file_keys)
+        LOGGER.info('Reading %s files ahead with %s concurrent requests.', self.read_ahead_files, self.read_requests)
+
+        buffers = iter(ReadAhead(missing, self.read_ahead_files, self.read_requests))
+
+        try:
+            for file in files:
+                if progress_step:
+                    progress_step()
+
+                if self.abort:
+                    return
+
+                if pyshop.add_duplicate_layer(file.stem, file_keys[file]):
+                    continue
+
+                cached = cached_layers.pop(file)
+                if cached is not None:
+                    pyshop.add_cached_layer(file.stem, cached)
+                    continue
+
+                file, data, waited = next(buffers)
+                pyshop.timer.add('read', waited, file.stem)
+                img_channels = pyshop._load_image_to_numpy_channels(file, BytesIO(data) if data is not None else None)
+                pyshop.add_channels_as_layer(file.stem, img_channels, file_key=file_keys[file])
+        finally:
+            # Do not start queued reads when aborted
+            buffers.close()
+
+    def _add_layers_with_pool(self, pyshop: PyShop, files: List[Path], previous_layers: Dict[Path, PreviousLayer],
+                              progress_step: Callable=None):
+        """ Decode files in worker processes and add the layers in the original sorted order """
+        cached_layers = {file: previous_layers.get(file) or pyshop.cached_layer(file) for file in files}
+        file_keys = {file: pyshop.file_key(file) for file in files}
+        missing = self._missing_files(files, cached_layers, file_keys)
+        LOGGER.info('Decoding %s files with a pool of %s processes.', len(missing), self.pool_size)
+
+        pool = None
+        if missing:
+            pool = LayerDecodePool(self.size, self.resample_filter, self.pool_size, self.place_layers,
+                                   self.process_pool, self.cancel_token)
+        decoded = pool.decode(missing) if missing else iter(())
+
+        try:
+            for file in files:
+                if progress_step:
+                    progress_step()
+
+                if self.abort:
+                    return
+
+                if pyshop.add_duplicate_layer(file.stem, file_keys[file]):
+                    continue
+
+                cached = cached_layers.pop(file)
+                if cached is not None:
+                    pyshop.add_cached_layer(file.stem, cached)
+                    continue
+
+                file, img_channels, stage_seconds = next(decoded)
+                pyshop.add_channels_as_layer(file.stem, img_channels, stage_seconds, file_keys[file])
+        finally:
+            if pool is not None:
+                # Do not start queued files when aborted
+                decoded.close()
+                pool.shutdown()
+
+    def _add_layers_with_pipeline(self, pyshop: PyShop, files: List[Path],
+                                  previous_layers: Dict[Path, PreviousLayer], progress_step: Callable=None):
+        """ Read, decode and compress files in a LayerPipeline and add the layers in the original sorted order """
+        cached_layers = {file: previous_layers.get(file) or pyshop.cached_layer(file) for file in files}
+        file_keys = {file: pyshop.file_key(file) for file in files}
+        missing = self._missing_files(files, cached_layers, file_keys)
+
+        pipeline = None
+        if missing:
+            read_requests = self.read_requests if self.read_ahead_files else 1
+            pipeline = LayerPipeline(pyshop, self.decode_threads, self.encode_threads, self.queue_depths,
+                                     self.read_ahead_files, read_requests)
+        processed = pipeline.process(missing) if missing else iter(())
+
+        try:
+            for file in files:
+                if progress_step:
+                    progress_step()
+
+                if self.abort:
+                    return
+
+                if pyshop.add_duplicate_layer(file.stem, file_keys[file]):
+                    continue
+
+                cached = cached_layers.pop(file)
+                if cached is not None:
+                    pyshop.add_cached_layer(file.stem, cached)
+                    continue
+
+                item = next(processed)
+                if item.img_channels is not None:
+                    pyshop.add_channels_as_layer(file.stem, item.img_channels, item.stage_seconds, file_keys[file])
+                else:
+                    pyshop.add_encoded_layer(file.stem, item.encoded, item.stage_seconds, item.digest,
+                                             file_keys[file])
+        finally:
+            if pipeline is not None:
+                # Stop reading and decoding when aborted
+                processed.close()
+                pipeline.close()
+                self.queue_stats = pipeline.queue_stats()
+
+    def _create_psd_name(self) -> str:
+        return f'{self.psd_base_name}_{self.counter:02d}_{self.psd_name_suffix}.psd'
+
+    def _create_psd_path(self):
+        psd_name: str = self._create_psd_name()
+        psd_path: Path = self.current_dir / psd_name
+
+        with self.reserved_lock:
+            while psd_path.exists() or psd_path in self.reserved_psd_files:
+                self.counter += 1
+                psd_name: str = self._create_psd_name()
+                psd_path: Path = self.current_dir / psd_name
+
+                if PsdJob.counter >= 99:
+                    LOGGER.error('Could not find a unique Psd file name!')
+                    break
+
+            self.reserved_psd_files.add(psd_path)
+            self._reserved = psd_path
+
+        return psd_path
+
+    def _release_psd_path(self):
+        with self.reserved_lock:
+            if self._reserved is not None:
+                self.reserved_psd_files.discard(self._reserved)
+                self._reserved = None
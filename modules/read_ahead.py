@@ -0,0 +1,116 @@
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Tuple, Union
+
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+
+def _advise(fd: int, *advices: int):
+    """ Access pattern hints for the kernel, not available on every platform """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    for advice in advices:
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError:
+            pass
+
+
+class ReadAhead:
+    """ Reads the next files into memory with several concurrent requests while earlier files get decoded.
+
+        Opening and reading a file on a network share stalls on the latency of every request. Fetching
+        several files at once hides the latency and decoding from the buffers never blocks on the network.
+        The kernel gets told every file is read sequentially and as a whole, so it reads ahead in large requests.
+    """
+    # Larger files are not buffered but opened by the decoder
+    max_size = 256 * 1048576
+
+    # Opens a file for reading in binary mode, replaced eg. by a throttled file system stand-in
+    opener: Callable = open
+
+    def __init__(self, files: Iterable[Path], depth: int, requests: int=1):
+        """
+        :param files: Files to read in order
+        :param depth: Number of files buffered ahead of the consumer
+        :param requests: Number of files read concurrently
+        """
+        self.files = iter(files)
+        self.depth = max(1, depth)
+        self.requests = max(1, min(requests, self.depth))
+
+        self.executor: Union[None, ThreadPoolExecutor] = None
+
+    @classmethod
+    def read(cls, file: Path) -> Union[None, bytes]:
+        """ Read the content of a file, None if it exceeds max_size """
+        with cls.opener(file, 'rb') as f:
+            fd = f.fileno() if hasattr(f, 'fileno') else None
+            if fd is not None:
+                if os.fstat(fd).st_size > cls.max_size:
+                    return None
+                _advise(fd, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0), getattr(os, 'POSIX_FADV_WILLNEED', 0))
+
+            data = f.read(cls.max_size + 1)
+
+        if len(data) > cls.max_size:
+            return None
+
+        return data
+
+    @classmethod
+    def _fetch(cls, file: Path) -> Union[None, bytes]:
+        try:
+            return cls.read(file)
+        except OSError as e:
+            # Reported by the decoder opening the file
+            LOGGER.debug('Could not read ahead %s: %s', file.name, e)
+
+        return None
+
+    def __iter__(self) -> Iterator[Tuple[Path, Union[None, bytes], float]]:
+        """ Yield (file, content or None if the file was not buffered, seconds waited for the content)
+            in the order of the provided files.
+        """
+        self.executor = ThreadPoolExecutor(max_workers=self.requests)
+        pending = deque()
+
+        def submit_next() -> bool:
+            try:
+                file = next(self.files)
+            except StopIteration:
+                return False
+
+            pending.append((file, self.executor.submit(self._fetch, file)))
+            return True
+
+        while len(pending) < self.depth and submit_next():
+            pass
+
+        try:
+            while pending:
+                file, future = pending.popleft()
+
+                start = time.perf_counter()
+                data = future.result()
+                waited = time.perf_counter() - start
+
+                submit_next()
+                yield file, data, waited
+        finally:
+            # Consumer stopped early eg. aborted, do not start queued reads
+            for file, future in pending:
+                future.cancel()
+            self.close()
+
+    def close(self):
+        """ Stop reading, reads in progress finish in the background """
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
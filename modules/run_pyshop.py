@@ -1,105 +1,53 @@
 from pathlib import Path
-from threading import Thread
 from typing import List
 
 from PySide2.QtCore import QObject, Signal, Slot
 
 from modules import AppSettings
-from modules.detect_language import get_translation
+from modules.job_scheduler import JobScheduler, ScheduledJob
 from modules.log import init_logging
-from modules.pyshop import PyShop
-from modules.widgets.settings_dialog import ResampleFilterSetting
+from modules.pyshop_job import PsdJob
 
 LOGGER = init_logging(__name__)
 
-# translate strings
-lang = get_translation()
-lang.install()
-_ = lang.gettext
 
-
-class CreateLayeredPsdSignals(QObject):
-    started = Signal()
-    progress_step = Signal()
-    finished = Signal()
+class PsdJobQueueSignals(QObject):
+    # ScheduledJob whose state or progress changed
+    job_updated = Signal(object)
     file_created = Signal(Path)
+    # Per file and per job seconds spent in every pipeline stage, see PipelineTimer.records
+    timings = Signal(dict)
 
 
-class CreateLayeredPsdThread(Thread):
-    counter = 0
-    psd_base_name = _('Dateien')
-    psd_name_suffix = _('Stapel')
-
-    def __init__(self, parent, files: List[Path]):
-        super(CreateLayeredPsdThread, self).__init__()
+class PsdJobQueue(QObject):
+    """ Queues a PsdJob for every drop, runs them with a JobScheduler and reports them as Qt signals """
+    def __init__(self, parent=None):
+        super(PsdJobQueue, self).__init__(parent=parent)
 
-        self.parent = parent
-        self.files = files
-        self.abort = False
+        self.signals = PsdJobQueueSignals()
+        self.scheduler = JobScheduler(AppSettings.app['concurrent_jobs'], AppSettings.app['process_pool_size'],
+                                      listener=self._job_updated)
 
-        self.size = AppSettings.app['psd_size']
+    def add_files(self, files: List[Path]) -> ScheduledJob:
+        """ Queue a job with a frozen copy of the current settings """
+        return self.scheduler.submit(PsdJob.from_settings(files))
 
-        for (name, filter_setting, desc) in ResampleFilterSetting.values:
-            if name == AppSettings.app['resampling_filter']:
-                self.resample_filter = filter_setting
+    def _job_updated(self, scheduled: ScheduledJob):
+        """ Called from the job threads """
+        if scheduled.state == ScheduledJob.finished:
+            self.signals.timings.emit(scheduled.job.timings)
+            self.signals.file_created.emit(scheduled.psd_file)
 
-        self.signals = CreateLayeredPsdSignals()
+        self.signals.job_updated.emit(scheduled)
 
-        if files:
-            self.current_dir = files[0].parent
-        else:
-            self.current_dir = Path('.')
+    @Slot(int)
+    def cancel_job(self, job_id: int):
+        self.scheduler.cancel(job_id)
 
     @Slot()
-    def abort_creation(self):
-        self.abort = True
-
-    def _abort(self):
-        self.files = list()
-        self.signals.finished.emit()
-
-    def run(self):
-        if not self.files:
-            return
-
-        self.signals.started.emit()
-        pyshop = PyShop(self.size, self.resample_filter)
-
-        for file in reversed(sorted(self.files)):
-            self.signals.progress_step.emit()
-
-            if self.abort:
-                del pyshop
-                self._abort()
-                return
-
-            pyshop.add_image_as_layer(file)
-
-        if self.abort:
-            del pyshop
-            self._abort()
-            return
-
-        psd_file = self._create_psd_path()
-        pyshop.create_psd(psd_file=psd_file)
-
-        self.signals.finished.emit()
-        self.signals.file_created.emit(psd_file)
-
-    def _create_psd_name(self) -> str:
-        return f'{self.psd_base_name}_{self.counter:02d}_{self.psd_name_suffix}.psd'
-
-    def _create_psd_path(self):
-        psd_name: str = self._create_psd_name()
-        psd_path: Path = self.current_dir / psd_name
-
-        while psd_path.exists():
-            self.counter += 1
-            psd_name: str = self._create_psd_name()
-            psd_path: Path = self.current_dir / psd_name
-
-            if CreateLayeredPsdThread.counter >= 99:
-                LOGGER.error('Could not find a unique Psd file name!')
-                break
+    def cancel_all(self):
+        self.scheduler.cancel_all()
 
-        return psd_path
+    def shutdown(self):
+        """ Abort all jobs and stop the shared process pool, call before the application quits """
+        self.scheduler.shutdown(cancel=True)
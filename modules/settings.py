@@ -81,7 +81,39 @@ class AppSettings:
         editor_path='.',
         psd_size=(1920, 1080),
         window=(0, 0, 0, 0),
-        resampling_filter='Bicubic'
+        resampling_filter='Bicubic',
+        # Layer channel compression: Raw, RLE, ZIP, ZIP Prediction or Auto
+        compression='RLE',
+        # Number of processes decoding image files, 0 or 1 decodes inside the job thread
+        process_pool_size=0,
+        # Number of processes compressing layers before the Psd file is written, 0 or 1 compresses in the job thread
+        encode_pool_size=0,
+        # Write layers to the Psd file as soon as they are decoded instead of keeping them in memory
+        stream_psd=False,
+        # Keep decoded layers above this budget in scratch files, 0 keeps everything in memory
+        memory_budget_mb=0,
+        # Directory for scratch files, system temp directory if empty
+        scratch_dir='',
+        # Size of the on disk cache of compressed layers in the settings directory, 0 disables the cache
+        layer_cache_mb=0,
+        # Copy layers of unchanged files from a previously created Psd file, writes a manifest next to every Psd file
+        incremental_export=False,
+        # Store resized images at their size centered by the layer bounds instead of padding them to the Psd size
+        layer_placement=False,
+        # Crop fully transparent borders off layers and store them with matching layer bounds
+        trim_layers=False,
+        # Re-use the layer content of image files reached through several paths and of identical images
+        dedup_layers=True,
+        # Threads reading, decoding and compressing files at the same time, 0 decodes inside the job thread
+        pipeline_decode_threads=0,
+        pipeline_encode_threads=2,
+        # Files read ahead, decoded layers waiting for compression and compressed layers waiting to be added
+        pipeline_queue_depths=[4, 2, 2],
+        # Files read into memory ahead of decoding eg. from network shares and how many are read at once, 0 disables it
+        read_ahead_files=0,
+        read_ahead_requests=4,
+        # Jobs running at the same time, further dropped files wait in the job queue
+        concurrent_jobs=1
         )
 
     language = 'de'
@@ -0,0 +1,78 @@
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Union
+
+
+class StageTimes:
+    """ Seconds spent in the stages of the Psd pipeline for one file or a whole job """
+    stages = ['read', 'decode', 'resize', 'split', 'trim', 'dedup', 'compress', 'write']
+
+    def __init__(self, name: str=''):
+        self.name = name
+        self.seconds: Dict[str, float] = dict()
+
+    def add(self, stage: str, seconds: float):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def update(self, seconds: Dict[str, float]):
+        for stage, value in seconds.items():
+            self.add(stage, value)
+
+    @property
+    def total(self) -> float:
+        return sum(self.seconds.values())
+
+    def record(self) -> dict:
+        return dict(name=self.name, stages=dict(self.seconds), total=self.total)
+
+    @classmethod
+    def format(cls, seconds: Dict[str, float]) -> str:
+        return ', '.join(f'{stage} {seconds[stage] * 1000:.1f}ms' for stage in cls.stages if stage in seconds)
+
+    def __str__(self):
+        return self.format(self.seconds)
+
+
+class PipelineTimer:
+    """ Times the pipeline stages of every file. Stages not related to a file eg. writing
+        the Psd file only count for the whole job, the job stages are the sum of all files.
+    """
+    def __init__(self):
+        self.files: Dict[str, StageTimes] = dict()
+        self.job = StageTimes()
+
+    def add(self, stage: str, seconds: float, name: Union[None, str]=None):
+        """ Add seconds to the stage of the named file and the job """
+        if name is not None:
+            self.files.setdefault(name, StageTimes(name)).add(stage, seconds)
+
+        self.job.add(stage, seconds)
+
+    def update(self, seconds: Dict[str, float], name: Union[None, str]=None):
+        for stage, value in seconds.items():
+            self.add(stage, value, name)
+
+    @contextmanager
+    def stage(self, stage: str, name: Union[None, str]=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, name)
+
+    def file_seconds(self, name: str) -> Dict[str, float]:
+        if name not in self.files:
+            return dict()
+        return dict(self.files[name].seconds)
+
+    def records(self, name: str='', wall_time: float=0.0) -> dict:
+        """ Per file and per job timing records
+
+        :param name: Name of the job eg. the Psd file name
+        :param wall_time: Seconds the whole job took
+        """
+        job = self.job.record()
+        job.update(name=name, wall_time=wall_time)
+        files: List[dict] = [times.record() for times in self.files.values()]
+
+        return dict(job=job, files=files)
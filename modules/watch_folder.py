@@ -0,0 +1,288 @@
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, List, Set, Tuple, Union
+
+from modules.log import init_logging
+from modules.pyshop import PyShop
+from modules.pyshop_job import PsdJob
+
+LOGGER = init_logging(__name__)
+
+# File system notifications are optional, folders get polled without watchdog
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler, Observer = object, None
+
+# Keep watchdog's event debug messages out of the log
+logging.getLogger('watchdog').setLevel(logging.INFO)
+
+
+class _FileState:
+    def __init__(self, size: int, mtime: float, changed: float):
+        self.size = size
+        self.mtime = mtime
+        self.changed = changed
+
+
+class _EventHandler(FileSystemEventHandler):
+    """ Collects the paths of created, modified and moved files reported by watchdog """
+    def __init__(self, watcher):
+        super(_EventHandler, self).__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+
+        self.watcher.notify(Path(getattr(event, 'dest_path', '') or event.src_path))
+
+
+class WatchFolder:
+    """ Watches render output folders and creates a layered Psd file for every group of image files.
+
+        Files are grouped into jobs by a regular expression searched in the file name, the named
+        group 'job' or the whole match is the job key eg. the frame number of a render pass.
+        A file is complete once it's size and modification time did not change for the settle time.
+        A job starts when all of it's files are complete and, if set, the expected number of passes
+        arrived. Files re-rendered into a finished job are stacked again with the other files of that job.
+        Several jobs run concurrently, every job runs as PsdJob like jobs started from the GUI.
+    """
+    default_pattern = r'(?P<job>\d+)$'
+
+    def __init__(self, folders: List[Union[Path, str]], create_job: Callable[[List[Path]], PsdJob],
+                 pattern: str=default_pattern, passes: int=0, settle_time: float=2.0, poll_interval: float=1.0,
+                 max_jobs: int=2, process_existing: bool=False, use_notifications: bool=True):
+        """
+        :param folders: Folders to watch, sub folders are not watched
+        :param create_job: Creates the PsdJob for a list of files
+        :param pattern: Regular expression searched in the file name without suffix
+        :param passes: Number of files a job waits for, 0 starts jobs once no file changed for the settle time
+        :param settle_time: Seconds a files size and modification time have to stay unchanged
+        :param poll_interval: Seconds between checks of incomplete files or folder scans when polling
+        :param max_jobs: Number of jobs running concurrently
+        :param process_existing: Create jobs for files already present in the folders
+        :param use_notifications: Use file system notifications if watchdog is available
+        """
+        self.folders = [Path(f) for f in folders]
+        self.create_job = create_job
+        self.pattern = re.compile(pattern)
+        self.passes = passes
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.process_existing = process_existing
+
+        self.observer = None
+        if use_notifications and Observer is not None:
+            self.observer = Observer()
+
+        self.executor = ThreadPoolExecutor(max_workers=max(1, max_jobs))
+
+        self.files: Dict[Path, _FileState] = dict()
+        self.done: Dict[Path, Tuple[int, float]] = dict()
+        self.running: Dict[Tuple[Path, str], Future] = dict()
+
+        self.notified: Set[Path] = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.stopped = threading.Event()
+
+    def notify(self, file: Path):
+        """ Called from the watchdog observer thread """
+        with self.lock:
+            self.notified.add(file)
+        self.wake.set()
+
+    def job_key(self, file: Path) -> Union[None, Tuple[Path, str]]:
+        """ Folder and job key of a supported image file or None """
+        if file.suffix.casefold() not in PyShop.supported_img:
+            return None
+
+        match = self.pattern.search(file.stem)
+        if match is None:
+            return None
+
+        return file.parent, match.groupdict().get('job') or match.group(0)
+
+    def _scan(self) -> Set[Path]:
+        files = set()
+
+        for folder in self.folders:
+            try:
+                with os.scandir(folder) as it:
+                    for entry in it:
+                        try:
+                            if entry.is_file():
+                                files.add(Path(entry.path))
+                        except OSError:
+                            # File was removed while scanning
+                            pass
+            except OSError as e:
+                LOGGER.error('Could not scan watch folder %s: %s', folder.as_posix(), e)
+
+        return files
+
+    def _changed_files(self) -> Set[Path]:
+        if self.observer is None:
+            return self._scan()
+
+        with self.lock:
+            files, self.notified = self.notified, set()
+
+        return files
+
+    @staticmethod
+    def _stat(file: Path) -> Union[None, os.stat_result]:
+        try:
+            return file.stat()
+        except OSError:
+            # File was removed or renamed
+            return None
+
+    def _update(self, file: Path, now: float):
+        """ Track size and modification time of a file """
+        if self.job_key(file) is None:
+            return
+
+        stat = self._stat(file)
+        if stat is None:
+            self.files.pop(file, None)
+            return
+
+        if self.done.get(file) == (stat.st_size, stat.st_mtime):
+            return
+
+        state = self.files.get(file)
+        if state is None:
+            self.files[file] = _FileState(stat.st_size, stat.st_mtime, now)
+            LOGGER.debug('Watching new file %s', file.name)
+        elif (state.size, state.mtime) != (stat.st_size, stat.st_mtime):
+            state.size, state.mtime, state.changed = stat.st_size, stat.st_mtime, now
+
+    def _groups(self) -> Dict[Tuple[Path, str], List[Path]]:
+        groups = dict()
+
+        for file in self.files:
+            key = self.job_key(file)
+            if key is not None:
+                groups.setdefault(key, list()).append(file)
+
+        return groups
+
+    def _finished_files(self, key: Tuple[Path, str]) -> List[Path]:
+        """ Files of earlier jobs with the same job key that still exist """
+        files = list()
+
+        for file in list(self.done):
+            if file in self.files or self.job_key(file) != key:
+                continue
+            if self._stat(file) is None:
+                self.done.pop(file)
+                continue
+            files.append(file)
+
+        return files
+
+    def _dispatch(self, now: float):
+        """ Start jobs for all groups whose files are complete """
+        for key, files in self._groups().items():
+            if key in self.running:
+                continue
+
+            states = [self.files[f] for f in files]
+            if any(s.size == 0 or now - s.changed < self.settle_time for s in states):
+                continue
+
+            # Re-rendered files replace their layers in the Psd file of the whole job
+            finished = self._finished_files(key)
+            if self.passes and len(files) + len(finished) < self.passes:
+                continue
+
+            for file, state in zip(files, states):
+                self.done[file] = (state.size, state.mtime)
+                self.files.pop(file)
+
+            files += finished
+            LOGGER.info('Starting watch folder job %s with %s files in %s', key[1], len(files), key[0].as_posix())
+            self.running[key] = self.executor.submit(self._run_job, key, sorted(files))
+
+        for key, future in list(self.running.items()):
+            if future.done():
+                self.running.pop(key)
+
+    def _run_job(self, key: Tuple[Path, str], files: List[Path]) -> Union[None, Path]:
+        job = self.create_job(files)
+        # Name files after the job key, concurrent jobs in one folder must not pick the same name
+        job.psd_base_name = key[1]
+
+        try:
+            psd_file = job.run()
+        except Exception as e:
+            LOGGER.error('Watch folder job %s failed: %s', key[1], e)
+            return None
+
+        if psd_file is not None:
+            LOGGER.info('Watch folder job %s created: %s', key[1], psd_file.as_posix())
+
+        return psd_file
+
+    def start(self):
+        """ Start watching, existing files are marked as done unless process_existing is set """
+        now = time.monotonic()
+        for file in self._scan():
+            if self.process_existing:
+                self._update(file, now)
+            else:
+                stat = self._stat(file)
+                if stat is not None:
+                    self.done[file] = (stat.st_size, stat.st_mtime)
+
+        if self.observer is not None:
+            handler = _EventHandler(self)
+            for folder in self.folders:
+                self.observer.schedule(handler, folder.as_posix(), recursive=False)
+            self.observer.start()
+
+        LOGGER.info('Watching %s folders %s', len(self.folders),
+                    'with file system notifications' if self.observer else 'by polling')
+
+    def run(self):
+        """ Watch until stop is called """
+        self.start()
+
+        try:
+            while not self.stopped.is_set():
+                now = time.monotonic()
+
+                for file in self._changed_files() | set(self.files):
+                    self._update(file, now)
+
+                self._dispatch(now)
+
+                # Without pending files or running jobs notifications will wake us up
+                timeout = self.poll_interval
+                if self.observer is not None and not self.files and not self.running:
+                    timeout = None
+
+                self.wake.wait(timeout)
+                self.wake.clear()
+        finally:
+            self._shutdown()
+
+    def stop(self):
+        self.stopped.set()
+        self.wake.set()
+
+    def _shutdown(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+        LOGGER.info('Waiting for %s running watch folder jobs.', len(self.running))
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,92 @@
+from typing import Dict
+
+from PySide2.QtCore import Qt, QTimer, Signal
+from PySide2.QtWidgets import QAbstractItemView, QHeaderView, QMenu, QProgressBar, QTreeWidget, QTreeWidgetItem
+
+from modules.detect_language import get_translation
+from modules.job_scheduler import ScheduledJob
+from modules.log import init_logging
+
+LOGGER = init_logging(__name__)
+
+# translate strings
+lang = get_translation()
+lang.install()
+_ = lang.gettext
+
+
+class JobQueueWidget(QTreeWidget):
+    """ Lists pending and running jobs with their progress, hidden while no job is queued """
+    cancel_job = Signal(int)
+
+    # Milliseconds a finished job stays in the list
+    remove_delay = 3000
+
+    state_names = {
+        ScheduledJob.pending: _('Wartet'),
+        ScheduledJob.running: _('Läuft'),
+        ScheduledJob.finished: _('Fertig'),
+        ScheduledJob.failed: _('Fehler'),
+        ScheduledJob.cancelled: _('Abgebrochen'),
+        }
+
+    def __init__(self, parent):
+        super(JobQueueWidget, self).__init__(parent)
+
+        self.setColumnCount(3)
+        self.setHeaderLabels([_('Auftrag'), _('Status'), _('Fortschritt')])
+        self.setRootIsDecorated(False)
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setMaximumHeight(120)
+        self.header().setSectionResizeMode(0, QHeaderView.Stretch)
+
+        self.setContextMenuPolicy(Qt.CustomContextMenu)
+        self.customContextMenuRequested.connect(self._context_menu)
+
+        self.items: Dict[int, QTreeWidgetItem] = dict()
+        self.hide()
+
+    def update_job(self, scheduled: ScheduledJob):
+        item = self.items.get(scheduled.id)
+
+        if item is None:
+            if not scheduled.is_active:
+                return
+            item = QTreeWidgetItem(self)
+            item.setData(0, Qt.UserRole, scheduled.id)
+            progress = QProgressBar(self)
+            progress.setFormat('%v/%m')
+            progress.setAlignment(Qt.AlignCenter)
+            self.setItemWidget(item, 2, progress)
+            self.items[scheduled.id] = item
+
+        item.setText(0, scheduled.name)
+        item.setText(1, self.state_names.get(scheduled.state, scheduled.state))
+        item.setToolTip(1, scheduled.error)
+
+        progress: QProgressBar = self.itemWidget(item, 2)
+        progress.setMaximum(max(1, scheduled.total))
+        progress.setValue(min(scheduled.progress, scheduled.total))
+
+        if not scheduled.is_active:
+            QTimer.singleShot(self.remove_delay, lambda: self._remove(scheduled.id))
+
+        self.show()
+
+    def _remove(self, job_id: int):
+        item = self.items.pop(job_id, None)
+        if item is not None:
+            self.takeTopLevelItem(self.indexOfTopLevelItem(item))
+
+        if not self.items:
+            self.hide()
+
+    def _context_menu(self, pos):
+        item = self.itemAt(pos)
+        if item is None:
+            return
+
+        menu = QMenu(self)
+        cancel_action = menu.addAction(_('Auftrag abbrechen'))
+        if menu.exec_(self.viewport().mapToGlobal(pos)) == cancel_action:
+            self.cancel_job.emit(item.data(0, Qt.UserRole))
@@ -3,7 +3,8 @@ from pathlib import Path
 from PIL import Image
 from PySide2.QtCore import Qt, QRegExp, Slot
 from PySide2.QtGui import QRegExpValidator
-from PySide2.QtWidgets import QDialog, QHBoxLayout, QLabel, QLineEdit, QPushButton, QToolButton, QVBoxLayout, QComboBox
+from PySide2.QtWidgets import QCheckBox, QComboBox, QDialog, QHBoxLayout, QLabel, QLineEdit, QPushButton, \
+    QToolButton, QVBoxLayout
 
 from modules.pyshop import PyShop
 from modules import AppSettings
@@ -27,7 +28,7 @@ class SettingsDialog(QDialog):
         self.setWindowFlags(self.windowFlags() & ~Qt.WindowContextHelpButtonHint)
         self.setWindowTitle(_('{} - Einstellungsdialog').format(APP_NAME.capitalize()))
 
-        min_size = (850, 512)
+        min_size = (850, 840)
 
         self.setMinimumSize(*min_size)
 
@@ -54,6 +55,15 @@ class ResolutionLineEdit(QLineEdit):
         self.setValidator(self.validator)
 
 
+class MegabyteLineEdit(QLineEdit):
+    regex = QRegExp('^\d{1,6}$')
+    validator = QRegExpValidator(regex)
+
+    def __init__(self, parent):
+        super(MegabyteLineEdit, self).__init__(parent)
+        self.setValidator(self.validator)
+
+
 class ResampleFilterSetting(QComboBox):
     values = [
         ('Bilinear', Image.BILINEAR, _('Schnell - niedrige Qualität.')),
@@ -90,6 +100,46 @@ class ResampleFilterSetting(QComboBox):
         self.desc_label.setText(description)
 
 
+class CompressionSetting(QComboBox):
+    values = [
+        ('RLE', PyShop.compression_methods['RLE'], _('Schnell - Standard Komprimierung von Photoshop.')),
+        ('Raw', PyShop.compression_methods['Raw'],
+         _('Am schnellsten - keine Komprimierung. Für lokale Datenträger mit viel Speicherplatz.')),
+        ('ZIP', PyShop.compression_methods['ZIP'], _('Langsam - kleinere Dateien.')),
+        ('ZIP Prediction', PyShop.compression_methods['ZIP Prediction'],
+         _('Langsam - kleinste Dateien bei Verläufen und Fotos. Für langsame Netzwerkfreigaben.')),
+        ('Auto', PyShop.compression_methods['Auto'],
+         _('Wählt die Komprimierung für jede Ebene anhand einiger Beispielzeilen.')),
+        ]
+
+    default_value_idx = 0  # RLE
+
+    def __init__(self, parent, desc_label: QLabel):
+        super(CompressionSetting, self).__init__(parent)
+        self.desc_label = desc_label
+        self.desc_text = self.desc_label.text()
+
+        self.currentIndexChanged.connect(self.update_setting)
+
+        current_setting_idx = self.default_value_idx
+
+        for idx, (text, data, description) in enumerate(self.values):
+            self.addItem(text, data)
+
+            if text == AppSettings.app['compression']:
+                current_setting_idx = idx
+
+        self.setCurrentIndex(current_setting_idx)
+
+    @Slot(int)
+    def update_setting(self, current_idx):
+        description = '{}<br><b>{}:</b> {}'.format(self.desc_text,  # Compression description
+                                                   self.values[current_idx][0],  # Compression name
+                                                   self.values[current_idx][2],  # Compression description
+                                                   )
+        self.desc_label.setText(description)
+
+
 class PhotoshopSettings(SettingsDialog):
     psd_editor_path = ''
 
@@ -108,6 +158,12 @@ class PhotoshopSettings(SettingsDialog):
         resolution_box.setContentsMargins(13, 13, 13, 26)
         filter_box = QHBoxLayout()
         filter_box.setContentsMargins(13, 13, 13, 26)
+        compression_box = QHBoxLayout()
+        compression_box.setContentsMargins(13, 13, 13, 26)
+        cache_box = QHBoxLayout()
+        cache_box.setContentsMargins(13, 13, 13, 26)
+        incremental_box = QHBoxLayout()
+        incremental_box.setContentsMargins(13, 13, 13, 26)
         path_box = QHBoxLayout()
         path_box.setSpacing(13)
         path_box.setContentsMargins(13, 13, 13, 26)
@@ -150,6 +206,50 @@ class PhotoshopSettings(SettingsDialog):
         filter_box.addWidget(self.filter_combo_box)
         vbox.addLayout(filter_box)
 
+        # --- Compression Setting ---
+        compression_title = QLabel(_('<h4 style="margin: 2px 0;">Komprimierung</h4>'
+                                     'Komprimierung der Ebenen in der Photoshop Datei.<br>'), self)
+        vbox.addWidget(compression_title)
+
+        compression_lbl = QLabel(_('Komprimierung wählen:'), self)
+        compression_box.addWidget(compression_lbl)
+
+        self.compression_combo_box = CompressionSetting(self, compression_title)
+
+        compression_box.addWidget(self.compression_combo_box)
+        vbox.addLayout(compression_box)
+
+        # --- Layer Cache Setting ---
+        cache_title = QLabel(self)
+        cache_title.setWordWrap(True)
+        cache_title.setText(_('<h4 style="margin: 2px 0;">Ebenen-Cache</h4>'
+                              'Speichert komprimierte Ebenen im Einstellungsverzeichnis. Unveränderte Dateien '
+                              'werden beim nächsten Stapel nicht erneut dekodiert.<br>'))
+        vbox.addWidget(cache_title)
+
+        cache_lbl = QLabel(_('Größe in MB, 0 deaktiviert den Cache:'), self)
+        cache_box.addWidget(cache_lbl)
+
+        self.cache_edit = MegabyteLineEdit(self)
+        self.cache_edit.setText(str(AppSettings.app['layer_cache_mb']))
+        cache_box.addWidget(self.cache_edit)
+        vbox.addLayout(cache_box)
+
+        # --- Incremental Export Setting ---
+        incremental_title = QLabel(self)
+        incremental_title.setWordWrap(True)
+        incremental_title.setText(_('<h4 style="margin: 2px 0;">Inkrementeller Export</h4>'
+                                    'Legt neben jeder Photoshop Datei ein Manifest an. Wird ein Stapel mit '
+                                    'größtenteils denselben Dateien erneut erstellt, werden nur geänderte '
+                                    'Ebenen neu berechnet.<br>'))
+        vbox.addWidget(incremental_title)
+
+        self.incremental_check = QCheckBox(_('Unveränderte Ebenen aus der vorherigen Photoshop Datei übernehmen'),
+                                           self)
+        self.incremental_check.setChecked(AppSettings.app['incremental_export'])
+        incremental_box.addWidget(self.incremental_check)
+        vbox.addLayout(incremental_box)
+
         # --- Path Settings ---
         path_desc = QLabel(self)
         path_desc.setWordWrap(True)
@@ -206,6 +306,15 @@ class PhotoshopSettings(SettingsDialog):
         # Update Resample Filter Setting
         AppSettings.app['resampling_filter'] = self.filter_combo_box.currentText()
 
+        # Update Compression Setting
+        AppSettings.app['compression'] = self.compression_combo_box.currentText()
+
+        # Update Layer Cache Setting
+        AppSettings.app['layer_cache_mb'] = int(self.cache_edit.text() or 0)
+
+        # Update Incremental Export Setting
+        AppSettings.app['incremental_export'] = self.incremental_check.isChecked()
+
         # Update Photoshop Editor Path Setting
         if self.psd_editor_path:
             AppSettings.app['editor_path'] = self.psd_editor_path
@@ -222,4 +331,8 @@ class PhotoshopSettings(SettingsDialog):
             if filter_setting == PyShop.default_resample_filter:
                 AppSettings.app['resampling_filter'] = name
 
+        AppSettings.app['compression'] = PyShop.default_compression
+        AppSettings.app['layer_cache_mb'] = 0
+        AppSettings.app['incremental_export'] = False
+
         self.reject()
@@ -0,0 +1,74 @@
+import unittest
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+from modules import band_decode
+
+
+def gradient_png(size=(301, 400)) -> bytes:
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.dstack((x * 255 // width, y * 255 // height, (x * y) % 256)).astype(np.uint8)
+
+    fp = BytesIO()
+    Image.fromarray(rgb).save(fp, format='PNG')
+    return fp.getvalue()
+
+
+def palette_png(size=(301, 203), colors=32) -> bytes:
+    """ Palette Png with gradients and a transparent palette entry """
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    rgb = np.dstack((x * 255 // width, y * 255 // height, (x + y) % 256)).astype(np.uint8)
+    img = Image.fromarray(rgb).quantize(colors)
+
+    fp = BytesIO()
+    img.save(fp, format='PNG', transparency=3)
+    return fp.getvalue()
+
+
+class BandDecodeTest(unittest.TestCase):
+    def setUp(self):
+        # Decode the test images in several bands
+        self.band_size = band_decode.BAND_SIZE
+        band_decode.BAND_SIZE = 4096
+
+    def tearDown(self):
+        band_decode.BAND_SIZE = self.band_size
+
+    def assertSameImage(self, img: Image.Image, expected: Image.Image):
+        self.assertEqual(img.size, expected.size)
+        np.testing.assert_array_equal(np.asarray(img), np.asarray(expected))
+
+    def test_reduce_palette_bands(self):
+        data = palette_png()
+        decoder = band_decode.open_band_decoder(BytesIO(data), 1)
+        self.assertIsNotNone(decoder)
+
+        img = band_decode.reduce_bands(decoder, (1, 1), 'P')
+
+        expected = Image.open(BytesIO(data))
+        self.assertSameImage(img.convert('RGBA'), expected.convert('RGBA'))
+        self.assertSameImage(img.convert('RGB'), expected.convert('RGB'))
+
+    def test_palette_image_not_resized(self):
+        data = palette_png()
+        decoder = band_decode.open_band_decoder(BytesIO(data), 1)
+
+        img = band_decode.resize_thumbnail(decoder, (640, 360), Image.BICUBIC)
+
+        self.assertSameImage(img.convert('RGBA'), Image.open(BytesIO(data)).convert('RGBA'))
+
+    def test_resample_bands(self):
+        data = gradient_png()
+        decoder = band_decode.open_band_decoder(BytesIO(data), 1)
+
+        img = band_decode.resample_bands(decoder, (150, 100), Image.BICUBIC, 'RGB')
+
+        self.assertSameImage(img, Image.open(BytesIO(data)).resize((150, 100), Image.BICUBIC))
+
+
+if __name__ == '__main__':
+    unittest.main()
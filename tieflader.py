@@ -1,11 +1,12 @@
 import sys
 import logging
+from multiprocessing import freeze_support
 from queue import Queue
 
 from modules.gui.gui_utils import GuiExceptionHook
 from modules.settings import delayed_log_setup
 from ui import gui_resource
-from modules import AppSettings
+from modules import AppSettings, packbits
 from modules.gui.main_app import MainApp
 from modules.app_globals import APP_NAME
 from modules.log import init_logging, setup_log_queue_listener, setup_logging
@@ -51,6 +52,7 @@ def main():
 
     LOGGER.info('---------------------------------------')
     LOGGER.info('Application start.')
+    LOGGER.info('Using %s PackBits encoder.', packbits.active_encoder())
 
     AppSettings.load()
 
@@ -74,4 +76,6 @@ def main():
 
 
 if __name__ == "__main__":
+    # Required for process pools inside frozen PyInstaller executables
+    freeze_support()
     main()